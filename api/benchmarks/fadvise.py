@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# Mixed workload benchmark of the page cache hints given by the files backend.
+#
+# A set of small "hot" files is read in a loop while big files are
+# downloaded and uploaded. The benchmark reports the read latency of the hot
+# files, and how much of each set stays in the page cache (measured with
+# mincore), with and without posix_fadvise hints.
+#
+# The effect is only visible when the big files don't fit in the page cache
+# alongside the hot set: use a --big-size close to the available memory.
+import argparse
+import asyncio
+import ctypes
+import dataclasses
+import mmap
+import os
+import statistics
+import tempfile
+import time
+
+from secsend_api.backend import RootID
+from secsend_api.backend_files import BackendFiles, advise
+from secsend_api.metadata import EncryptedFileMetadata
+
+METADATA = EncryptedFileMetadata(name=b"N", mime_type=b"M", iv=b"\x00"*12, chunk_size=b"C", key_sign=b"")
+CHUNK_SIZE = 10*1024*1024
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+_libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+
+def resident(paths):
+    # Number of pages of the files that are in the page cache, and total
+    # number of pages
+    res = total = 0
+    for path in paths:
+        size = os.path.getsize(path)
+        if size == 0:
+            continue
+        pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            addr = _libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+            vec = (ctypes.c_ubyte*pages)()
+            _libc.mincore(addr, size, vec)
+            _libc.munmap(addr, size)
+        finally:
+            os.close(fd)
+        res += sum(v & 1 for v in vec)
+        total += pages
+    return res, total
+
+def drop(paths):
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        os.fsync(fd)
+        advise(fd, 0, 0, "DONTNEED")
+        os.close(fd)
+
+async def upload(backend, size):
+    f = backend.create(RootID.generate().file_id(), dataclasses.replace(METADATA))
+    block = os.urandom(1024*1024)
+    async with f.stream_append() as s:
+        for _ in range(size // len(block)):
+            await s.write(block)
+    await asyncio.to_thread(f.set_as_complete)
+    return f
+
+async def download(f):
+    n = 0
+    async for data in f.stream_range(0, f.size, CHUNK_SIZE):
+        n += len(data)
+    return n
+
+async def read_hot(files, stop, latencies):
+    while not stop.is_set():
+        for f in files:
+            t = time.perf_counter()
+            async for _ in f.stream_range(0, f.size, CHUNK_SIZE):
+                pass
+            latencies.append(time.perf_counter() - t)
+            if stop.is_set():
+                break
+
+async def run(root, args, fadvise):
+    backend = BackendFiles(root, durability="finish", fadvise=fadvise, fadvise_drop_threshold=args.threshold, cache_size=0)
+    hot = []
+    for _ in range(args.hot_count):
+        hot.append(backend.create_complete(RootID.generate().file_id(), dataclasses.replace(METADATA), os.urandom(args.hot_size)))
+    hot_paths = [f.content_path for f in hot]
+    # Warm the hot set
+    for f in hot:
+        await download(f)
+
+    stop = asyncio.Event()
+    latencies = []
+    reader = asyncio.create_task(read_hot(hot, stop, latencies))
+    t = time.perf_counter()
+    big = await upload(backend, args.big_size)
+    for _ in range(args.downloads):
+        await download(big)
+    elapsed = time.perf_counter() - t
+    stop.set()
+    await reader
+
+    hot_res = resident(hot_paths)
+    big_res = resident([big.content_path])
+    drop(hot_paths + [big.content_path])
+    latencies.sort()
+    print("fadvise=%-5s big transfers: %6.0f MB/s  hot reads: p50 %7.3f ms, p99 %7.3f ms  resident: hot %5.1f%%, big %5.1f%%" % (
+        fadvise,
+        args.big_size * (1 + args.downloads) / elapsed / 1e6,
+        statistics.median(latencies)*1e3,
+        latencies[int(len(latencies)*0.99)]*1e3,
+        100*hot_res[0]/hot_res[1],
+        100*big_res[0]/big_res[1]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the page cache hints of the files backend on a mixed workload")
+    parser.add_argument("--root", type=str, help="Storage root (defaults to a temporary directory)")
+    parser.add_argument("--hot-count", type=int, default=1000, help="Number of small hot files")
+    parser.add_argument("--hot-size", type=int, default=64*1024, help="Size of hot files")
+    parser.add_argument("--big-size", type=int, default=1024*1024*1024, help="Size of the big uploaded and downloaded file")
+    parser.add_argument("--downloads", type=int, default=2, help="Number of downloads of the big file")
+    parser.add_argument("--threshold", type=int, default=64*1024*1024, help="Size above which files are dropped from the page cache")
+    args = parser.parse_args()
+
+    for fadvise in (False, True):
+        with tempfile.TemporaryDirectory(prefix="secsend_bench", dir=args.root) as root:
+            asyncio.run(run(root, args, fadvise))
+
+if __name__ == "__main__":
+    main()
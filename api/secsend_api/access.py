@@ -0,0 +1,50 @@
+import asyncio
+import os
+import time
+from pathlib import Path
+
+class AccessTracker:
+    # Keeps the last access time of files in memory, and writes them in
+    # batches as the access time (atime) of their content file, every
+    # "flush_interval" seconds. The atime can't be relied upon by itself:
+    # filesystems are often mounted with noatime or relatime, and files served
+    # from memory or by a reverse proxy are not read by secsend.
+    #
+    # The modification time of the file is kept as is, as it is used to
+    # validate caches.
+    def __init__(self, flush_interval: float = 60):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self.recorded = 0
+        self.flushed = 0
+
+    def record(self, content_path: Path):
+        self._pending[content_path] = time.time_ns()
+        self.recorded += 1
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if len(self._pending) == 0:
+            return
+        pending, self._pending = self._pending, {}
+        self.flushed += await asyncio.to_thread(_set_atimes, pending)
+
+    def stats(self):
+        return {'pending': len(self._pending), 'recorded': self.recorded, 'flushed': self.flushed}
+
+def _set_atimes(pending: dict) -> int:
+    ret = 0
+    for path, atime in pending.items():
+        try:
+            stats = os.stat(path)
+            if stats.st_atime_ns < atime:
+                os.utime(path, ns=(atime, stats.st_mtime_ns))
+                ret += 1
+        except FileNotFoundError:
+            # Deleted, or moved to another tier
+            pass
+    return ret
@@ -0,0 +1,42 @@
+import asyncio
+import secrets
+
+from sanic import Blueprint, response, exceptions
+
+# Administration endpoints. They are only available if an admin token has
+# been configured, and must be called with an "Authorization: Bearer <token>"
+# header.
+bp = Blueprint("admin", url_prefix="/admin", version=1)
+
+@bp.on_request
+async def check_token(request):
+    token = request.app.config.ADMIN_TOKEN
+    if not token:
+        raise exceptions.NotFound("admin endpoints are disabled")
+    auth = request.headers.get("authorization", "")
+    scheme, _, value = auth.partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(value.strip(), token):
+        raise exceptions.Unauthorized("invalid admin token", scheme="Bearer")
+
+@bp.get("/stats")
+async def stats(request):
+    ret = request.app.ctx.backend.stats()
+    ret['admission'] = {kind: a.stats() for kind, a in request.app.ctx.admission.items()}
+    ret['ratelimit'] = {kind: r.stats() for kind, r in request.app.ctx.ratelimit.items()}
+    ret['push_timeouts'] = request.app.ctx.push_timeouts.stats()
+    ret['scrubber'] = request.app.ctx.scrubber.stats()
+    ret['sweeper'] = request.app.ctx.sweeper.stats()
+    ret['tiering'] = request.app.ctx.tiering.stats()
+    ret['quotas'] = request.app.ctx.backend.quotas.stats() if request.app.ctx.backend.quotas is not None else None
+    ret['cluster'] = request.app.ctx.cluster.stats() if request.app.ctx.cluster is not None else None
+    return response.json(ret)
+
+@bp.get("/quotas")
+async def quotas(request):
+    # Storage used by each client, by decreasing number of bytes
+    quotas = request.app.ctx.backend.quotas
+    if quotas is None:
+        raise exceptions.NotFound("quotas are disabled")
+    usage = await asyncio.to_thread(quotas.all)
+    usage.sort(key=lambda u: u['bytes'], reverse=True)
+    return response.json(dict(quotas.stats(), clients=usage))
@@ -0,0 +1,88 @@
+import asyncio
+import collections
+
+from sanic import exceptions
+
+class ServerBusy(exceptions.ServiceUnavailable):
+    def __init__(self, retry_after: int):
+        super().__init__("too many concurrent requests, retry later", headers={"Retry-After": str(retry_after)})
+
+class AdmissionControl:
+    # Bounds the number of concurrent streams, globally and per client
+    # address (0 means no limit). Requests over the limits wait in a short
+    # queue for at most "queue_timeout" seconds. When the queue is full or
+    # the timeout expires, they are rejected with a 503 error, and clients are
+    # told to retry after "retry_after" seconds.
+    def __init__(self, limit: int = 0, per_client: int = 0, queue_size: int = 32, queue_timeout: float = 2, retry_after: int = 1):
+        self.limit = limit
+        self.per_client = per_client
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._cond = asyncio.Condition()
+        self._clients = collections.Counter()
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def _can_admit(self, client: str) -> bool:
+        if self.limit > 0 and self.active >= self.limit:
+            return False
+        if self.per_client > 0 and self._clients[client] >= self.per_client:
+            return False
+        return True
+
+    def slot(self, client: str):
+        return AdmissionSlot(self, client)
+
+    async def acquire(self, client: str):
+        if not self._can_admit(client):
+            if self.queued >= self.queue_size:
+                self.rejected += 1
+                raise ServerBusy(self.retry_after)
+            self.queued += 1
+            try:
+                async with self._cond:
+                    await asyncio.wait_for(self._cond.wait_for(lambda: self._can_admit(client)), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise ServerBusy(self.retry_after)
+            finally:
+                self.queued -= 1
+        self.active += 1
+        self._clients[client] += 1
+        self.admitted += 1
+
+    async def release(self, client: str):
+        self.active -= 1
+        self._clients[client] -= 1
+        if self._clients[client] == 0:
+            del self._clients[client]
+        async with self._cond:
+            self._cond.notify_all()
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'clients': len(self._clients),
+            'queued': self.queued,
+            'admitted': self.admitted,
+            'rejected': self.rejected
+        }
+
+class AdmissionSlot:
+    def __init__(self, admission: AdmissionControl, client: str):
+        self._admission = admission
+        self._client = client
+
+    async def __aenter__(self):
+        await self._admission.acquire(self._client)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._admission.release(self._client)
+
+def client_address(request) -> str:
+    # remote_addr is set when sanic is configured to trust a reverse proxy
+    return request.remote_addr or request.ip
@@ -1,22 +1,39 @@
+import asyncio
+import base64
+import binascii
+import contextlib
 import json
 import jsonschema
 import secrets
 import os
 import sys
-from pathlib import Path
+import time
 from aiofiles import os as async_os
 
 from sanic import Sanic, Blueprint, response, exceptions
 from sanic.compat import stat_async
 from sanic.handlers import ContentRangeHandler
-from sanic.exceptions import HeaderNotFound
-
+from sanic.exceptions import HeaderNotFound, RangeNotSatisfiable
+
+from . import http_cache
+from .admission import AdmissionControl, client_address
+from .ratelimit import RateLimiter
+from .stream_timeouts import StreamTimeouts
+from .webapp import setup_webapp
+from .scrubber import Scrubber
+from .sweeper import Sweeper
+from .tiering import Tiering
+from .fsck import fsck, format_report, POLICIES as FSCK_POLICIES
+from .admin import bp as admin_bp
+from .quota import Quotas
+from .cluster import Cluster, load_members, route_request, remote_owner, bp as cluster_bp
 from .cors import add_cors_headers
 from .options import setup_options
 from .backend import RootID, FileID, BaseID
 from .metadata import EncryptedFileMetadata, ALGOS
-from .backend import BackendErrorIDUnknown, BackendErrorIDExists, BackendErrorIDInvalid, BackendErrorIDWrongType, BackendError, BackendErrorFileLocked, BackendErrorIDUnavailable
+from .backend import BackendErrorIDUnknown, BackendErrorIDExists, BackendErrorIDInvalid, BackendErrorIDWrongType, BackendError, BackendErrorFileLocked, BackendErrorIDUnavailable, BackendErrorNoSpace, BackendErrorRootFull
 from .backend_files import BackendFiles
+from .durability import DURABILITY_NONE
 
 encr_metadata_json_schema = {
     'type': 'object',
@@ -38,19 +55,35 @@ encr_metadata_json_schema = {
     'required': ['name','mime_type','iv','chunk_size','version','timeout_s'],
 }
 
+OFFLOAD_HEADERS = {
+    'x-accel-redirect': 'X-Accel-Redirect',
+    'x-sendfile': 'X-Sendfile',
+}
+
+DOWNLOAD_CHUNK_SIZE = 10*1024*1024
+# AES-GCM chunks of clients can't be bigger than this (4-byte counter)
+CHUNK_SIZE_LIMIT = 2**32-1
+
 bp = Blueprint("api", version=1)
+bp.on_request(route_request)
 
 def get_backend(request):
     return request.app.ctx.backend
 
-@bp.post("/upload/new")
-async def upload_new(request):
+def id_generator(request):
+    # In cluster mode, IDs carry the node that stores them
+    cluster = request.app.ctx.cluster
+    return RootID.generate if cluster is None else cluster.generate
+
+def parse_metadata(request, metadata):
     try:
-        metadata = request.json
         jsonschema.validate(instance=metadata, schema=encr_metadata_json_schema)
         metadata['complete'] = False
         # Will be set once the upload is finished
         metadata['timeout_ts'] = 0
+        metadata['declared_size'] = None
+        metadata['digest'] = None
+        metadata['owner'] = None
         if metadata['timeout_s'] not in request.app.config.TIMEOUT_S_VALID:
             raise exceptions.InvalidUsage("invalid timeout value")
         metadata = EncryptedFileMetadata.from_jsonable(metadata)
@@ -58,41 +91,125 @@ async def upload_new(request):
         raise exceptions.InvalidUsage("invalid metadata: %s" % str(e))
     if len(metadata.iv) != 12:
         raise exceptions.InvalidUsage("IV length must be 12 bytes")
+    return metadata
 
-    for i in range(8):
+def create_new_id(create, generate=RootID.generate):
+    # A new ID is drawn if the generated one already exists, or if it would be
+    # stored on a full disk while other disks still have space left.
+    root_full = False
+    for i in range(32):
         try:
-            rid = RootID.generate()
-            fid = rid.file_id()
-            f = get_backend(request).create(fid, metadata)
-            break
+            rid = generate()
+            create(rid.file_id())
+            return rid
         except BackendErrorIDExists:
             continue
-    else:
-        raise BackendErrorIDUnavailable()
+        except BackendErrorRootFull:
+            root_full = True
+            continue
+    if root_full:
+        raise BackendErrorNoSpace()
+    raise BackendErrorIDUnavailable()
+
+@bp.post("/upload/new")
+async def upload_new(request):
+    metadata = request.json
+    # Optional size of the encrypted file. If provided, the upload is rejected
+    # right away if it can't be stored, and the needed space is reserved.
+    size = metadata.pop('size', None) if isinstance(metadata, dict) else None
+    metadata = parse_metadata(request, metadata)
+    if size is not None:
+        if not isinstance(size, int) or size < 0:
+            raise exceptions.InvalidUsage("invalid size")
+        filesize_limit = request.app.config.FILESIZE_LIMIT
+        if filesize_limit is not None and size >= filesize_limit:
+            raise exceptions.InvalidUsage("file limit exceeded")
+        metadata.declared_size = size
+    quotas = get_backend(request).quotas
+    if quotas is not None:
+        metadata.owner = quotas.owner(request)
+        await asyncio.to_thread(quotas.check_new, metadata.owner, size)
+    rid = await asyncio.to_thread(create_new_id, lambda fid: get_backend(request).create(fid, metadata), id_generator(request))
+    return response.json({"root_id": str(rid)})
+
+@bp.post("/upload/oneshot")
+async def upload_oneshot(request):
+    # Upload a small file with a single request. Metadata are sent in the
+    # X-Secsend-Metadata header (as in download responses), and the
+    # encrypted content as the body.
+    oneshot_limit = request.app.config.ONESHOT_SIZE_LIMIT
+    if oneshot_limit == 0:
+        raise exceptions.NotFound("one-shot uploads are disabled")
+    try:
+        metadata = json.loads(base64.b64decode(request.headers["x-secsend-metadata"]))
+    except KeyError:
+        raise exceptions.InvalidUsage("missing X-Secsend-Metadata header")
+    except (ValueError, binascii.Error):
+        raise exceptions.InvalidUsage("invalid X-Secsend-Metadata header")
+    metadata = parse_metadata(request, metadata)
+
+    content = request.body
+    if len(content) > oneshot_limit:
+        raise exceptions.InvalidUsage("file too big for a one-shot upload")
+    filesize_limit = request.app.config.FILESIZE_LIMIT
+    if filesize_limit is not None and len(content) >= filesize_limit:
+        raise exceptions.InvalidUsage("file limit exceeded")
+    quotas = get_backend(request).quotas
+    if quotas is not None:
+        metadata.owner = quotas.owner(request)
+        quotas.check_bytes(await asyncio.to_thread(quotas.usage, metadata.owner), len(content))
+
+    rid = await asyncio.to_thread(create_new_id, lambda fid: get_backend(request).create_complete(fid, metadata, content), id_generator(request))
     return response.json({"root_id": str(rid)})
 
+class FileLimitExceeded(Exception):
+    pass
+
 @bp.post("/upload/push/<id_>", stream=True)
 async def upload_push(request, id_):
     rid = RootID.from_str(id_)
     fid = rid.file_id()
     f = get_backend(request).open(fid)
     filesize_limit = request.app.config.FILESIZE_LIMIT
-    async with f.lock_write():
-        if filesize_limit is not None:
-            cursize = f.size
+    client = client_address(request)
+    async with request.app.ctx.admission['upload'].slot(client), f.lock_write():
+        cursize = f.size
         if f.metadata.complete:
             raise exceptions.InvalidUsage("ID '%s' is already complete" % id_)
-        async with f.stream_append() as s:
-            while True:
-                body = await request.stream.read()
-                if body is None:
-                    break
-                if filesize_limit is not None:
-                    cursize += len(body)
-                    if cursize >= filesize_limit:
-                        f.delete()
-                        raise exceptions.InvalidUsage("file limit exceeded")
-                await s.write(body)
+        declared_size = f.metadata.declared_size
+        # Storage used by the owner of the file before this push. It is only
+        # read once, so that concurrent pushes of a client can exceed its
+        # quota by up to their sizes (see quota.py).
+        quotas = get_backend(request).quotas
+        usage = None
+        if quotas is not None and quotas.max_bytes > 0 and f.metadata.owner is not None:
+            usage = await asyncio.to_thread(quotas.usage, f.metadata.owner)
+        start = cursize
+        reader = request.app.ctx.push_timeouts.reader(request.stream)
+        with request.app.ctx.ratelimit['upload'].stream(client) as shaper:
+            # Received data are kept if the client times out or exceeds its
+            # quota, so that the upload can be resumed
+            try:
+                async with f.stream_append() as s:
+                    while True:
+                        body = await reader.read()
+                        if body is None:
+                            break
+                        # Slowing down reads makes the client slow down
+                        await shaper.consume(len(body))
+                        cursize += len(body)
+                        if filesize_limit is not None and cursize >= filesize_limit:
+                            raise FileLimitExceeded()
+                        if declared_size is not None and cursize > declared_size:
+                            raise exceptions.InvalidUsage("declared size exceeded")
+                        if usage is not None:
+                            quotas.check_bytes(usage, cursize - start)
+                        await s.write(body)
+            except FileLimitExceeded:
+                # The file is deleted once the stream is closed, so that the
+                # data written so far are accounted for
+                await asyncio.to_thread(f.delete)
+                raise exceptions.InvalidUsage("file limit exceeded")
     return response.json({})
 
 @bp.post("/upload/finish/<id_>")
@@ -101,66 +218,243 @@ async def upload_finish(request, id_):
     fid = rid.file_id()
     f = get_backend(request).open(fid)
     async with f.lock_write():
-        f.set_as_complete()
+        declared_size = f.metadata.declared_size
+        if declared_size is not None and f.size != declared_size and not f.metadata.complete:
+            raise exceptions.InvalidUsage("upload isn't finished: %d bytes are missing" % (declared_size - f.size))
+        # This may fsync files, depending on the durability mode
+        await asyncio.to_thread(f.set_as_complete)
     return response.json({})
 
 @bp.get("/metadata/<id_>")
 async def metadata(request, id_):
     fid = FileID.from_str(id_)
     f = get_backend(request).open(fid)
-    f.check_validity()
-    ret = f.metadata.jsonable()
+    await asyncio.to_thread(f.check_validity)
+    if f.metadata.complete:
+        stats = await stat_async(f.content_path)
+        size = stats.st_size
+    else:
+        stats = None
+        size = f.size
+    headers = http_cache.cache_headers(fid, f.metadata, stats, request.app.config.CACHE_MAX_AGE)
+    if http_cache.not_modified(request, headers):
+        return response.empty(status=304, headers=headers)
     ret = {
-        'metadata': f.metadata.jsonable(),
-        'size': f.size
+        'metadata': f.metadata.public_jsonable(),
+        'size': size
     }
-    return response.json(ret)
+    return response.json(ret, headers=headers)
 
-@bp.get("/download/<id_>")
-async def download(request, id_):
+def metadata_header(metadata):
+    return base64.b64encode(json.dumps(metadata.public_jsonable()).encode("ascii")).decode("ascii")
+
+async def download_prepare(request, id_):
     fid = FileID.from_str(id_)
     f = get_backend(request).open(fid)
     if not f.metadata.complete:
         raise exceptions.InvalidUsage("ID '%s' isn't completely uploaded yet" % str(fid))
-    f.check_validity()
-
-    path = f.content_path
-
-    length = f.size
-    _range = None
+    await asyncio.to_thread(f.check_validity)
+
+    stats = await stat_async(f.content_path)
+    if request.method != "HEAD":
+        # Probing a file doesn't count as an access
+        f.touch()
+        request.app.ctx.tiering.promote(f)
+    headers = http_cache.cache_headers(fid, f.metadata, stats, request.app.config.CACHE_MAX_AGE)
+    headers["Content-Type"] = "application/octet-stream"
+    headers["Accept-Ranges"] = "bytes"
+    # Send the metadata along with the content, so that clients can start
+    # decrypting with a single request.
+    headers["X-Secsend-Metadata"] = metadata_header(f.metadata)
+    headers["X-Secsend-Size"] = stats.st_size
+    return f, stats, headers
+
+@bp.head("/download/<id_>")
+async def download_head(request, id_):
+    f, stats, headers = await download_prepare(request, id_)
+    if http_cache.not_modified(request, headers):
+        return response.empty(status=304, headers=headers)
+    headers["Content-Length"] = stats.st_size
+    return response.empty(status=200, headers=headers)
+
+def content_range(request, stats, headers):
+    # Returns None if the whole content must be sent, and raises
+    # RangeNotSatisfiable for invalid ranges. Ranges are ignored if the
+    # If-Range validator doesn't match the current content.
+    if not http_cache.if_range_matches(request, headers):
+        return None
     try:
-        stats = await stat_async(path)
-        _range = ContentRangeHandler(request, stats)
-        length -= _range.start
+        ret = ContentRangeHandler(request, stats)
     except HeaderNotFound:
-        pass
+        return None
+    # Sanic doesn't clamp ranges that go past the end of the content
+    ret.start = max(ret.start, 0)
+    ret.end = min(ret.end, ret.total - 1)
+    if ret.start > ret.end:
+        raise RangeNotSatisfiable("Invalid for Content Range parameters", ret)
+    ret.size = ret.end - ret.start + 1
+    ret.headers = {"Content-Range": "bytes %d-%d/%d" % (ret.start, ret.end, ret.total)}
+    return ret
 
-    return await response.file_stream(
-        path,
-        headers={
-            "Content-Type": "application/octet-stream",
-            "Content-Length": length
-        },
-        _range=_range,
-        chunk_size=1024*1024*10,
-    )
+@bp.get("/download/<id_>")
+async def download(request, id_):
+    f, stats, headers = await download_prepare(request, id_)
+    if http_cache.not_modified(request, headers):
+        return response.empty(status=304, headers=headers)
+
+    _range = content_range(request, stats, headers)
+    offload = request.app.config.DOWNLOAD_OFFLOAD
+    if offload is not None:
+        return download_offload(request, f, offload, headers)
+    length = _range.size if _range else stats.st_size
+
+    headers["Content-Length"] = length
+    status = 200
+    start = 0
+    if _range:
+        headers.update(_range.headers)
+        status = 206
+        start = _range.start
+
+    # The stream is sent from the handler, so that its slot is held until the
+    # whole content has been sent. Contents served from memory go through
+    # the same admission control and shaping as the others.
+    client = client_address(request)
+    async with request.app.ctx.admission['download'].slot(client):
+        with request.app.ctx.ratelimit['download'].stream(client) as shaper:
+            # Small popular files are served from memory
+            content = await f.cached_content(stats)
+            resp = await request.respond(status=status, headers=headers, content_type="application/octet-stream")
+            chunk_size = shaper.chunk_size or DOWNLOAD_CHUNK_SIZE
+            if content is not None:
+                chunks = memory_range(content, start, length, chunk_size)
+            else:
+                chunks = f.stream_range(start, length, chunk_size)
+            async with contextlib.aclosing(chunks) as chunks:
+                async for data in chunks:
+                    await shaper.consume(len(data))
+                    await resp.send(data)
+            await resp.eof()
+
+async def memory_range(content: bytes, start: int, length: int, chunk_size: int):
+    # Same as BackendFile.stream_range, for contents from the memory cache
+    end = start + length
+    for offset in range(start, end, chunk_size):
+        yield content[offset:min(offset + chunk_size, end)]
+
+def download_offload(request, f, offload, headers):
+    # Let the reverse proxy stream the file. Unsatisfiable ranges have
+    # already been rejected by content_range: the proxy processes the Range
+    # header by itself, so we only send back the internal redirection along
+    # with the validators, which it compares to If-Range.
+    if offload == "x-sendfile":
+        value = str(f.content_path.resolve())
+    else:
+        relpath = f.content_path.relative_to(f.root.path)
+        value = "%s/%s" % (request.app.ctx.offload_locations[f.root], relpath.as_posix())
+    headers[OFFLOAD_HEADERS[offload]] = value
+    return response.empty(status=200, headers=headers)
 
 @bp.post("/delete/<id_>")
 async def delete_id(request, id_):
     rid = RootID.from_str(id_)
     fid = rid.file_id()
     f = get_backend(request).open(fid)
-    f.check_validity()
-    f.delete()
+    # Deletions update quota counters, under a file lock
+    await asyncio.to_thread(f.check_validity)
+    await asyncio.to_thread(f.delete)
     return response.json({})
 
+batch_json_schema = {
+    'type': 'object',
+    'properties': {
+        'ids': {'type': 'array', 'items': {'type': 'string'}}
+    },
+    'required': ['ids'],
+}
+
+def backend_error_status(exc):
+    if isinstance(exc, BackendErrorIDUnknown):
+        return 404
+    if isinstance(exc, BackendErrorNoSpace):
+        return 507
+    if isinstance(exc, (BackendErrorIDExists, BackendErrorIDInvalid, BackendErrorIDWrongType, BackendErrorFileLocked)):
+        return 400
+    return 500
+
+async def batch_process(request, process):
+    ids = request.json
+    try:
+        jsonschema.validate(instance=ids, schema=batch_json_schema)
+    except jsonschema.exceptions.ValidationError as e:
+        raise exceptions.InvalidUsage("invalid batch request: %s" % str(e))
+    ids = ids['ids']
+    if len(ids) > request.app.config.BATCH_SIZE_LIMIT:
+        raise exceptions.InvalidUsage("too many IDs (maximum is %d)" % request.app.config.BATCH_SIZE_LIMIT)
+
+    # Backend accesses are blocking, so process the IDs concurrently in
+    # threads, with a bounded concurrency.
+    sem = asyncio.Semaphore(request.app.config.BATCH_CONCURRENCY)
+    # Legacy cluster nodes are probed for the whole batch at once
+    cluster = request.app.ctx.cluster
+    deadline = time.monotonic() + cluster.probe_timeout if cluster is not None else None
+    def process_local(id_):
+        ret = process(id_)
+        ret['status'] = 200
+        return ret
+    async def process_one(id_):
+        async with sem:
+            try:
+                # IDs stored by another node of the cluster are not
+                # processed, and their result tells where to send them
+                node = await remote_owner(request.app, id_, deadline)
+                if node is not None:
+                    ret = {'status': 307, 'location': node.url, 'message': "stored by cluster node %d" % node.id}
+                else:
+                    ret = await asyncio.to_thread(process_local, id_)
+            except BackendError as e:
+                ret = {'status': backend_error_status(e), 'message': str(e)}
+        ret['id'] = id_
+        return ret
+    results = await asyncio.gather(*(process_one(id_) for id_ in ids))
+    return response.json({'results': results})
+
+@bp.post("/batch/metadata")
+async def batch_metadata(request):
+    backend = get_backend(request)
+    def process(id_):
+        fid = BaseID.from_str(id_)
+        if isinstance(fid, RootID):
+            fid = fid.file_id()
+        f = backend.open(fid)
+        f.check_validity()
+        return {'metadata': f.metadata.public_jsonable(), 'size': f.size}
+    return await batch_process(request, process)
+
+@bp.post("/batch/delete")
+async def batch_delete(request):
+    backend = get_backend(request)
+    def process(id_):
+        f = backend.open(RootID.from_str(id_).file_id())
+        f.check_validity()
+        f.delete()
+        return {}
+    return await batch_process(request, process)
+
 @bp.get("/config")
 async def config(request):
     filesize_limit = request.app.config.FILESIZE_LIMIT
     filesize_limit = 0 if filesize_limit is None else filesize_limit
-    return response.json({'timeout_s_valid': request.app.config.TIMEOUT_S_VALID, 'filesize_limit': filesize_limit})
-
-def declare_app(enable_cors=False, backend_files_root=None, html_root=None, timeout_s_valid=None, filesize_limit=None):
+    return response.json({
+        'timeout_s_valid': request.app.config.TIMEOUT_S_VALID,
+        'filesize_limit': filesize_limit,
+        'oneshot_size_limit': request.app.config.ONESHOT_SIZE_LIMIT,
+        'batch_size_limit': request.app.config.BATCH_SIZE_LIMIT,
+        'chunk_size_preferred': request.app.config.CHUNK_SIZE_PREFERRED,
+        'chunk_size_max': request.app.config.CHUNK_SIZE_MAX
+    })
+
+def declare_app(enable_cors=False, backend_files_root=None, html_root=None, timeout_s_valid=None, filesize_limit=None, download_offload=None, download_offload_location=None, cache_max_age=None, oneshot_size_limit=None, batch_size_limit=None, durability=None):
     app = Sanic("secsend", env_prefix="SECSEND_")
     app.config.FALLBACK_ERROR_FORMAT = "json"
 
@@ -176,6 +470,42 @@ def declare_app(enable_cors=False, backend_files_root=None, html_root=None, time
             filesize_limit = None
     app.config.FILESIZE_LIMIT = filesize_limit
 
+    if download_offload is None:
+        download_offload = getattr(app.config, "DOWNLOAD_OFFLOAD", None)
+    if download_offload:
+        download_offload = download_offload.lower()
+        if download_offload not in OFFLOAD_HEADERS:
+            raise ValueError("invalid download_offload value: must be one of %s" % ",".join(OFFLOAD_HEADERS))
+        if download_offload_location is None:
+            download_offload_location = getattr(app.config, "DOWNLOAD_OFFLOAD_LOCATION", "/_secsend_files")
+        app.config.DOWNLOAD_OFFLOAD_LOCATION = download_offload_location
+    else:
+        download_offload = None
+    app.config.DOWNLOAD_OFFLOAD = download_offload
+
+    if cache_max_age is None:
+        cache_max_age = int(getattr(app.config, "CACHE_MAX_AGE", 0))
+    app.config.CACHE_MAX_AGE = cache_max_age
+
+    if oneshot_size_limit is None:
+        oneshot_size_limit = int(getattr(app.config, "ONESHOT_SIZE_LIMIT", 4*1024*1024))
+    app.config.ONESHOT_SIZE_LIMIT = oneshot_size_limit
+
+    if batch_size_limit is None:
+        batch_size_limit = int(getattr(app.config, "BATCH_SIZE_LIMIT", 1000))
+    app.config.BATCH_SIZE_LIMIT = batch_size_limit
+    app.config.BATCH_CONCURRENCY = int(getattr(app.config, "BATCH_CONCURRENCY", 16))
+
+    # Chunk sizes advertised to clients, which pick one for each upload. The
+    # server never sees them (they are encrypted in the metadata), but
+    # downloads decrypt a whole chunk in memory.
+    chunk_size_preferred = int(getattr(app.config, "CHUNK_SIZE_PREFERRED", 1024*1024))
+    chunk_size_max = int(getattr(app.config, "CHUNK_SIZE_MAX", 16*1024*1024))
+    if not 0 < chunk_size_preferred <= chunk_size_max <= CHUNK_SIZE_LIMIT:
+        raise ValueError("invalid chunk sizes: expected 0 < chunk_size_preferred <= chunk_size_max <= %d" % CHUNK_SIZE_LIMIT)
+    app.config.CHUNK_SIZE_PREFERRED = chunk_size_preferred
+    app.config.CHUNK_SIZE_MAX = chunk_size_max
+
     if enable_cors:
         # Add OPTIONS handlers to any route that is missing it
         app.register_listener(setup_options, "before_server_start")
@@ -208,9 +538,7 @@ def declare_app(enable_cors=False, backend_files_root=None, html_root=None, time
 
     if html_root is not None:
         app.ctx.html_root = html_root
-        app.static("/", html_root, name="webapp")
-        app.static("/", os.path.join(html_root, "index.html"), name="webapp_index")
-        app.static("/dl", os.path.join(html_root, "dl.html"), name="dl")
+        setup_webapp(app, html_root)
     else:
         print("Warning: no html_root has been specified, sanic won't serve the webapp", file=sys.stderr)
 
@@ -220,9 +548,129 @@ def declare_app(enable_cors=False, backend_files_root=None, html_root=None, time
     except AttributeError:
         backend_files_root = os.path.realpath("secsend_root")
         print("Warning: no backend_files_root has been specified, using the path '%s'" % backend_files_root, file=sys.stderr)
-    app.ctx.backend = BackendFiles(Path(backend_files_root))
+    if durability is None:
+        durability = str(getattr(app.config, "DURABILITY", DURABILITY_NONE)).lower()
+    app.ctx.backend = BackendFiles(
+        backend_files_root,
+        durability=durability,
+        write_buffer_size=int(getattr(app.config, "WRITE_BUFFER_SIZE", 4*1024*1024)),
+        sync_interval=float(getattr(app.config, "SYNC_INTERVAL", 0.05)),
+        lock_timeout=float(getattr(app.config, "LOCK_TIMEOUT", 0)),
+        delete_rate=int(getattr(app.config, "DELETE_RATE", 0)),
+        cache_size=int(getattr(app.config, "CACHE_SIZE", 64*1024*1024)),
+        cache_max_object_size=int(getattr(app.config, "CACHE_MAX_OBJECT_SIZE", 1024*1024)),
+        fadvise=bool(getattr(app.config, "FADVISE", True)),
+        fadvise_drop_threshold=int(getattr(app.config, "FADVISE_DROP_THRESHOLD", 64*1024*1024)),
+        cold_root=getattr(app.config, "COLD_ROOT", None))
+    quotas = Quotas(
+        app.ctx.backend.roots[0].path / ".quotas",
+        max_bytes=int(getattr(app.config, "QUOTA_BYTES", 0)),
+        max_uploads=int(getattr(app.config, "QUOTA_UPLOADS", 0)),
+        key=str(getattr(app.config, "QUOTA_KEY", "ip")))
+    if quotas.enabled:
+        app.ctx.backend.quotas = quotas
+
+    # Hot/cold tiering, if a cold root is configured
+    app.ctx.tiering = Tiering(
+        app.ctx.backend,
+        cold_age=float(getattr(app.config, "COLD_AGE", 30*24*3600)),
+        rate=int(getattr(app.config, "TIER_RATE", 0)),
+        interval=float(getattr(app.config, "TIER_INTERVAL", 3600)),
+        promote=bool(getattr(app.config, "TIER_PROMOTE", False)))
+
+    # Check the storage roots before workers are started
+    fsck_policy = getattr(app.config, "FSCK_ON_START", None)
+    if fsck_policy:
+        if fsck_policy not in FSCK_POLICIES:
+            raise ValueError("invalid fsck_on_start value '%s'" % fsck_policy)
+        fsck_jobs = int(getattr(app.config, "FSCK_JOBS", 16))
+
+        @app.main_process_start
+        async def run_fsck(app, _):
+            log = lambda line: print(line, file=sys.stderr)
+            counts = await asyncio.to_thread(fsck, app.ctx.backend, fsck_policy, fsck_jobs, log)
+            log("fsck: %s" % format_report(counts))
+
+    # Background integrity checks
+    app.ctx.scrubber = Scrubber(
+        app.ctx.backend,
+        rate=int(getattr(app.config, "SCRUB_RATE", 0)),
+        interval=float(getattr(app.config, "SCRUB_INTERVAL", 7*24*3600)))
+
+    # Background deletion of expired files and abandoned uploads
+    app.ctx.sweeper = Sweeper(
+        app.ctx.backend,
+        interval=float(getattr(app.config, "SWEEP_INTERVAL", 3600)),
+        abandoned_age=float(getattr(app.config, "ABANDONED_AGE", 0)))
+
+    if download_offload is not None:
+        # One internal location per storage root. If only one is given, each
+        # root is served from a numbered sub-location.
+        roots = app.ctx.backend.all_roots
+        locations = [l.strip().rstrip("/") for l in str(app.config.DOWNLOAD_OFFLOAD_LOCATION).split(",")]
+        if len(locations) == 1 and len(roots) > 1:
+            locations = ["%s/%d" % (locations[0], i) for i in range(len(roots))]
+        if len(locations) != len(roots):
+            raise ValueError("invalid download_offload_location value: expected one location per storage root")
+        app.ctx.offload_locations = dict(zip(roots, locations))
+
+    # Limits of concurrent upload and download streams
+    admission = {}
+    for kind in ("upload", "download"):
+        admission[kind] = AdmissionControl(
+            limit=int(getattr(app.config, "%s_LIMIT" % kind.upper(), 0)),
+            per_client=int(getattr(app.config, "%s_LIMIT_PER_CLIENT" % kind.upper(), 0)),
+            queue_size=int(getattr(app.config, "ADMISSION_QUEUE_SIZE", 32)),
+            queue_timeout=float(getattr(app.config, "ADMISSION_QUEUE_TIMEOUT", 2)),
+            retry_after=int(getattr(app.config, "ADMISSION_RETRY_AFTER", 1)))
+    app.ctx.admission = admission
+
+    # Bandwidth shaping
+    ratelimit = {}
+    for kind in ("upload", "download"):
+        ratelimit[kind] = RateLimiter(
+            rate=int(getattr(app.config, "%s_RATE" % kind.upper(), 0)),
+            per_client=int(getattr(app.config, "%s_RATE_PER_CLIENT" % kind.upper(), 0)),
+            global_rate=int(getattr(app.config, "%s_RATE_GLOBAL" % kind.upper(), 0)),
+            burst=int(getattr(app.config, "RATE_BURST", 1024*1024)))
+    app.ctx.ratelimit = ratelimit
+
+    app.ctx.push_timeouts = StreamTimeouts(
+        idle_timeout=float(getattr(app.config, "PUSH_IDLE_TIMEOUT", 60)),
+        min_rate=int(getattr(app.config, "PUSH_MIN_RATE", 0)),
+        window=float(getattr(app.config, "PUSH_MIN_RATE_WINDOW", 30)))
+
+    @app.after_server_start
+    async def start_reaper(app, _):
+        app.add_task(app.ctx.backend.reaper.run(), name="reaper")
+        app.add_task(app.ctx.scrubber.run(), name="scrubber")
+        app.add_task(app.ctx.sweeper.run(), name="sweeper")
+        app.add_task(app.ctx.backend.access.run(), name="access")
+        app.add_task(app.ctx.tiering.run(), name="tiering")
+        if app.ctx.cluster is not None:
+            app.add_task(app.ctx.cluster.run(), name="cluster")
+
+    # Cluster mode
+    app.ctx.cluster = None
+    cluster_members = getattr(app.config, "CLUSTER_MEMBERS", None)
+    if cluster_members:
+        try:
+            node_id = int(app.config.CLUSTER_NODE)
+        except AttributeError:
+            raise ValueError("cluster_node must be set in cluster mode")
+        app.ctx.cluster = Cluster(
+            load_members(cluster_members), node_id,
+            poll_interval=float(getattr(app.config, "CLUSTER_POLL_INTERVAL", 5)),
+            stale_after=float(getattr(app.config, "CLUSTER_STALE_AFTER", 30)),
+            probe_timeout=float(getattr(app.config, "CLUSTER_PROBE_TIMEOUT", 5)),
+            probe_cache_ttl=float(getattr(app.config, "CLUSTER_PROBE_CACHE_TTL", 60)))
+
+    admin_token = getattr(app.config, "ADMIN_TOKEN", None)
+    app.config.ADMIN_TOKEN = str(admin_token) if admin_token else None
 
     app.blueprint(bp)
+    app.blueprint(admin_bp)
+    app.blueprint(cluster_bp)
 
     @app.exception(BackendError)
     async def catch_id_unk(request, exc):
@@ -252,4 +700,8 @@ def declare_app(enable_cors=False, backend_files_root=None, html_root=None, time
     async def catch_file_locked(request, exc):
         raise exceptions.InvalidUsage(str(exc))
 
+    @app.exception(BackendErrorNoSpace)
+    async def catch_no_space(request, exc):
+        raise exceptions.SanicException(str(exc), status_code=507)
+
     return app
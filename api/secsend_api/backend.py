@@ -81,3 +81,12 @@ class BackendErrorFileLocked(BackendError):
 class BackendErrorIDUnavailable(BackendError):
     def __init__(self):
         super().__init__("unable to get an available ID")
+
+class BackendErrorNoSpace(BackendError):
+    def __init__(self):
+        super().__init__("not enough storage space")
+
+class BackendErrorRootFull(BackendErrorNoSpace):
+    # The storage root owning an ID is full, but others still have space
+    def __init__(self):
+        BackendError.__init__(self, "storage root full")
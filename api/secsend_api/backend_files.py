@@ -1,50 +1,184 @@
+import asyncio
 import io
 import json
+import ctypes
 import dataclasses
+import errno
+import secrets
 import tempfile
 import os
 import aiofiles
 from pathlib import Path
 from collections import namedtuple
 
-from .backend import FileID, BackendErrorIDExists, BackendErrorIDUnknown, BackendErrorInvalidMetadata, BackendErrorFileLocked
+from .backend import FileID, BackendErrorIDExists, BackendErrorIDUnknown, BackendErrorInvalidMetadata, BackendErrorNoSpace, BackendErrorRootFull
 from .metadata import EncryptedFileMetadata
 from .timeout import timeout_ts, ts_has_expired
+from .locks import LockManager
+from .reaper import Reaper
+from .content_cache import ContentCache
+from .access import AccessTracker
+from .digest import DigestStore, RollingDigest, UploadDigest
+from .roots import StorageRoot, parse_roots, owner
+from .durability import DURABILITY_NONE, DURABILITY_PERIODIC, DURABILITY_MODES, GroupCommit, fsync_path
 
 def id_to_dir(id_: FileID):
     hid = id_.bytes
     parts = (bytes(p).hex() for p in zip(*[iter(hid[:-2])]*2))
     return Path(*parts)
 
-class LockCtx:
-    def __init__(self, path: Path, id_: FileID):
+def _umask() -> int:
+    # The umask can only be read by setting it
+    mask = os.umask(0o022)
+    os.umask(mask)
+    return mask
+
+_FILE_MODE = 0o666 & ~_umask()
+
+def _mkstemp(path: Path):
+    # Temporary file next to path, to be renamed or linked in place. mkstemp
+    # makes it only readable by its owner: it gets the mode of the files
+    # created by open() instead, so that a reverse proxy running as another
+    # user can serve it (see SECSEND_DOWNLOAD_OFFLOAD).
+    tmp, tpath = tempfile.mkstemp(prefix=str(path))
+    os.fchmod(tmp, _FILE_MODE)
+    return tmp, tpath
+
+def _write_tmp(path: Path, write, mode: str, sync: bool = False) -> str:
+    tmp, tpath = _mkstemp(path)
+    with os.fdopen(tmp, mode) as ftmp:
+        write(ftmp)
+        if sync:
+            ftmp.flush()
+            os.fsync(ftmp.fileno())
+    return tpath
+
+_FALLOC_FL_KEEP_SIZE = 1
+_fallocate = None
+
+def preallocate(fd: int, size: int):
+    # Reserve disk blocks for a file that will grow up to size bytes. We can't
+    # use os.posix_fallocate here, as it changes the file size, which is used
+    # as the resume offset of uploads. Linux's fallocate with
+    # FALLOC_FL_KEEP_SIZE allocates blocks without changing it. This is a
+    # no-op on other systems.
+    global _fallocate
+    if _fallocate is None:
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            _fallocate = libc.fallocate64
+            _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        except (OSError, AttributeError):
+            _fallocate = False
+    if not _fallocate:
+        return
+    if _fallocate(fd, _FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        err = ctypes.get_errno()
+        if err in (errno.EOPNOTSUPP, errno.ENOSYS):
+            return
+        raise OSError(err, os.strerror(err))
+
+def advise(fd: int, offset: int, length: int, advice: str):
+    # Give the kernel a hint about how a file is going to be accessed, so
+    # that big transfers don't push hot data out of the page cache. This is a
+    # no-op on systems without posix_fadvise.
+    advice = getattr(os, "POSIX_FADV_%s" % advice, None)
+    if advice is None:
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+def open_noatime(path: Path) -> int:
+    # Opens a file for reading without updating its access time, which the
+    # tiering uses to find cold files. Background readers (scrubbing, copies
+    # between roots) must not make files look accessed. O_NOATIME is only
+    # allowed to the owner of the file, and doesn't exist outside Linux.
+    flags = os.O_RDONLY | os.O_CLOEXEC
+    noatime = getattr(os, "O_NOATIME", 0)
+    if noatime:
+        try:
+            return os.open(path, flags | noatime)
+        except PermissionError:
+            pass
+    return os.open(path, flags)
+
+class AppendStream:
+    # Coalesces the (usually small) fragments received from clients into
+    # large writes, aligned on buffer_size in the destination file. Written
+    # data are hashed on the way if a digest is given. on_close is called with
+    # the number of bytes that have been written once the file is closed.
+    def __init__(self, path: Path, buffer_size: int, group_commit=None, digest=None, on_close=None):
         self._path = path
+        self._buffer_size = buffer_size
+        self._group_commit = group_commit
+        self._digest = digest
+        self._on_close = on_close
         self._f = None
-        self._id = id_
+        self._buf = bytearray()
+        self._offset = 0
+        self._start = 0
 
     async def __aenter__(self):
-        try:
-            self._f = await aiofiles.open(str(self._path), "x")
-            return self
-        except FileExistsError:
-            raise BackendErrorFileLocked()
-        except FileNotFoundError:
-            # This can happen because one parent directory doesn't exist, as the file doesn't exist
-            raise BackendErrorIDUnknown(self._id)
+        self._f = await aiofiles.open(self._path, "ab")
+        self._offset = self._start = await self._f.tell()
+        if self._digest is not None:
+            try:
+                await self._digest.open(self._offset)
+            except:
+                await self._f.close()
+                raise
+        return self
 
     async def __aexit__(self, exc_type, exc, tb):
-        if not self._f is None:
+        try:
+            # Always keep what has been received, so that the upload can be
+            # resumed.
+            await self.flush()
+            if self._group_commit is not None and exc_type is None:
+                await self._group_commit.sync(self._f.fileno())
+        finally:
             await self._f.close()
-            self._path.unlink()
+            if self._digest is not None:
+                self._digest.close()
+            if self._on_close is not None:
+                await asyncio.to_thread(self._on_close, self._offset - self._start)
+
+    async def write(self, data):
+        self._buf += data
+        end = self._offset + len(self._buf)
+        n = end - end % self._buffer_size - self._offset
+        if n > 0:
+            await self._write(n)
+
+    async def flush(self):
+        if len(self._buf) > 0:
+            await self._write(len(self._buf))
+        await self._f.flush()
+
+    async def _write(self, n):
+        if n == len(self._buf):
+            data, self._buf = self._buf, bytearray()
+        else:
+            data = self._buf[:n]
+            del self._buf[:n]
+        await self._f.write(data)
+        self._offset += n
+        if self._digest is not None:
+            await self._digest.update(data)
 
 
 class BackendFile:
-    def __init__(self, load_metadata, content_path: Path, metadata_path: Path, id_: FileID):
+    def __init__(self, backend, root: StorageRoot, load_metadata, content_path: Path, metadata_path: Path, id_: FileID):
+        self._backend = backend
+        self._root = root
         self._metadata_path = metadata_path
         self._metadata = None
         self._load_metadata = load_metadata
         self._content_path = content_path
         self._id = id_
+        self._lock = None
 
     @property
     def metadata(self):
@@ -52,10 +186,22 @@ class BackendFile:
             self._metadata = self._load_metadata()
         return self._metadata
 
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def root(self):
+        return self._root
+
     @property
     def content_path(self):
         return self._content_path
 
+    @property
+    def metadata_path(self):
+        return self._metadata_path
+
     @property
     def size(self):
         try:
@@ -73,19 +219,54 @@ class BackendFile:
             self.delete()
             raise BackendErrorIDUnknown(self._id)
 
+    @property
+    def lock_path(self):
+        return self._metadata_path.with_suffix(".lock")
+
+    @property
+    def digest_path(self):
+        return self._metadata_path.with_suffix(".digest")
+
     def lock_write(self):
-        return LockCtx(self._metadata_path.with_suffix(".lock"), self._id)
+        self._lock = self._backend.locks.lock(self.lock_path, self._metadata_path, self._id)
+        return self._lock
 
     def set_as_complete(self):
         if self.metadata.complete:
             return
         self.metadata.complete = True
         self.metadata.timeout_ts = timeout_ts(self.metadata.timeout_s)
+        self.metadata.digest = self._backend.digests.take(self._id, self.digest_path, self._content_path, self.size).hexdigest()
+        self._backend.account(self.metadata.owner, uploads=-1)
 
-        tmp, tpath = tempfile.mkstemp(prefix=str(self._metadata_path))
-        with os.fdopen(tmp,"w") as ftmp:
-            json.dump(self.metadata.jsonable(), ftmp)
+        durable = self._backend.durability != DURABILITY_NONE
+        if durable and self._content_path.exists():
+            fsync_path(self._content_path)
+        tpath = _write_tmp(self._metadata_path, lambda f: json.dump(self.metadata.jsonable(), f), "w", sync=durable)
         os.rename(tpath, str(self._metadata_path))
+        if durable:
+            fsync_path(self._metadata_path.parent)
+        self.digest_path.unlink(missing_ok=True)
+        self._drop_cache()
+        # No more writes can happen
+        if self._lock is not None:
+            self._lock.remove = True
+
+    def _drop_cache(self):
+        # Uploaded data of big files are unlikely to be read again soon. Dirty
+        # pages can't be dropped, but the kernel starts writing them back.
+        backend = self._backend
+        if not backend.fadvise:
+            return
+        try:
+            fd = os.open(self._content_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            if os.fstat(fd).st_size >= backend.fadvise_drop_threshold:
+                advise(fd, 0, 0, "DONTNEED")
+        finally:
+            os.close(fd)
 
     @property
     def nchunks(self):
@@ -94,40 +275,289 @@ class BackendFile:
     def stream_read(self):
         return aiofiles.open(self._content_path, "rb")
 
+    async def stream_range(self, start: int, length: int, chunk_size: int):
+        # Yields the content of the file between start and start+length, by
+        # chunks. Pages of big files are dropped from the page cache once they
+        # have been sent.
+        backend = self._backend
+        fadvise = backend.fadvise
+        drop = fadvise and length >= backend.fadvise_drop_threshold
+        end = start + length
+        async with aiofiles.open(self._content_path, "rb") as f:
+            fd = f.fileno()
+            if fadvise:
+                await asyncio.to_thread(advise, fd, start, length, "SEQUENTIAL")
+                await asyncio.to_thread(advise, fd, start, min(chunk_size, length), "WILLNEED")
+            await f.seek(start)
+            offset = start
+            try:
+                while offset < end:
+                    data = await f.read(min(chunk_size, end - offset))
+                    if len(data) == 0:
+                        break
+                    if fadvise and offset + len(data) < end:
+                        # Read the next chunk while this one is being sent
+                        await asyncio.to_thread(advise, fd, offset + len(data), min(chunk_size, end - offset - len(data)), "WILLNEED")
+                    yield data
+                    if drop:
+                        await asyncio.to_thread(advise, fd, offset, len(data), "DONTNEED")
+                    offset += len(data)
+            finally:
+                if drop:
+                    # Also drop what has been read ahead, if the client went
+                    # away
+                    await asyncio.to_thread(advise, fd, start, length, "DONTNEED")
+
+    async def cached_content(self, stats: os.stat_result):
+        # Content of the file from the memory cache, or None if the file is
+        # too big to be cached
+        return await self._backend.cache.get(self._id, self._content_path, stats)
+
     def stream_append(self):
-        return aiofiles.open(self._content_path, "ab")
+        backend = self._backend
+        group_commit = backend.group_commit if backend.durability == DURABILITY_PERIODIC else None
+        digest = UploadDigest(backend.digests, self._id, self.digest_path, self._content_path)
+        owner = self.metadata.owner
+        return AppendStream(self._content_path, backend.write_buffer_size, group_commit, digest, lambda n: backend.account(owner, nbytes=n))
+
+    @property
+    def is_cold(self):
+        return self._root is self._backend.cold_root
+
+    def touch(self):
+        # Records an access, for the tiering of files
+        self._backend.access.record(self._content_path)
+
+    def _usage(self):
+        # What the file counts against the quotas of its owner, as
+        # (owner, complete, size), or None. It must be read before the file
+        # is removed from the store.
+        if self._backend.quotas is None:
+            return None
+        try:
+            metadata = self.metadata
+        except BackendErrorInvalidMetadata:
+            return None
+        if metadata.owner is None:
+            return None
+        return metadata.owner, metadata.complete, self.size
+
+    def _release(self, usage):
+        if usage is not None:
+            owner, complete, size = usage
+            self._backend.account(owner, nbytes=-size, uploads=0 if complete else -1)
 
     def delete(self):
+        backend = self._backend
+        usage = self._usage()
+        backend.cache.invalidate(self._id)
+        backend.digests.discard(self._id)
+        backend.trash(self._root, self._id, self._metadata_path, self._content_path)
+        self.lock_path.unlink(missing_ok=True)
+        self.digest_path.unlink(missing_ok=True)
+        self._release(usage)
+
+    def unlink_moved(self):
+        # Removes the file from its root once it has been copied to another
+        # one. The files are unlinked right away rather than trashed:
+        # downloads still reading the old copy keep it alive until they are
+        # done. Raises BackendErrorIDUnknown if the file has been deleted in
+        # the meantime.
+        backend = self._backend
+        backend.cache.invalidate(self._id)
+        backend.digests.discard(self._id)
         try:
-            self._metadata_path.unlink()
-            self._content_path.unlink()
+            os.unlink(self._metadata_path)
         except FileNotFoundError:
             raise BackendErrorIDUnknown(self._id)
+        self._content_path.unlink(missing_ok=True)
+        self.lock_path.unlink(missing_ok=True)
+        self.digest_path.unlink(missing_ok=True)
 
+    def quarantine(self) -> Path:
+        # Quarantined files leave the store: they don't count against the
+        # quotas of their owner anymore
+        usage = self._usage()
+        self._backend.cache.invalidate(self._id)
+        ret = self._backend.quarantine(self._root, self._id, self._metadata_path, self._content_path)
+        self._release(usage)
+        return ret
 
-FilePaths = namedtuple('FilePaths', ['metadata', 'content'])
+
+FilePaths = namedtuple('FilePaths', ['root', 'metadata', 'content'])
 
 class BackendFiles:
-    def __init__(self, root: Path):
-        self.root = root
+    def __init__(self, roots, durability: str = DURABILITY_NONE, write_buffer_size: int = 4*1024*1024, sync_interval: float = 0.05, lock_timeout: float = 0, delete_rate: int = 0, cache_size: int = 64*1024*1024, cache_max_object_size: int = 1024*1024, fadvise: bool = True, fadvise_drop_threshold: int = 64*1024*1024, cold_root=None, quotas=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError("invalid durability mode '%s'" % durability)
+        # Files are spread across several roots (usually one per disk). The
+        # root of a file only depends on its ID, so that lookups never need to
+        # probe every root.
+        self.roots = parse_roots(roots)
+        # Optional slower root, where complete files that haven't been
+        # accessed for a while are moved (see tiering.py). Files are looked up
+        # there when they aren't in their hot root.
+        self.cold_root = None
+        if cold_root is not None:
+            self.cold_root = cold_root if isinstance(cold_root, StorageRoot) else StorageRoot(cold_root)
+        self.access = AccessTracker()
+        self.durability = durability
+        self.write_buffer_size = write_buffer_size
+        self.group_commit = GroupCommit(sync_interval)
+        self.locks = LockManager(lock_timeout)
+        self.reaper = Reaper(delete_rate)
+        self.cache = ContentCache(cache_size, cache_max_object_size)
+        self.digests = DigestStore()
+        self.fadvise = fadvise
+        self.fadvise_drop_threshold = fadvise_drop_threshold
+        # Storage usage of each client, if quotas are enabled
+        self.quotas = quotas
+        for root in self.all_roots:
+            self.reaper.scan(root.trash_dir)
+
+    @property
+    def all_roots(self):
+        return self.roots + ([self.cold_root] if self.cold_root is not None else [])
+
+    def account(self, owner, nbytes: int = 0, uploads: int = 0):
+        if self.quotas is not None:
+            self.quotas.add(owner, nbytes, uploads)
 
     def create(self, id_: FileID, metadata: EncryptedFileMetadata) -> BackendFile:
-        paths = self._id_to_paths(id_, create_dir=True)
+        size = metadata.declared_size
+        paths = self._id_to_paths(id_)
+        if size is not None:
+            self._check_space(paths.root, size)
+        self._check_cold(id_)
+        paths.metadata.parent.mkdir(parents=True, exist_ok=True)
         fd_metadata = None
         try:
             fd_metadata = open(paths.metadata, "x")
         except FileExistsError:
             raise BackendErrorIDExists(id_)
 
-        ret = BackendFile(lambda: metadata, paths.content, paths.metadata, id_)
+        ret = BackendFile(self, paths.root, lambda: metadata, paths.content, paths.metadata, id_)
         json.dump(metadata.jsonable(), fd_metadata)
         fd_metadata.close()
+        self.account(metadata.owner, uploads=1)
+
+        if size is not None and size > 0:
+            try:
+                with open(paths.content, "xb") as f:
+                    preallocate(f.fileno(), size)
+            except OSError as e:
+                ret.delete()
+                if e.errno == errno.ENOSPC:
+                    raise BackendErrorNoSpace()
+                raise
 
         return ret
 
+    def _check_space(self, root: StorageRoot, size: int):
+        if size <= root.free_space():
+            return
+        if any(size <= r.free_space() for r in self.roots if r is not root):
+            # Another ID, owned by another root, can be used
+            raise BackendErrorRootFull()
+        raise BackendErrorNoSpace()
+
+    def _check_cold(self, id_: FileID):
+        if self.cold_root is not None and self.cold_paths(id_).metadata.exists():
+            raise BackendErrorIDExists(id_)
+
+    def trash(self, root: StorageRoot, id_: FileID, metadata_path: Path, content_path: Path):
+        # Renaming the metadata file makes the ID disappear atomically. The
+        # actual removal is done in the background by the reaper. Each root
+        # has its own trash, so that renames never cross filesystems.
+        root.trash_dir.mkdir(exist_ok=True)
+        prefix = "%s.%s" % (id_.bytes.hex(), secrets.token_hex(4))
+        dest = root.trash_dir / (prefix + ".metadata")
+        try:
+            os.rename(metadata_path, dest)
+        except FileNotFoundError:
+            raise BackendErrorIDUnknown(id_)
+        self.reaper.push(dest)
+        dest = root.trash_dir / (prefix + ".content")
+        try:
+            os.rename(content_path, dest)
+            self.reaper.push(dest)
+        except FileNotFoundError:
+            # Nothing has been uploaded yet
+            pass
+
+    def quarantine(self, root: StorageRoot, id_: FileID, metadata_path: Path, content_path: Path) -> Path:
+        # Corrupted files are moved out of the way, but kept for inspection.
+        # As with deletions, moving the metadata first makes the ID
+        # disappear.
+        qdir = root.path / ".quarantine"
+        qdir.mkdir(exist_ok=True)
+        dest = qdir / ("%s.%s" % (id_.bytes.hex(), secrets.token_hex(4)))
+        try:
+            os.rename(metadata_path, qdir / (dest.name + ".metadata"))
+        except FileNotFoundError:
+            raise BackendErrorIDUnknown(id_)
+        try:
+            os.rename(content_path, qdir / (dest.name + ".content"))
+        except FileNotFoundError:
+            pass
+        return dest
+
+    def stats(self):
+        return {
+            'deletion': self.reaper.stats(),
+            'locks': self.locks.stats(),
+            'durability': self.group_commit.stats(),
+            'cache': self.cache.stats(),
+            'roots': [{'path': str(r.path), 'weight': r.weight, 'free': r.free_space()} for r in self.roots],
+            'cold_root': {'path': str(self.cold_root.path), 'free': self.cold_root.free_space()} if self.cold_root is not None else None,
+            'access': self.access.stats()
+        }
+
+    def free_space(self) -> int:
+        return sum(r.free_space() for r in self.roots)
+
+    def create_complete(self, id_: FileID, metadata: EncryptedFileMetadata, content: bytes) -> BackendFile:
+        paths = self._id_to_paths(id_)
+        self._check_space(paths.root, len(content))
+        self._check_cold(id_)
+        paths.metadata.parent.mkdir(parents=True, exist_ok=True)
+        metadata.complete = True
+        metadata.timeout_ts = timeout_ts(metadata.timeout_s)
+        metadata.digest = RollingDigest().update(content).hexdigest()
+
+        # Write both files under temporary names, and then link them in
+        # place. Linking fails if the destination exists, so that an existing
+        # ID is never overwritten. The content is linked first, so that the
+        # ID only appears once it is complete.
+        durable = self.durability != DURABILITY_NONE
+        tmp_content = _write_tmp(paths.content, lambda f: f.write(content), "wb", sync=durable)
+        tmp_metadata = _write_tmp(paths.metadata, lambda f: json.dump(metadata.jsonable(), f), "w", sync=durable)
+        try:
+            try:
+                os.link(tmp_content, paths.content)
+            except FileExistsError:
+                raise BackendErrorIDExists(id_)
+            try:
+                os.link(tmp_metadata, paths.metadata)
+            except FileExistsError:
+                paths.content.unlink()
+                raise BackendErrorIDExists(id_)
+        finally:
+            os.unlink(tmp_content)
+            os.unlink(tmp_metadata)
+        if durable:
+            fsync_path(paths.metadata.parent)
+        self.account(metadata.owner, nbytes=len(content))
+
+        return BackendFile(self, paths.root, lambda: metadata, paths.content, paths.metadata, id_)
+
     def open(self, id_: FileID) -> BackendFile:
-        paths = self._id_to_paths(id_, create_dir=False)
-        return BackendFile(lambda: self.load_metadata(id_, paths.metadata), paths.content, paths.metadata, id_)
+        paths = self._id_to_paths(id_)
+        if self.cold_root is not None and not paths.metadata.exists():
+            cold = self.cold_paths(id_)
+            if cold.metadata.exists():
+                paths = cold
+        return BackendFile(self, paths.root, lambda: self.load_metadata(id_, paths.metadata), paths.content, paths.metadata, id_)
 
     def load_metadata(self, id_: FileID, path: str) -> EncryptedFileMetadata:
         try:
@@ -138,10 +568,18 @@ class BackendFiles:
         except json.JSONDecodeError:
             raise BackendErrorInvalidMetadata(id_)
 
-    def _id_to_paths(self, id_: FileID, create_dir: bool) -> FilePaths:
-        fdir = self.root / id_to_dir(id_)
-        if create_dir:
-            fdir.mkdir(parents=True,exist_ok=True)
+    def root_of(self, id_: FileID) -> StorageRoot:
+        return owner(self.roots, id_)
+
+    def _id_to_paths(self, id_: FileID) -> FilePaths:
+        return self._paths_in(self.root_of(id_), id_)
+
+    def cold_paths(self, id_: FileID) -> FilePaths:
+        return self._paths_in(self.cold_root, id_)
+
+    def _paths_in(self, root: StorageRoot, id_: FileID) -> FilePaths:
+        fdir = root.path / id_to_dir(id_)
         return FilePaths(
+                root=root,
                 metadata=fdir / ("%s.metadata" % id_.bytes.hex()),
                 content=fdir /  ("%s.content" % id_.bytes.hex()))
@@ -0,0 +1,259 @@
+import asyncio
+import collections
+import json
+import time
+import urllib.request
+from dataclasses import dataclass
+from typing import List, Optional
+
+from sanic import Blueprint, response, exceptions
+
+from .backend import BaseID, RootID, FileID, BackendError
+
+# Cluster mode: several secsend nodes, each one with its own storage, behind
+# the same public URL. Every file ID carries the ID of the node that stores
+# it, as the first byte of its FileID (so that it can be routed with both
+# its RootID and its FileID), and requests for IDs of other nodes are
+# redirected to them (307). New uploads are redirected to the least loaded
+# node.
+#
+# Nodes are listed in a static membership file, which must be the same on
+# every node:
+#
+#   {"nodes": [{"id": 0, "url": "https://node0.example.com"}, ...]}
+#
+# Node IDs are between 0 and 255, and must never be reused for another
+# storage. IDs that are stored locally are always served, so that files
+# created before cluster mode was enabled remain available. The first byte of
+# their FileID can name any node though: nodes that stored files before
+# cluster mode was enabled are flagged with "legacy": true, and IDs of this
+# node that it doesn't store are looked up on them (and redirected to the one
+# that has it), on /v1/cluster/stored. Legacy nodes are probed concurrently,
+# for at most "probe_timeout" seconds per request, and IDs that none of them
+# stores are remembered for "probe_cache_ttl" seconds.
+
+@dataclass
+class Node:
+    id: int
+    url: str
+    legacy: bool = False
+
+def load_members(path) -> List[Node]:
+    with open(path, "r") as f:
+        data = json.load(f)
+    nodes = []
+    for n in data['nodes']:
+        node = Node(int(n['id']), str(n['url']).rstrip("/"), bool(n.get('legacy', False)))
+        if not 0 <= node.id <= 255:
+            raise ValueError("invalid cluster node ID %d: must be between 0 and 255" % node.id)
+        if any(o.id == node.id for o in nodes):
+            raise ValueError("duplicate cluster node ID %d" % node.id)
+        nodes.append(node)
+    return nodes
+
+def node_hint(id_: BaseID) -> int:
+    if isinstance(id_, RootID):
+        id_ = id_.file_id()
+    return id_.bytes[0]
+
+class Cluster:
+    # The load of the other nodes is polled every "poll_interval" seconds.
+    # Nodes that haven't answered for "stale_after" seconds don't receive new
+    # uploads.
+    MAX_TRIES = 4096
+    PROBE_CACHE_SIZE = 65536
+
+    def __init__(self, nodes: List[Node], node_id: int, poll_interval: float = 5, stale_after: float = 30, probe_timeout: float = 5, probe_cache_ttl: float = 60):
+        self.nodes = {n.id: n for n in nodes}
+        if node_id not in self.nodes:
+            raise ValueError("cluster node ID %d is not in the membership file" % node_id)
+        self.node = self.nodes[node_id]
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.probe_timeout = probe_timeout
+        self.probe_cache_ttl = probe_cache_ttl
+        # Node ID => (time, status)
+        self._status = {}
+        # FileID bytes => expiry time, of IDs that no legacy node stores
+        self._unknown = collections.OrderedDict()
+        self.redirected = 0
+        self.poll_errors = 0
+        self.probe_errors = 0
+        self.probe_cached = 0
+        self.probe_skipped = 0
+
+    def owner(self, id_: BaseID) -> Node:
+        return self.nodes.get(node_hint(id_), self.node)
+
+    async def find_legacy(self, fid: FileID, deadline: Optional[float] = None) -> Optional[Node]:
+        # Legacy node that stores fid, if any. Probes stop at "deadline" (in
+        # time.monotonic() time), which defaults to "probe_timeout" seconds
+        # from now.
+        nodes = [n for n in self.nodes.values() if n.legacy and n is not self.node]
+        if len(nodes) == 0:
+            return None
+        now = time.monotonic()
+        expires = self._unknown.get(fid.bytes)
+        if expires is not None:
+            if expires > now:
+                self.probe_cached += 1
+                return None
+            del self._unknown[fid.bytes]
+        if deadline is None:
+            deadline = now + self.probe_timeout
+        timeout = deadline - now
+        if timeout <= 0:
+            self.probe_skipped += 1
+            return None
+        try:
+            found = await asyncio.wait_for(asyncio.gather(*(self._probe(n, fid, timeout) for n in nodes)), timeout)
+        except asyncio.TimeoutError:
+            self.probe_errors += 1
+            return None
+        for node, stored in zip(nodes, found):
+            if stored:
+                return node
+        # Nodes that couldn't be asked might store it
+        if all(stored is not None for stored in found):
+            self._unknown[fid.bytes] = now + self.probe_cache_ttl
+            while len(self._unknown) > self.PROBE_CACHE_SIZE:
+                self._unknown.popitem(last=False)
+        return None
+
+    async def _probe(self, node: Node, fid: FileID, timeout: float) -> Optional[bool]:
+        # None if the node couldn't be asked
+        try:
+            return await asyncio.to_thread(_fetch_stored, node.url, fid, timeout)
+        except (OSError, ValueError, KeyError):
+            self.probe_errors += 1
+            return None
+
+    def generate(self) -> RootID:
+        # RootIDs are drawn until the FileID they map to carries this node's
+        # ID, which takes 256 tries on average
+        for i in range(self.MAX_TRIES):
+            rid = RootID.generate()
+            if node_hint(rid) == self.node.id:
+                return rid
+        raise RuntimeError("unable to generate an ID for cluster node %d" % self.node.id)
+
+    def pick(self, local_status: dict) -> Node:
+        # Node with the fewest uploads in progress, and then with the most free
+        # space
+        now = time.monotonic()
+        candidates = [(self.node, local_status)]
+        for node_id, (ts, status) in self._status.items():
+            if now - ts <= self.stale_after:
+                candidates.append((self.nodes[node_id], status))
+        node, _ = min(candidates, key=lambda c: (c[1]['uploads'], -c[1]['free']))
+        return node
+
+    def update(self, node_id: int, status: dict):
+        self._status[node_id] = (time.monotonic(), status)
+
+    async def run(self):
+        while True:
+            await asyncio.gather(*(self.poll(n) for n in self.nodes.values() if n is not self.node))
+            await asyncio.sleep(self.poll_interval)
+
+    async def poll(self, node: Node):
+        try:
+            status = await asyncio.to_thread(_fetch_status, node.url, self.poll_interval)
+            self.update(node.id, status)
+        except (OSError, ValueError, KeyError):
+            self.poll_errors += 1
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'node': self.node.id,
+            'nodes': {str(node_id): dict(status, age=now-ts) for node_id, (ts, status) in self._status.items()},
+            'redirected': self.redirected,
+            'poll_errors': self.poll_errors,
+            'probe_errors': self.probe_errors,
+            'probe_cached': self.probe_cached,
+            'probe_skipped': self.probe_skipped,
+            'probe_cache': len(self._unknown)
+        }
+
+def _fetch_status(url: str, timeout: float) -> dict:
+    with urllib.request.urlopen("%s/v1/cluster/status" % url, timeout=timeout) as r:
+        data = json.load(r)
+    return {'uploads': int(data['uploads']), 'free': int(data['free'])}
+
+def _fetch_stored(url: str, fid: FileID, timeout: float) -> bool:
+    with urllib.request.urlopen("%s/v1/cluster/stored/%s" % (url, fid), timeout=timeout) as r:
+        return bool(json.load(r)['stored'])
+
+def local_status(app) -> dict:
+    return {'uploads': app.ctx.admission['upload'].active, 'free': app.ctx.backend.free_space()}
+
+def redirect(request, node: Node, query_string: Optional[str] = None):
+    request.app.ctx.cluster.redirected += 1
+    url = node.url + request.path
+    query_string = request.query_string if query_string is None else query_string
+    if query_string:
+        url += "?" + query_string
+    return response.redirect(url, status=307)
+
+async def route_request(request):
+    # on_request middleware of the API blueprint
+    cluster = request.app.ctx.cluster
+    if cluster is None:
+        return None
+    if request.route is not None and request.route.name.endswith(".upload_new"):
+        # Uploads redirected by another node are not redirected again
+        if request.args.get("node") == str(cluster.node.id):
+            return None
+        node = cluster.pick(local_status(request.app))
+        if node is cluster.node:
+            return None
+        return redirect(request, node, "node=%d" % node.id)
+    id_ = request.match_info.get("id_")
+    if id_ is None:
+        return None
+    node = await remote_owner(request.app, id_)
+    if node is None:
+        return None
+    return redirect(request, node)
+
+async def remote_owner(app, id_: str, deadline: Optional[float] = None) -> Optional[Node]:
+    # Node the ID must be redirected to, or None if it is served by this one.
+    # Legacy nodes are probed until "deadline" (see Cluster.find_legacy).
+    cluster = app.ctx.cluster
+    if cluster is None:
+        return None
+    try:
+        id_ = BaseID.from_str(id_)
+    except (BackendError, IndexError):
+        # Rejected by the handler
+        return None
+    fid = id_.file_id() if isinstance(id_, RootID) else id_
+    if await asyncio.to_thread(lambda: app.ctx.backend.open(fid).metadata_path.exists()):
+        return None
+    node = cluster.owner(id_)
+    if node is not cluster.node:
+        return node
+    return await cluster.find_legacy(fid, deadline)
+
+bp = Blueprint("cluster", url_prefix="/cluster", version=1)
+
+@bp.get("/status")
+async def status(request):
+    cluster = request.app.ctx.cluster
+    if cluster is None:
+        raise exceptions.NotFound("cluster mode is disabled")
+    return response.json(dict(local_status(request.app), node=cluster.node.id))
+
+@bp.get("/stored/<file_id>")
+async def stored(request, file_id):
+    # Whether a file is stored by this node, for the lookup of legacy IDs.
+    # Unlike the API, this is never redirected.
+    if request.app.ctx.cluster is None:
+        raise exceptions.NotFound("cluster mode is disabled")
+    try:
+        fid = FileID.from_str(file_id)
+    except (BackendError, IndexError):
+        raise exceptions.InvalidUsage("invalid file ID")
+    path = request.app.ctx.backend.open(fid).metadata_path
+    return response.json({'stored': await asyncio.to_thread(path.exists)})
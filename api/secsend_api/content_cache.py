@@ -0,0 +1,114 @@
+import asyncio
+import collections
+import os
+import threading
+from typing import Optional
+
+from .backend import FileID
+
+class ContentCache:
+    # Keeps the content of small complete files in memory, so that popular
+    # files are not read from disk for every download. Entries are evicted in
+    # LRU order once "max_size" bytes are used. Only files up to
+    # "max_object_size" bytes are cached.
+    #
+    # Each entry is tied to the stat of the content file it has been read
+    # from. Callers still load metadata and stat the file for every request,
+    # so that a deleted or expired file is never served from the cache, even
+    # if it has been deleted by another worker.
+    def __init__(self, max_size: int = 0, max_object_size: int = 1024*1024):
+        self.max_size = max_size
+        self.max_object_size = max_object_size
+        self._entries = collections.OrderedDict()
+        # Files are deleted (and invalidated) from worker threads, while the
+        # event loop looks entries up and adds them
+        self._lock = threading.Lock()
+        self._loading = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    @staticmethod
+    def _validator(stats: os.stat_result):
+        return (stats.st_ino, stats.st_size, stats.st_mtime_ns)
+
+    def cacheable(self, stats: os.stat_result) -> bool:
+        return self.enabled and stats.st_size <= min(self.max_object_size, self.max_size)
+
+    async def get(self, id_: FileID, path, stats: os.stat_result) -> Optional[bytes]:
+        # Returns the content of the file, or None if it can't be cached
+        if not self.cacheable(stats):
+            return None
+        key = id_.bytes
+        validator = self._validator(stats)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == validator:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        self.misses += 1
+        # Concurrent misses on the same file only read it once. The read runs
+        # in its own task, so that it isn't interrupted if the client that
+        # started it goes away.
+        loading = self._loading.get(key)
+        if loading is None or loading[0] != validator:
+            task = asyncio.get_running_loop().create_task(self._load(key, validator, path, stats.st_size))
+            loading = self._loading[key] = (validator, task)
+        return await asyncio.shield(loading[1])
+
+    async def _load(self, key: bytes, validator, path, size: int) -> Optional[bytes]:
+        try:
+            data = await asyncio.to_thread(_read, path, size)
+        finally:
+            if self._loading.get(key, (None, None))[1] is asyncio.current_task():
+                del self._loading[key]
+        if len(data) != size:
+            # The file has changed since it has been stat'ed
+            return None
+        self._put(key, validator, data)
+        return data
+
+    def _put(self, key: bytes, validator, data: bytes):
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (validator, data)
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, (_, old) = self._entries.popitem(last=False)
+                self.size -= len(old)
+                self.evictions += 1
+
+    def _remove(self, key: bytes):
+        # Called with the lock held
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def invalidate(self, id_: FileID):
+        with self._lock:
+            self._remove(id_.bytes)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        with self._lock:
+            entries, size = len(self._entries), self.size
+        return {
+            'entries': entries,
+            'size': size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / requests if requests > 0 else 0,
+            'evictions': self.evictions
+        }
+
+def _read(path, size: int) -> bytes:
+    with open(path, "rb") as f:
+        return f.read(size + 1)
@@ -13,6 +13,9 @@ def _add_cors_headers(response, methods: Iterable[str]) -> None:
             "origin, content-type, accept, "
             "authorization, x-xsrf-token, x-request-id"
         ),
+        "Access-Control-Expose-Headers": (
+            "content-range, etag, x-secsend-metadata, x-secsend-size"
+        ),
     }
     response.headers.update(headers)
 
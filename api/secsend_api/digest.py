@@ -0,0 +1,154 @@
+import asyncio
+import collections
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+from .backend import FileID
+
+# Digest of the encrypted content of files. The content is split in blocks of
+# BLOCK_SIZE bytes (the last one can be shorter), and the digest is the
+# SHA-256 of the concatenation of the SHA-256 of each block. Digests of the
+# complete blocks of an upload in progress are saved in a ".digest" file next
+# to its content, so that an upload resumed by another worker (or after a
+# restart) only needs to read back its last incomplete block.
+BLOCK_SIZE = 1024*1024
+BLOCK_DIGEST_SIZE = hashlib.sha256().digest_size
+
+class RollingDigest:
+    def __init__(self):
+        self.blocks = bytearray()
+        self.saved = 0
+        self._block = hashlib.sha256()
+        self._block_len = 0
+
+    @property
+    def offset(self) -> int:
+        # Number of bytes hashed so far
+        return (len(self.blocks)//BLOCK_DIGEST_SIZE)*BLOCK_SIZE + self._block_len
+
+    def update(self, data):
+        data = memoryview(data)
+        while len(data) > 0:
+            n = min(BLOCK_SIZE - self._block_len, len(data))
+            self._block.update(data[:n])
+            self._block_len += n
+            data = data[n:]
+            if self._block_len == BLOCK_SIZE:
+                self.blocks += self._block.digest()
+                self._block = hashlib.sha256()
+                self._block_len = 0
+        return self
+
+    def hexdigest(self) -> str:
+        blocks = bytes(self.blocks)
+        if self._block_len > 0:
+            blocks += self._block.digest()
+        return hashlib.sha256(blocks).hexdigest()
+
+    def unsaved(self) -> bytes:
+        # Digests of the complete blocks that are not in the ".digest" file
+        # yet
+        ret = bytes(self.blocks[self.saved:])
+        self.saved = len(self.blocks)
+        return ret
+
+    @classmethod
+    def load(cls, digest_path: Path, content_path: Path, size: int) -> "RollingDigest":
+        # Rebuilds the state of an upload whose first "size" bytes have been
+        # written. Block digests that are missing from the ".digest" file are
+        # computed again, and the ones past "size" (if writing the content
+        # failed) are dropped.
+        ret = cls()
+        try:
+            with open(digest_path, "rb") as f:
+                blocks = f.read()
+        except FileNotFoundError:
+            blocks = b""
+        nblocks = min(len(blocks)//BLOCK_DIGEST_SIZE, size//BLOCK_SIZE)
+        ret.blocks += blocks[:nblocks*BLOCK_DIGEST_SIZE]
+        ret.saved = len(ret.blocks)
+        if len(blocks) > ret.saved:
+            os.truncate(digest_path, ret.saved)
+        if ret.offset < size:
+            with open(content_path, "rb") as f:
+                f.seek(ret.offset)
+                while ret.offset < size:
+                    data = f.read(min(BLOCK_SIZE, size - ret.offset))
+                    if len(data) == 0:
+                        break
+                    ret.update(data)
+        return ret
+
+class DigestStore:
+    # Rolling digests of the uploads in progress in this worker, so that
+    # consecutive pushes to the same upload don't need to rebuild them. An
+    # entry is only used if it matches the current size of the content, as
+    # another worker may have appended data in the meantime.
+    #
+    # Entries are taken and discarded from worker threads, and put back from
+    # the event loop: the dict is only accessed under a lock.
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.rebuilds = 0
+
+    def take(self, id_: FileID, digest_path: Path, content_path: Path, size: int) -> RollingDigest:
+        with self._lock:
+            digest = self._entries.pop(id_.bytes, None)
+            if digest is not None and digest.offset == size:
+                return digest
+            self.rebuilds += 1
+        return RollingDigest.load(digest_path, content_path, size)
+
+    def put(self, id_: FileID, digest: RollingDigest):
+        with self._lock:
+            self._entries[id_.bytes] = digest
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, id_: FileID):
+        with self._lock:
+            self._entries.pop(id_.bytes, None)
+
+class UploadDigest:
+    # Digest of the data written by an AppendStream
+    def __init__(self, store: DigestStore, id_: FileID, digest_path: Path, content_path: Path):
+        self._store = store
+        self._id = id_
+        self._digest_path = digest_path
+        self._content_path = content_path
+        self._digest = None
+
+    async def open(self, offset: int):
+        self._digest = await asyncio.to_thread(self._store.take, self._id, self._digest_path, self._content_path, offset)
+
+    async def update(self, data):
+        # Called once data have been written. hashlib releases the GIL on
+        # large buffers.
+        digest = self._digest
+        await asyncio.to_thread(digest.update, data)
+        blocks = digest.unsaved()
+        if len(blocks) > 0:
+            await asyncio.to_thread(_append, self._digest_path, blocks)
+
+    def close(self):
+        if self._digest is not None:
+            self._store.put(self._id, self._digest)
+            self._digest = None
+
+def _append(path: Path, data: bytes):
+    with open(path, "ab") as f:
+        f.write(data)
+
+def file_digest(path: Path) -> str:
+    with open(path, "rb") as f:
+        digest = RollingDigest()
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if len(data) == 0:
+                break
+            digest.update(data)
+    return digest.hexdigest()
@@ -0,0 +1,71 @@
+import asyncio
+import os
+from pathlib import Path
+
+# Durability modes of uploaded data:
+# * none: never fsync, let the OS write data back
+# * finish: fsync files when an upload is marked as complete
+# * periodic: also fsync pushed data before acknowledging each push. fsyncs
+#   of concurrent uploads are grouped together every "interval" seconds.
+DURABILITY_NONE = "none"
+DURABILITY_FINISH = "finish"
+DURABILITY_PERIODIC = "periodic"
+DURABILITY_MODES = (DURABILITY_NONE, DURABILITY_FINISH, DURABILITY_PERIODIC)
+
+def fsync_path(path: Path):
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _fsync_all(fds):
+    # Closes the file descriptors once flushed
+    ret = {}
+    for fd in fds:
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            ret[fd] = e
+        finally:
+            os.close(fd)
+    return ret
+
+class GroupCommit:
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._pending = []
+        self._task = None
+        self.commits = 0
+        self.fsyncs = 0
+
+    async def sync(self, fd: int):
+        # The file descriptor is duplicated, so that it stays valid until it
+        # has been flushed even if the caller is cancelled and closes its own
+        # in the meantime (its number could then be reused by another file).
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((os.dup(fd), fut))
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        await fut
+
+    async def _run(self):
+        while len(self._pending) > 0:
+            await asyncio.sleep(self._interval)
+            batch, self._pending = self._pending, []
+            fds = [fd for fd, _ in batch]
+            errors = await asyncio.to_thread(_fsync_all, fds)
+            self.commits += 1
+            self.fsyncs += len(fds)
+            for fd, fut in batch:
+                if fut.done():
+                    continue
+                err = errors.get(fd)
+                if err is None:
+                    fut.set_result(None)
+                else:
+                    fut.set_exception(err)
+
+    def stats(self):
+        return {'commits': self.commits, 'fsyncs': self.fsyncs, 'pending': len(self._pending)}
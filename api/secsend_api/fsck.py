@@ -0,0 +1,178 @@
+import collections
+import concurrent.futures
+import os
+import re
+import secrets
+from pathlib import Path
+
+from .backend import FileID, BackendErrorInvalidMetadata
+from .backend_files import BackendFiles
+from .digest import RollingDigest
+from .roots import StorageRoot
+from .timeout import ts_has_expired
+
+# Consistency check of the files backend, e.g. after an unclean shutdown.
+# Like the other maintenance tools, it must not run while a server is using
+# the same storage roots.
+#
+# Every file of a root is classified, and debris are handled according to a
+# policy:
+# * "report" only reports them
+# * "repair" removes what is certainly garbage (temporary files, lock and
+#   digest files of complete or deleted uploads), recreates the content of
+#   complete empty files, and moves what can't be repaired to the
+#   ".quarantine" directory of the root
+# * "purge" removes everything that can't be repaired, as well as expired
+#   files and empty directories
+POLICIES = ("report", "repair", "purge")
+
+# Files that are part of an ID, and temporary files of _write_tmp
+_NAME = re.compile(r"^([0-9a-f]{%d})\.(metadata|content|lock|digest)$" % (FileID.ID_LEN*2))
+_TMP = re.compile(r"^([0-9a-f]{%d})\.(metadata|content)[a-z0-9_]+$" % (FileID.ID_LEN*2))
+
+EMPTY_DIGEST = RollingDigest().hexdigest()
+
+class Fsck:
+    def __init__(self, backend: BackendFiles, policy: str = "report", log=print):
+        if policy not in POLICIES:
+            raise ValueError("invalid fsck policy '%s'" % policy)
+        self.backend = backend
+        self.policy = policy
+        self.log = log
+
+    def scan_tree(self, root: StorageRoot, top: Path):
+        # Checks a subtree of a root. Returns the number of entries of each
+        # category, and the log lines.
+        counts = collections.Counter()
+        lines = []
+        for dirpath, dirnames, filenames in os.walk(top, topdown=False):
+            dirpath = Path(dirpath)
+            ids = collections.defaultdict(dict)
+            for name in filenames:
+                m = _NAME.match(name)
+                if m is not None:
+                    ids[m.group(1)][m.group(2)] = dirpath / name
+                elif _TMP.match(name) is not None:
+                    self._finding(counts, lines, dirpath / name, "tmp", repair=_unlink([dirpath / name]))
+                else:
+                    self._finding(counts, lines, dirpath / name, "unknown")
+            for hid, files in ids.items():
+                try:
+                    self._check_id(counts, lines, root, FileID(bytes.fromhex(hid)), files)
+                except OSError as e:
+                    counts['errors'] += 1
+                    lines.append("%s: error: %s" % (dirpath / hid, e))
+            if self.policy == "purge":
+                try:
+                    # Fails if the directory isn't empty
+                    os.rmdir(dirpath)
+                    counts['empty_dirs'] += 1
+                except OSError:
+                    pass
+        return counts, lines
+
+    def _check_id(self, counts, lines, root: StorageRoot, id_: FileID, files: dict):
+        all_files = list(files.values())
+        metadata_path = files.get("metadata")
+        if metadata_path is None:
+            for kind in ("lock", "digest"):
+                if kind in files:
+                    self._finding(counts, lines, files[kind], "orphan_" + kind, repair=_unlink([files[kind]]))
+            if "content" in files:
+                self._finding(counts, lines, files["content"], "orphan_content", repair=_quarantine(root, [files["content"]]), purge=_unlink([files["content"]]))
+            return
+
+        content_path = metadata_path.with_suffix(".content")
+        try:
+            metadata = self.backend.load_metadata(id_, metadata_path)
+        except (BackendErrorInvalidMetadata, ValueError, KeyError, TypeError):
+            self._finding(counts, lines, metadata_path, "invalid_metadata", repair=_quarantine(root, all_files), purge=_unlink(all_files))
+            return
+
+        if root is not self.backend.cold_root and self.backend.root_of(id_).path != root.path:
+            # "secstore rebalance" moves it to the right root
+            self._finding(counts, lines, metadata_path, "misplaced")
+
+        if not metadata.complete:
+            counts['incomplete'] += 1
+            return
+
+        for kind in ("lock", "digest"):
+            if kind in files:
+                self._finding(counts, lines, files[kind], "orphan_" + kind, repair=_unlink([files[kind]]))
+        if "content" not in files:
+            if metadata.digest == EMPTY_DIGEST or (metadata.digest is None and metadata.declared_size == 0):
+                self._finding(counts, lines, content_path, "empty_content", repair=_create_empty(content_path))
+            else:
+                self._finding(counts, lines, metadata_path, "missing_content", repair=_quarantine(root, all_files), purge=_unlink(all_files))
+            return
+        if metadata.timeout_s != 0 and ts_has_expired(metadata.timeout_ts):
+            self._finding(counts, lines, metadata_path, "expired", purge=lambda: self.backend.trash(root, id_, metadata_path, content_path))
+            return
+        counts['ok'] += 1
+
+    def _finding(self, counts, lines, path: Path, category: str, repair=None, purge=None):
+        # "repair" and "purge" are the actions run by these policies. "purge"
+        # defaults to "repair".
+        counts[category] += 1
+        action = None
+        if self.policy == "repair":
+            action = repair
+        elif self.policy == "purge":
+            action = purge or repair
+        if action is None:
+            lines.append("%s: %s" % (path, category))
+            return
+        try:
+            action()
+            counts['fixed'] += 1
+            lines.append("%s: %s, fixed" % (path, category))
+        except OSError as e:
+            counts['errors'] += 1
+            lines.append("%s: %s, error: %s" % (path, category, e))
+
+    def run(self, jobs: int = 16) -> collections.Counter:
+        # Subtrees of each root are checked in parallel: the work is mostly
+        # waiting for the filesystem.
+        counts = collections.Counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = []
+            for root in self.backend.all_roots:
+                # Files at the top of the root are its key and lock files
+                for entry in os.scandir(root.path):
+                    if entry.name.startswith(".") or not entry.is_dir(follow_symlinks=False):
+                        continue
+                    futures.append(pool.submit(self.scan_tree, root, Path(entry.path)))
+            for future in concurrent.futures.as_completed(futures):
+                c, lines = future.result()
+                counts.update(c)
+                for line in lines:
+                    self.log(line)
+        return counts
+
+def _unlink(paths: list):
+    def action():
+        for path in paths:
+            os.unlink(path)
+    return action
+
+def _create_empty(path: Path):
+    def action():
+        with open(path, "xb"):
+            pass
+    return action
+
+def _quarantine(root: StorageRoot, paths: list):
+    def action():
+        qdir = root.path / ".quarantine"
+        qdir.mkdir(exist_ok=True)
+        token = secrets.token_hex(4)
+        for path in paths:
+            os.rename(path, qdir / ("%s.%s" % (path.name, token)))
+    return action
+
+def fsck(backend: BackendFiles, policy: str = "report", jobs: int = 16, log=print) -> collections.Counter:
+    return Fsck(backend, policy, log).run(jobs)
+
+def format_report(counts: collections.Counter) -> str:
+    return ", ".join("%s: %d" % (k, v) for k, v in sorted(counts.items()))
@@ -0,0 +1,75 @@
+import datetime
+from email.utils import formatdate, parsedate_to_datetime
+
+from .backend import FileID
+
+def etag(id_: FileID, size: int) -> str:
+    # Complete files are immutable, so their identity and size are enough to
+    # build a strong validator.
+    return '"%s-%x"' % (id_.bytes.hex(), size)
+
+def digest_etag(digest: str) -> str:
+    # The digest of the encrypted content, computed during the upload
+    return '"%s"' % digest
+
+def cache_control(metadata, max_age: int) -> str:
+    if not metadata.complete:
+        return "no-store"
+    if metadata.timeout_s != 0:
+        now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+        max_age = min(max_age, int(metadata.timeout_ts - now))
+    if max_age <= 0:
+        return "no-cache"
+    return "public, max-age=%d" % max_age
+
+def cache_headers(id_: FileID, metadata, stats, max_age: int) -> dict:
+    ret = {"Cache-Control": cache_control(metadata, max_age)}
+    if metadata.complete:
+        if metadata.digest is not None:
+            ret["ETag"] = digest_etag(metadata.digest)
+        else:
+            ret["ETag"] = etag(id_, stats.st_size)
+        ret["Last-Modified"] = formatdate(stats.st_mtime, usegmt=True)
+    return ret
+
+def _strip_weak(tag: str) -> str:
+    tag = tag.strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    return tag
+
+def _parse_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def not_modified(request, headers: dict) -> bool:
+    etag_ = headers.get("ETag")
+    if etag_ is None:
+        return False
+    inm = request.headers.get("if-none-match")
+    if inm is not None:
+        # RFC 9110 uses the weak comparison function for If-None-Match
+        if inm.strip() == "*":
+            return True
+        return any(_strip_weak(v) == etag_ for v in inm.split(","))
+    ims = request.headers.get("if-modified-since")
+    if ims is None:
+        return False
+    ims = _parse_date(ims)
+    last_modified = _parse_date(headers["Last-Modified"])
+    return ims is not None and last_modified <= ims
+
+def if_range_matches(request, headers: dict) -> bool:
+    value = request.headers.get("if-range")
+    if value is None:
+        return True
+    value = value.strip()
+    etag_ = headers.get("ETag")
+    if etag_ is None:
+        return False
+    if value.startswith('"') or value.startswith("W/"):
+        # Strong comparison: a weak validator never matches
+        return value == etag_
+    return value == headers["Last-Modified"]
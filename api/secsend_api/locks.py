@@ -0,0 +1,133 @@
+import asyncio
+import fcntl
+import os
+from pathlib import Path
+
+from .backend import FileID, BackendErrorFileLocked, BackendErrorIDUnknown
+
+class LockManager:
+    # Write locks are taken in two steps:
+    # * an asyncio lock, shared by all the requests of this process
+    # * an fcntl advisory lock on a ".lock" file, for exclusion between
+    #   processes. The kernel releases it when its owner dies, so that a
+    #   killed worker never leaves a stale lock behind.
+    def __init__(self, timeout: float = 0, poll_interval: float = 0.05):
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._locks = {}
+        self.waits = 0
+        self.timeouts = 0
+
+    def lock(self, path: Path, metadata_path: Path, id_: FileID):
+        return LockCtx(self, path, metadata_path, id_)
+
+    def _get(self, path: Path):
+        entry = self._locks.get(path)
+        if entry is None:
+            entry = self._locks[path] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _put(self, path: Path):
+        entry = self._locks[path]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[path]
+
+    def stats(self):
+        return {'held': len(self._locks), 'waits': self.waits, 'timeouts': self.timeouts}
+
+
+class LockCtx:
+    def __init__(self, manager: LockManager, path: Path, metadata_path: Path, id_: FileID):
+        self._manager = manager
+        self._path = path
+        self._metadata_path = metadata_path
+        self._id = id_
+        self._fd = None
+        # Set when the lock file is not needed anymore (complete or deleted
+        # upload)
+        self.remove = False
+
+    async def __aenter__(self):
+        manager = self._manager
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + manager.timeout
+        lock = manager._get(self._path)
+        try:
+            if lock.locked():
+                if manager.timeout <= 0:
+                    raise BackendErrorFileLocked()
+                manager.waits += 1
+                try:
+                    await asyncio.wait_for(lock.acquire(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    manager.timeouts += 1
+                    raise BackendErrorFileLocked()
+            else:
+                await lock.acquire()
+            try:
+                self._fd = await self._flock(deadline)
+            except:
+                lock.release()
+                raise
+        except:
+            manager._put(self._path)
+            raise
+        return self
+
+    async def _flock(self, deadline: float) -> int:
+        manager = self._manager
+        loop = asyncio.get_running_loop()
+        path = str(self._path)
+        while True:
+            if not self._metadata_path.exists():
+                raise BackendErrorIDUnknown(self._id)
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+            except FileNotFoundError:
+                # This can happen because one parent directory doesn't exist, as the file doesn't exist
+                raise BackendErrorIDUnknown(self._id)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                if loop.time() >= deadline:
+                    manager.timeouts += 1
+                    raise BackendErrorFileLocked()
+                manager.waits += 1
+                await asyncio.sleep(manager.poll_interval)
+                continue
+            # The previous owner might have removed the lock file while we
+            # were waiting for it. In this case, try again with the new one.
+            try:
+                same = os.stat(path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                same = False
+            if same:
+                return fd
+            os.close(fd)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if self.remove or not self._metadata_path.exists():
+                try:
+                    self._path.unlink()
+                except FileNotFoundError:
+                    pass
+            os.close(self._fd)
+        finally:
+            self._manager._locks[self._path][0].release()
+            self._manager._put(self._path)
+
+def try_lock(path: Path):
+    # Takes an fcntl lock on path without waiting. Returns the file
+    # descriptor that holds it, or None if another process holds it. Used to
+    # elect the worker that runs a background task.
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
@@ -1,8 +1,9 @@
 import base64
 import datetime
 from dataclasses import dataclass, asdict
+from typing import Optional
 
-ALGOS = ['aes-gcm']
+ALGOS = ['aes-gcm', 'aes-gcm-zlib']
 
 @dataclass
 class EncryptedFileMetadata:
@@ -16,6 +17,14 @@ class EncryptedFileMetadata:
     version: int = 1
     timeout_s: int = 0
     timeout_ts: int = 0
+    # Size of the encrypted content announced by the client, if any
+    declared_size: Optional[int] = None
+    # Digest of the encrypted content (see digest.py), set once the upload is
+    # complete
+    digest: Optional[str] = None
+    # Client that uploaded the file, for quotas (see quota.py). Only known
+    # by the server.
+    owner: Optional[str] = None
 
     def jsonable(self):
         ret = asdict(self)
@@ -24,6 +33,12 @@ class EncryptedFileMetadata:
             ret[f] = v
         return ret
 
+    def public_jsonable(self):
+        # Metadata sent to clients
+        ret = self.jsonable()
+        del ret['owner']
+        return ret
+
     @classmethod
     def from_jsonable(cls, d):
         for f in ("name","mime_type","iv","chunk_size","key_sign"):
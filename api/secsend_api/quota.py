@@ -0,0 +1,120 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+
+from sanic import exceptions
+
+from .admission import client_address
+
+# Quotas on the files stored by each client: total bytes stored, and number
+# of uploads in progress. Clients are identified by their IP address, or by
+# a header set by an authenticating reverse proxy (e.g. "X-Remote-User").
+#
+# Usage is tracked incrementally, as files are created, pushed to, finished
+# and deleted (expired files and abandoned uploads are deleted in the
+# background, see sweeper.py), in one counter file per client under the
+# ".quotas" directory of the first root. Counter files are updated under an
+# fcntl lock, so that they are shared by all the workers. The client of a
+# file is stored in its metadata, as "owner", and never sent to other
+# clients.
+#
+# Counter files are read and written from worker threads, never from the
+# event loop. The byte quota is a soft limit: a push is checked against the
+# usage read when it starts, so that concurrent pushes of a client can
+# exceed it by up to their sizes.
+
+class QuotaExceeded(exceptions.SanicException):
+    status_code = 413
+    quiet = True
+
+class Quotas:
+    def __init__(self, path: Path, max_bytes: int = 0, max_uploads: int = 0, key: str = "ip"):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.max_uploads = max_uploads
+        if key != "ip" and not key.startswith("header:"):
+            raise ValueError("invalid quota key '%s': must be 'ip' or 'header:<name>'" % key)
+        self.key = key
+        # fcntl locks don't exclude threads of the same process
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 or self.max_uploads > 0
+
+    def owner(self, request) -> str:
+        if self.key.startswith("header:"):
+            value = request.headers.get(self.key[len("header:"):])
+            if value:
+                return "user:%s" % value
+        return "ip:%s" % client_address(request)
+
+    def _counter_path(self, owner: str) -> Path:
+        return self.path / hashlib.sha256(owner.encode("utf8")).hexdigest()[:32]
+
+    def usage(self, owner: str) -> dict:
+        try:
+            with open(self._counter_path(owner), "r") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+                return _load(f, owner)
+        except FileNotFoundError:
+            return _load(None, owner)
+
+    def add(self, owner: Optional[str], nbytes: int = 0, uploads: int = 0):
+        if owner is None or (nbytes == 0 and uploads == 0):
+            return
+        self.path.mkdir(exist_ok=True)
+        with self._lock:
+            fd = os.open(self._counter_path(owner), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+            with os.fdopen(fd, "r+") as f:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                usage = _load(f, owner)
+                # Usage can't become negative if files of a client were
+                # stored before quotas were enabled
+                usage['bytes'] = max(usage['bytes'] + nbytes, 0)
+                usage['uploads'] = max(usage['uploads'] + uploads, 0)
+                f.seek(0)
+                f.truncate()
+                json.dump(usage, f)
+
+    def check_new(self, owner: str, size: Optional[int]):
+        # Called before a new upload, with the size it has announced if any
+        usage = self.usage(owner)
+        if self.max_uploads > 0 and usage['uploads'] >= self.max_uploads:
+            self.rejected += 1
+            raise QuotaExceeded("too many uploads in progress (maximum is %d)" % self.max_uploads)
+        self.check_bytes(usage, size or 0)
+
+    def check_bytes(self, usage: dict, size: int):
+        if self.max_bytes > 0 and usage['bytes'] + size > self.max_bytes:
+            self.rejected += 1
+            raise QuotaExceeded("storage quota exceeded (%d bytes stored, maximum is %d)" % (usage['bytes'], self.max_bytes))
+
+    def all(self):
+        ret = []
+        try:
+            entries = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return ret
+        for entry in entries:
+            try:
+                with open(entry.path, "r") as f:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+                    ret.append(_load(f, None))
+            except (OSError, ValueError):
+                continue
+        return ret
+
+    def stats(self):
+        return {'max_bytes': self.max_bytes, 'max_uploads': self.max_uploads, 'rejected': self.rejected}
+
+def _load(f, owner: Optional[str]) -> dict:
+    data = f.read() if f is not None else ""
+    if len(data) == 0:
+        return {'owner': owner, 'bytes': 0, 'uploads': 0}
+    return json.loads(data)
@@ -0,0 +1,91 @@
+import asyncio
+import time
+from typing import Optional
+
+class TokenBucket:
+    # "rate" bytes per second, with bursts of up to "burst" bytes. Tokens are
+    # taken for whole chunks, and can go negative: the caller then waits
+    # until the debt is paid back, so that there is a single sleep per chunk.
+    def __init__(self, rate: int, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+
+    def take(self, n: int) -> float:
+        # Returns the time to wait before sending these n bytes
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        self._tokens -= n
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self.rate
+
+class RateLimiter:
+    # Bandwidth shaping of one direction (uploads or downloads), per stream,
+    # per client address and globally. A rate of 0 means no limit.
+    def __init__(self, rate: int = 0, per_client: int = 0, global_rate: int = 0, burst: int = 1024*1024):
+        self.rate = rate
+        self.per_client = per_client
+        self.burst = burst
+        self._global = TokenBucket(global_rate, burst) if global_rate > 0 else None
+        # client -> [bucket, number of streams]
+        self._clients = {}
+        self.delays = 0
+        self.delay_s = 0.0
+
+    @property
+    def enabled(self):
+        return self.rate > 0 or self.per_client > 0 or self._global is not None
+
+    def stream(self, client: str):
+        return ShapedStream(self, client)
+
+    def stats(self):
+        return {'clients': len(self._clients), 'delays': self.delays, 'delay_s': self.delay_s}
+
+class ShapedStream:
+    def __init__(self, limiter: RateLimiter, client: str):
+        self._limiter = limiter
+        self._client = client
+        self._buckets = []
+
+    def __enter__(self):
+        limiter = self._limiter
+        if limiter.rate > 0:
+            self._buckets.append(TokenBucket(limiter.rate, limiter.burst))
+        if limiter.per_client > 0:
+            entry = limiter._clients.get(self._client)
+            if entry is None:
+                entry = limiter._clients[self._client] = [TokenBucket(limiter.per_client, limiter.burst), 0]
+            entry[1] += 1
+            self._buckets.append(entry[0])
+        if limiter._global is not None:
+            self._buckets.append(limiter._global)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        limiter = self._limiter
+        if limiter.per_client > 0:
+            entry = limiter._clients[self._client]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del limiter._clients[self._client]
+
+    @property
+    def chunk_size(self) -> Optional[int]:
+        # Maximum size of the chunks to send at once, so that the stream stays
+        # smooth
+        if len(self._buckets) == 0:
+            return None
+        return max(self._limiter.burst, 64*1024)
+
+    async def consume(self, n: int):
+        if len(self._buckets) == 0:
+            return
+        delay = max([b.take(n) for b in self._buckets])
+        if delay > 0:
+            self._limiter.delays += 1
+            self._limiter.delay_s += delay
+            await asyncio.sleep(delay)
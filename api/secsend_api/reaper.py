@@ -0,0 +1,65 @@
+import asyncio
+import collections
+import os
+from pathlib import Path
+
+class Reaper:
+    # Deleted files are first moved into a trash directory, which makes them
+    # disappear from the API immediately. The reaper then unlinks them in the
+    # background, at a rate of at most "rate" bytes per second (0 means no
+    # limit). Files are never truncated: downloads still reading a deleted
+    # file keep the inode alive, and its blocks are freed when the last of
+    # them closes it.
+    def __init__(self, rate: int = 0, poll_interval: float = 0.5):
+        self.rate = rate
+        self.poll_interval = poll_interval
+        self._queue = collections.deque()
+        self.deleted = 0
+        self.deleted_bytes = 0
+        self.errors = 0
+
+    def push(self, path: Path):
+        self._queue.append(path)
+
+    def scan(self, trash_dir: Path):
+        # Files left by a previous run
+        try:
+            for entry in os.scandir(trash_dir):
+                self.push(Path(entry.path))
+        except FileNotFoundError:
+            pass
+
+    async def run(self):
+        while True:
+            await self.reap()
+            await asyncio.sleep(self.poll_interval)
+
+    async def reap(self):
+        while len(self._queue) > 0:
+            path = self._queue.popleft()
+            try:
+                await self._remove(path)
+                self.deleted += 1
+            except FileNotFoundError:
+                # Already removed by another worker
+                pass
+            except OSError:
+                self.errors += 1
+
+    async def _remove(self, path: Path):
+        size = (await asyncio.to_thread(os.stat, path)).st_size
+        await asyncio.to_thread(os.unlink, path)
+        await self._account(size)
+
+    async def _account(self, size: int):
+        self.deleted_bytes += size
+        if self.rate > 0:
+            await asyncio.sleep(size / self.rate)
+
+    def stats(self):
+        return {
+            'queue': len(self._queue),
+            'deleted': self.deleted,
+            'deleted_bytes': self.deleted_bytes,
+            'errors': self.errors
+        }
@@ -0,0 +1,82 @@
+import hashlib
+import math
+import secrets
+import shutil
+from pathlib import Path
+from typing import List
+
+from .backend import FileID
+
+class StorageRoot:
+    # A directory (usually one per disk) where files are stored. Each root has
+    # a random key, stored in its ".secsend_root" file, so that the placement
+    # of files doesn't depend on the path where the disk is mounted.
+    KEY_FILE = ".secsend_root"
+
+    def __init__(self, path: Path, weight: float = 1):
+        if weight <= 0:
+            raise ValueError("invalid weight for root '%s': must be positive" % path)
+        self.path = Path(path)
+        self.weight = weight
+        self.trash_dir = self.path / ".trash"
+        self.key = self._load_key()
+
+    def _load_key(self) -> bytes:
+        kpath = self.path / self.KEY_FILE
+        try:
+            return bytes.fromhex(kpath.read_text().strip())
+        except FileNotFoundError:
+            pass
+        self.path.mkdir(parents=True, exist_ok=True)
+        key = secrets.token_bytes(16)
+        try:
+            with open(kpath, "x") as f:
+                f.write(key.hex())
+        except FileExistsError:
+            # Created concurrently by another worker
+            return bytes.fromhex(kpath.read_text().strip())
+        return key
+
+    def score(self, id_: FileID) -> float:
+        # Weighted rendezvous hashing: each root draws a uniform number in
+        # ]0,1[ from the ID, and the root with the highest score owns it.
+        # Adding a root only moves the files that the new root now owns.
+        h = hashlib.blake2b(id_.bytes, key=self.key, digest_size=8).digest()
+        u = (int.from_bytes(h, "little") + 1) / (2**64 + 1)
+        return -self.weight / math.log(u)
+
+    def free_space(self) -> int:
+        return shutil.disk_usage(self.path).free
+
+    def __repr__(self):
+        return "StorageRoot(%s, %g)" % (self.path, self.weight)
+
+def parse_roots(value) -> List[StorageRoot]:
+    # Roots are given as a comma-separated list of "path[:weight]"
+    if isinstance(value, (str, Path)):
+        value = str(value).split(",")
+    ret = []
+    for spec in value:
+        if isinstance(spec, StorageRoot):
+            ret.append(spec)
+            continue
+        spec = str(spec).strip()
+        if len(spec) == 0:
+            continue
+        path, sep, weight = spec.rpartition(":")
+        if sep and path:
+            try:
+                weight = float(weight)
+            except ValueError:
+                path, weight = spec, 1
+        else:
+            path, weight = spec, 1
+        ret.append(StorageRoot(Path(path), weight))
+    if len(ret) == 0:
+        raise ValueError("no storage root specified")
+    return ret
+
+def owner(roots: List[StorageRoot], id_: FileID) -> StorageRoot:
+    if len(roots) == 1:
+        return roots[0]
+    return max(roots, key=lambda r: r.score(id_))
@@ -0,0 +1,125 @@
+import asyncio
+import collections
+import os
+import sys
+import time
+
+from .backend import FileID, BackendErrorIDUnknown, BackendErrorInvalidMetadata
+from .backend_files import BackendFiles, advise, open_noatime
+from .locks import try_lock
+from .digest import BLOCK_SIZE, RollingDigest
+from .ratelimit import TokenBucket
+from .timeout import ts_has_expired
+from .tools import iter_ids
+
+class Scrubber:
+    # Reads complete files back in the background, and checks them against
+    # the digest computed while they were uploaded, so that silent disk
+    # corruption is found before recipients fail to decrypt them. Files are
+    # read at "rate" bytes per second at most (0 disables the scrubber), and a
+    # new pass starts "interval" seconds after the previous one has finished.
+    #
+    # Corrupted files are moved to the ".quarantine" directory of their root:
+    # they disappear from the API, but are kept for inspection.
+    #
+    # A single worker scrubs at a time: the one that holds an fcntl lock on
+    # ".scrub.lock" in the first root. The kernel releases it if the worker
+    # dies, and another one takes over.
+    MAX_REPORTS = 100
+
+    def __init__(self, backend: BackendFiles, rate: int = 0, interval: float = 7*24*3600, election_interval: float = 60):
+        self.backend = backend
+        self.rate = rate
+        self.interval = interval
+        self.election_interval = election_interval
+        self._lock_fd = None
+        self.passes = 0
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+        self.corrupted = collections.deque(maxlen=self.MAX_REPORTS)
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def elect(self) -> bool:
+        if self._lock_fd is not None:
+            return True
+        self._lock_fd = try_lock(self.backend.roots[0].path / ".scrub.lock")
+        return self._lock_fd is not None
+
+    async def run(self):
+        if not self.enabled:
+            return
+        while True:
+            if not await asyncio.to_thread(self.elect):
+                await asyncio.sleep(self.election_interval)
+                continue
+            await self.scrub()
+            await asyncio.sleep(self.interval)
+
+    async def scrub(self):
+        bucket = TokenBucket(self.rate, BLOCK_SIZE) if self.rate > 0 else None
+        for root in self.backend.all_roots:
+            ids = await asyncio.to_thread(lambda: [id_ for id_, _ in iter_ids(root)])
+            for id_ in ids:
+                try:
+                    await self.check(id_, bucket)
+                except (FileNotFoundError, BackendErrorIDUnknown):
+                    # Deleted in the meantime
+                    pass
+                except (OSError, BackendErrorInvalidMetadata):
+                    self.errors += 1
+        self.passes += 1
+
+    async def check(self, id_: FileID, bucket: TokenBucket = None) -> bool:
+        # Returns False if the file is corrupted (and has been quarantined)
+        f = self.backend.open(id_)
+        metadata = await asyncio.to_thread(lambda: f.metadata)
+        if not metadata.complete or metadata.digest is None:
+            # Not uploaded yet, or uploaded before digests existed
+            return True
+        if metadata.timeout_s != 0 and ts_has_expired(metadata.timeout_ts):
+            return True
+
+        digest = RollingDigest()
+        fd = await asyncio.to_thread(open_noatime, f.content_path)
+        try:
+            size = os.fstat(fd).st_size
+            while True:
+                data = await asyncio.to_thread(os.read, fd, BLOCK_SIZE)
+                if len(data) == 0:
+                    break
+                await asyncio.to_thread(digest.update, data)
+                self.bytes += len(data)
+                if bucket is not None:
+                    delay = bucket.take(len(data))
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+            if self.backend.fadvise and size >= self.backend.fadvise_drop_threshold:
+                advise(fd, 0, 0, "DONTNEED")
+        finally:
+            os.close(fd)
+        self.files += 1
+        if digest.hexdigest() == metadata.digest:
+            return True
+        await asyncio.to_thread(self.quarantine, f)
+        return False
+
+    def quarantine(self, f):
+        dest = f.quarantine()
+        report = {'id': str(f.id), 'root': str(f.root.path), 'quarantine': str(dest), 'time': int(time.time())}
+        self.corrupted.append(report)
+        print("Warning: file %s is corrupted, moved to %s" % (report['id'], report['quarantine']), file=sys.stderr)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'elected': self._lock_fd is not None,
+            'passes': self.passes,
+            'files': self.files,
+            'bytes': self.bytes,
+            'errors': self.errors,
+            'corrupted': list(self.corrupted)
+        }
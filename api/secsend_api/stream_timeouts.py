@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from sanic import exceptions
+
+class StreamTimeouts:
+    # Protects upload streams against stalled and very slow clients, which
+    # would otherwise hold the write lock of their upload forever:
+    # * a client that sends nothing for "idle_timeout" seconds is
+    #   disconnected
+    # * a client that sends less than "min_rate" bytes per second, measured
+    #   over "window" seconds of waiting for it, is disconnected
+    # 0 disables these checks. Time spent by the server itself (writing data,
+    # rate limiting) is not accounted.
+    def __init__(self, idle_timeout: float = 60, min_rate: int = 0, window: float = 30):
+        self.idle_timeout = idle_timeout
+        self.min_rate = min_rate
+        self.window = window
+        self.idle = 0
+        self.slow = 0
+
+    def reader(self, stream):
+        return TimedReader(self, stream)
+
+    def stats(self):
+        return {'idle': self.idle, 'slow': self.slow}
+
+class TimedReader:
+    def __init__(self, timeouts: StreamTimeouts, stream):
+        self._timeouts = timeouts
+        self._stream = stream
+        self._wait = 0.0
+        self._bytes = 0
+
+    def _close(self):
+        # Close the connection once the error has been sent. By default,
+        # sanic would try to read the rest of the request body first, which
+        # would again wait for the client.
+        self._stream.keep_alive = False
+        self._stream.request_body = None
+
+    async def read(self):
+        timeouts = self._timeouts
+        start = time.monotonic()
+        try:
+            if timeouts.idle_timeout > 0:
+                data = await asyncio.wait_for(self._stream.read(), timeouts.idle_timeout)
+            else:
+                data = await self._stream.read()
+        except asyncio.TimeoutError:
+            timeouts.idle += 1
+            self._close()
+            raise exceptions.RequestTimeout("no data received for %g seconds" % timeouts.idle_timeout)
+        if data is None or timeouts.min_rate <= 0:
+            return data
+
+        self._wait += time.monotonic() - start
+        self._bytes += len(data)
+        if self._wait >= timeouts.window:
+            if self._bytes < timeouts.min_rate * self._wait:
+                timeouts.slow += 1
+                self._close()
+                raise exceptions.RequestTimeout("upload too slow")
+            self._wait = 0.0
+            self._bytes = 0
+        return data
@@ -0,0 +1,107 @@
+import asyncio
+import os
+import time
+
+from .backend import FileID, BackendErrorIDUnknown, BackendErrorInvalidMetadata, BackendErrorFileLocked
+from .backend_files import BackendFiles, BackendFile
+from .locks import try_lock
+from .timeout import ts_has_expired
+from .tools import iter_ids
+
+class Sweeper:
+    # Deletes expired files, and uploads that haven't received any data for
+    # "abandoned_age" seconds (0, the default, keeps them forever so that
+    # they can always be resumed), in the background.
+    # Without it, expired files are only deleted when they are accessed, and
+    # keep using disk space and the quota of their owner. Files are deleted
+    # with BackendFile.delete, which updates quotas. A pass runs every
+    # "interval" seconds (0 disables the sweeper), in the worker that holds
+    # the ".sweep.lock" file of the first root.
+    def __init__(self, backend: BackendFiles, interval: float = 3600, abandoned_age: float = 0, election_interval: float = 60):
+        self.backend = backend
+        self.interval = interval
+        self.abandoned_age = abandoned_age
+        self.election_interval = election_interval
+        self._lock_fd = None
+        self.passes = 0
+        self.expired = 0
+        self.abandoned = 0
+        self.errors = 0
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def elect(self) -> bool:
+        if self._lock_fd is not None:
+            return True
+        self._lock_fd = try_lock(self.backend.roots[0].path / ".sweep.lock")
+        return self._lock_fd is not None
+
+    async def run(self):
+        if not self.enabled:
+            return
+        while True:
+            if not await asyncio.to_thread(self.elect):
+                await asyncio.sleep(self.election_interval)
+                continue
+            await self.sweep()
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self):
+        for root in self.backend.all_roots:
+            ids = await asyncio.to_thread(lambda: [id_ for id_, _ in iter_ids(root)])
+            for id_ in ids:
+                try:
+                    await self.check(id_)
+                except (FileNotFoundError, BackendErrorIDUnknown, BackendErrorFileLocked):
+                    # Deleted in the meantime, or being uploaded
+                    pass
+                except (OSError, BackendErrorInvalidMetadata):
+                    self.errors += 1
+        self.passes += 1
+
+    async def check(self, id_: FileID) -> bool:
+        # Returns True if the file has been deleted
+        f = self.backend.open(id_)
+        metadata = await asyncio.to_thread(lambda: f.metadata)
+        if metadata.complete:
+            if metadata.timeout_s == 0 or not ts_has_expired(metadata.timeout_ts):
+                return False
+            await asyncio.to_thread(f.delete)
+            self.expired += 1
+            return True
+
+        if not await asyncio.to_thread(self._is_abandoned, f):
+            return False
+        # Uploads being pushed to hold their write lock. It is checked again
+        # once the lock is held, as the upload might have been resumed or
+        # finished in the meantime.
+        async with f.lock_write():
+            f = self.backend.open(id_)
+            if not await asyncio.to_thread(self._is_abandoned, f):
+                return False
+            await asyncio.to_thread(f.delete)
+        self.abandoned += 1
+        return True
+
+    def _is_abandoned(self, f: BackendFile) -> bool:
+        if self.abandoned_age <= 0 or f.metadata.complete:
+            return False
+        last_write = os.stat(f.metadata_path).st_mtime
+        try:
+            last_write = max(last_write, os.stat(f.content_path).st_mtime)
+        except FileNotFoundError:
+            # Nothing has been pushed yet
+            pass
+        return time.time() - last_write >= self.abandoned_age
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'elected': self._lock_fd is not None,
+            'passes': self.passes,
+            'expired': self.expired,
+            'abandoned': self.abandoned,
+            'errors': self.errors
+        }
@@ -0,0 +1,199 @@
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+
+from .backend import FileID, BackendErrorIDUnknown, BackendErrorInvalidMetadata
+from .backend_files import BackendFiles, BackendFile, FilePaths, _mkstemp, _write_tmp, advise, open_noatime
+from .digest import BLOCK_SIZE, RollingDigest
+from .durability import DURABILITY_NONE, fsync_path
+from .locks import try_lock
+from .ratelimit import TokenBucket
+from .tools import iter_ids
+
+class Tiering:
+    # Moves complete files that haven't been accessed for "cold_age" seconds
+    # from the hot roots to the cold root of the backend, at "rate" bytes per
+    # second at most (0 means no limit). A pass runs every "interval" seconds,
+    # in the worker that holds the ".tier.lock" file of the first root.
+    #
+    # With "promote", cold files are moved back to their hot root when they
+    # are downloaded.
+    #
+    # Files are copied before being made visible in their new root, and are
+    # then unlinked from the old one, metadata first. A file deleted during
+    # its migration is detected (its metadata is already gone), and its copy
+    # is removed. Downloads of the old copy keep reading it until they are
+    # done. A migration interrupted by a crash leaves the file in both roots,
+    # and is finished by the next pass.
+    def __init__(self, backend: BackendFiles, cold_age: float = 30*24*3600, rate: int = 0, interval: float = 3600, promote: bool = False):
+        self.backend = backend
+        self.cold_age = cold_age
+        self.rate = rate
+        self.interval = interval
+        self.promote_on_access = promote
+        self._bucket = TokenBucket(rate, BLOCK_SIZE) if rate > 0 else None
+        self._lock_fd = None
+        self._promoting = set()
+        self.demoted = 0
+        self.promoted = 0
+        self.moved_bytes = 0
+        self.errors = 0
+
+    @property
+    def enabled(self):
+        return self.backend.cold_root is not None
+
+    def elect(self) -> bool:
+        if self._lock_fd is None:
+            self._lock_fd = try_lock(self.backend.roots[0].path / ".tier.lock")
+        return self._lock_fd is not None
+
+    async def run(self):
+        if not self.enabled:
+            return
+        while True:
+            if await asyncio.to_thread(self.elect):
+                await self.demote_all()
+            await asyncio.sleep(self.interval)
+
+    async def demote_all(self):
+        limit = time.time() - self.cold_age
+        for root in self.backend.roots:
+            ids = await asyncio.to_thread(lambda: list(iter_ids(root)))
+            for id_, metadata_path in ids:
+                try:
+                    stats = await asyncio.to_thread(os.stat, metadata_path.with_suffix(".content"))
+                    if stats.st_atime >= limit:
+                        continue
+                    await self.demote(id_)
+                except (FileNotFoundError, BackendErrorIDUnknown):
+                    # Incomplete upload, or deleted in the meantime
+                    pass
+                except (OSError, BackendErrorInvalidMetadata, ValueError):
+                    self.errors += 1
+
+    async def demote(self, id_: FileID) -> bool:
+        backend = self.backend
+        f = backend.open(id_)
+        if f.is_cold:
+            return False
+        return await self._move(f, backend.cold_paths(id_))
+
+    def promote(self, f: BackendFile):
+        # Called on access: the move is done in the background
+        if not (self.promote_on_access and f.is_cold) or f.id.bytes in self._promoting:
+            return
+        self._promoting.add(f.id.bytes)
+        asyncio.get_running_loop().create_task(self._promote(f.id))
+
+    async def _promote(self, id_: FileID):
+        try:
+            f = self.backend.open(id_)
+            if f.is_cold:
+                await self._move(f, self.backend._id_to_paths(id_))
+        except (FileNotFoundError, BackendErrorIDUnknown):
+            pass
+        except (OSError, BackendErrorInvalidMetadata, ValueError):
+            self.errors += 1
+        finally:
+            self._promoting.discard(id_.bytes)
+
+    async def _move(self, f: BackendFile, dest: FilePaths) -> bool:
+        # Filesystem calls can block on slow disks: they are run in threads,
+        # as are the reads and writes of the copy.
+        metadata = await asyncio.to_thread(lambda: f.metadata)
+        if not metadata.complete:
+            return False
+        size = (await asyncio.to_thread(os.stat, f.content_path)).st_size
+        if size > await asyncio.to_thread(dest.root.free_space):
+            return False
+        durable = self.backend.durability != DURABILITY_NONE
+        demote = dest.root is self.backend.cold_root
+        await asyncio.to_thread(dest.metadata.parent.mkdir, parents=True, exist_ok=True)
+        if not await asyncio.to_thread(dest.metadata.exists):
+            tmp = await self._copy(f.content_path, dest.content, metadata.digest, durable, drop=demote)
+            if not await asyncio.to_thread(self._install, tmp, dest, metadata, durable):
+                return False
+        if not await asyncio.to_thread(self._remove_source, f, dest, demote):
+            return False
+        if demote:
+            self.demoted += 1
+        else:
+            self.promoted += 1
+        self.moved_bytes += size
+        return True
+
+    def _install(self, tmp: str, dest: FilePaths, metadata, durable: bool) -> bool:
+        # The content is put in place first, so that the file only appears in
+        # its new root once it is complete. Returns False if the file has been
+        # moved concurrently by another worker.
+        os.rename(tmp, dest.content)
+        tmp = _write_tmp(dest.metadata, lambda fd: json.dump(metadata.jsonable(), fd), "w", sync=durable)
+        try:
+            os.link(tmp, dest.metadata)
+        except FileExistsError:
+            return False
+        finally:
+            os.unlink(tmp)
+        if durable:
+            fsync_path(dest.metadata.parent)
+        return True
+
+    def _remove_source(self, f: BackendFile, dest: FilePaths, demote: bool) -> bool:
+        # The modification time is kept, as it is used to validate caches.
+        # Promoted files have just been accessed.
+        stats = os.stat(f.content_path)
+        atime = stats.st_atime_ns if demote else time.time_ns()
+        os.utime(dest.content, ns=(atime, stats.st_mtime_ns))
+        try:
+            f.unlink_moved()
+        except BackendErrorIDUnknown:
+            # Deleted during the copy
+            dest.metadata.unlink(missing_ok=True)
+            dest.content.unlink(missing_ok=True)
+            return False
+        return True
+
+    async def _copy(self, src: Path, dst: Path, digest: str, durable: bool, drop: bool) -> str:
+        # Copies src next to dst, and checks the copy against the digest of
+        # the file. Returns the path of the copy. With "drop", the pages of
+        # both files are dropped from the page cache, as they are not going to
+        # be read soon.
+        rolling = RollingDigest()
+        fd, tmp = await asyncio.to_thread(_mkstemp, dst)
+        try:
+            with os.fdopen(fd, "wb") as fdst, os.fdopen(await asyncio.to_thread(open_noatime, src), "rb") as fsrc:
+                while True:
+                    data = await asyncio.to_thread(fsrc.read, BLOCK_SIZE)
+                    if len(data) == 0:
+                        break
+                    await asyncio.to_thread(fdst.write, data)
+                    await asyncio.to_thread(rolling.update, data)
+                    if self._bucket is not None:
+                        delay = self._bucket.take(len(data))
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                await asyncio.to_thread(fdst.flush)
+                if durable:
+                    await asyncio.to_thread(os.fsync, fdst.fileno())
+                if drop and self.backend.fadvise:
+                    await asyncio.to_thread(advise, fsrc.fileno(), 0, 0, "DONTNEED")
+                    await asyncio.to_thread(advise, fdst.fileno(), 0, 0, "DONTNEED")
+            if digest is not None and rolling.hexdigest() != digest:
+                raise OSError("digest mismatch while copying %s" % src)
+        except:
+            os.unlink(tmp)
+            raise
+        return tmp
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'elected': self._lock_fd is not None,
+            'demoted': self.demoted,
+            'promoted': self.promoted,
+            'moved_bytes': self.moved_bytes,
+            'errors': self.errors
+        }
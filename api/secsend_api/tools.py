@@ -0,0 +1,84 @@
+import errno
+import os
+import shutil
+from pathlib import Path
+
+from .backend import FileID
+from .backend_files import BackendFiles, _write_tmp
+from .roots import StorageRoot
+
+# Offline maintenance of the files backend. These functions must not be run
+# while a server is using the same storage roots.
+
+def iter_ids(root: StorageRoot):
+    # Yield (FileID, metadata path) for every file stored in a root
+    for dirpath, dirnames, filenames in os.walk(root.path):
+        # Skip the trash and other internal directories
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for name in filenames:
+            if not name.endswith(".metadata"):
+                continue
+            try:
+                id_ = FileID(bytes.fromhex(name[:-len(".metadata")]))
+            except ValueError:
+                continue
+            if len(id_.bytes) != FileID.ID_LEN:
+                continue
+            yield id_, Path(dirpath) / name
+
+def _move(src: Path, dst: Path):
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    # Different filesystems: copy under a temporary name, and rename it in
+    # place once it is complete.
+    def copy(f):
+        with open(src, "rb") as fsrc:
+            shutil.copyfileobj(fsrc, f, 1024*1024)
+    tmp = _write_tmp(dst, copy, "wb", sync=True)
+    try:
+        os.rename(tmp, dst)
+    except:
+        os.unlink(tmp)
+        raise
+    os.unlink(src)
+
+def rebalance(backend: BackendFiles, drain=(), dry_run: bool = False, log=print):
+    # Move every file to the root that owns it, e.g. after a root has been
+    # added. Files of the roots in "drain" (which must not be part of the
+    # backend anymore) are moved to the backend's roots.
+    moved = 0
+    errors = 0
+    for root in list(backend.roots) + list(drain):
+        for id_, metadata_path in iter_ids(root):
+            paths = backend._id_to_paths(id_)
+            if paths.root.path == root.path:
+                continue
+            log("%s: %s -> %s" % (id_, root.path, paths.root.path))
+            if dry_run:
+                moved += 1
+                continue
+            if paths.metadata.exists():
+                log("%s: error: already exists in %s" % (id_, paths.root.path))
+                errors += 1
+                continue
+            try:
+                paths.metadata.parent.mkdir(parents=True, exist_ok=True)
+                # The content is moved first, so that the file only appears
+                # in its new root once it is complete.
+                content_path = metadata_path.with_suffix(".content")
+                if content_path.exists():
+                    _move(content_path, paths.content)
+                digest_path = metadata_path.with_suffix(".digest")
+                if digest_path.exists():
+                    _move(digest_path, paths.metadata.with_suffix(".digest"))
+                _move(metadata_path, paths.metadata)
+                metadata_path.with_suffix(".lock").unlink(missing_ok=True)
+                moved += 1
+            except OSError as e:
+                log("%s: error: %s" % (id_, e))
+                errors += 1
+    return moved, errors
@@ -0,0 +1,159 @@
+import hashlib
+import mimetypes
+import os
+import re
+from email.utils import formatdate
+
+from sanic import response, exceptions
+
+from . import http_cache
+
+# Content encodings of the precompressed variants produced by the webapp
+# build, by order of preference.
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+# Assets whose name contains a content hash (like "main.0123456789abcdef0123.js")
+# never change: a new build produces new names.
+_HASHED = re.compile(r"\.[0-9a-f]{16,}\.[^.]+$")
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+class Asset:
+    def __init__(self, path: str, name: str):
+        self.path = path
+        self.cache_control = IMMUTABLE if _HASHED.search(name) else "no-cache"
+        self.content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.load()
+
+    def load(self):
+        # Everything is read once, so that serving an asset only costs a
+        # lookup. Missing variants are just not offered.
+        self.mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path, "rb") as f:
+            data = f.read()
+        tag = hashlib.blake2b(data, digest_size=16).hexdigest()
+        last_modified = formatdate(self.mtime / 1e9, usegmt=True)
+        self.variants = {None: (data, self._headers(tag, last_modified, None))}
+        for encoding, ext in ENCODINGS:
+            try:
+                with open(self.path + ext, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            self.variants[encoding] = (data, self._headers(tag, last_modified, encoding))
+
+    def _headers(self, tag: str, last_modified: str, encoding) -> dict:
+        # Each variant has its own strong validator
+        ret = {
+            "Cache-Control": self.cache_control,
+            "ETag": '"%s%s"' % (tag, "" if encoding is None else "-" + encoding),
+            "Last-Modified": last_modified,
+        }
+        if encoding is not None:
+            ret["Content-Encoding"] = encoding
+        return ret
+
+    def reload_if_changed(self):
+        try:
+            if os.stat(self.path).st_mtime_ns != self.mtime:
+                self.load()
+        except FileNotFoundError:
+            pass
+
+def accepted_encodings(header) -> set:
+    # Parses Accept-Encoding. Only the encodings we have variants for are of
+    # interest, so "identity" and the other ones are ignored.
+    if header is None:
+        return set()
+    ret = set()
+    star = None
+    explicit = set()
+    for item in header.split(","):
+        params = item.strip().split(";")
+        coding = params[0].strip().lower()
+        q = 1.0
+        for p in params[1:]:
+            k, _, v = p.strip().partition("=")
+            if k.strip().lower() == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        if coding == "*":
+            star = q > 0
+            continue
+        if coding == "x-gzip":
+            coding = "gzip"
+        explicit.add(coding)
+        if q > 0:
+            ret.add(coding)
+    if star:
+        ret.update(e for e, _ in ENCODINGS if e not in explicit)
+    return ret
+
+class Webapp:
+    # Serves the bundled webapp from memory. The build emits gzip and brotli
+    # variants of each asset next to it ("main.<hash>.js.br", ...), which are
+    # sent as is to clients that accept them: no compression happens at
+    # request time.
+    #
+    # Hashed assets are cached forever by clients. index.html, dl.html and the
+    # service worker are revalidated at each use, so that a new build is
+    # picked up right away.
+    def __init__(self, root: str, reload: bool = False):
+        self.root = root
+        self.reload = reload
+        self.assets = {}
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if any(filename.endswith(ext) for _, ext in ENCODINGS):
+                    continue
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, root).replace(os.sep, "/")
+                self.assets[name] = Asset(path, name)
+
+    def get(self, name: str) -> Asset:
+        asset = self.assets.get(name)
+        if asset is None:
+            if not self.reload:
+                raise exceptions.NotFound("file not found")
+            # Development mode: new assets appear with each build
+            path = os.path.join(self.root, *name.split("/"))
+            if ".." in name.split("/") or not os.path.isfile(path):
+                raise exceptions.NotFound("file not found")
+            asset = self.assets[name] = Asset(path, name)
+        elif self.reload:
+            asset.reload_if_changed()
+        return asset
+
+    def respond(self, request, name: str):
+        asset = self.get(name)
+        accepted = accepted_encodings(request.headers.get("accept-encoding"))
+        data, headers = asset.variants[None]
+        for encoding, _ in ENCODINGS:
+            if encoding in accepted and encoding in asset.variants:
+                data, headers = asset.variants[encoding]
+                break
+        headers = dict(headers)
+        if len(asset.variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        if http_cache.not_modified(request, headers):
+            return response.empty(status=304, headers=headers)
+        return response.raw(data, headers=headers, content_type=asset.content_type)
+
+def setup_webapp(app, root: str):
+    webapp = Webapp(root, reload=getattr(app.config, "WEBAPP_RELOAD", False))
+    app.ctx.webapp = webapp
+
+    async def index(request):
+        return webapp.respond(request, "index.html")
+
+    async def dl(request):
+        return webapp.respond(request, "dl.html")
+
+    async def asset(request, name: str):
+        return webapp.respond(request, name)
+
+    app.add_route(index, "/", methods=["GET", "HEAD"], name="webapp_index")
+    app.add_route(dl, "/dl", methods=["GET", "HEAD"], name="dl")
+    app.add_route(asset, "/<name:path>", methods=["GET", "HEAD"], name="webapp")
@@ -14,6 +14,9 @@ setup(name='secsend_api',
       author_email=about['__author_email__'],
       license=about['__license__'],
       packages=['secsend_api'],
+      scripts=[
+          'bin/secstore'
+      ],
       install_requires=[
           'jsonschema==4.15.*',
           'sanic==23.12.1'
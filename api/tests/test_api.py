@@ -1,6 +1,10 @@
 import pytest
+import asyncio
+import gzip
 import tempfile
 import base64
+import dataclasses
+import json
 import time
 import os
 from unittest.mock import patch
@@ -8,6 +12,15 @@ from unittest.mock import patch
 from secsend_api import declare_app
 from secsend_api.backend import RootID, BaseID, BackendErrorIDUnavailable
 from secsend_api.metadata import EncryptedFileMetadata
+from secsend_api.roots import StorageRoot
+from secsend_api.admission import AdmissionControl, ServerBusy
+from secsend_api.ratelimit import TokenBucket, RateLimiter
+from secsend_api.stream_timeouts import StreamTimeouts
+from secsend_api.webapp import accepted_encodings
+from secsend_api.digest import RollingDigest
+from sanic import exceptions
+
+pytest_plugins = ('pytest_asyncio',)
 
 METADATA = EncryptedFileMetadata(name=b"ENCRYPTED_NAME", mime_type=b"ENCRYPTED_MIME_TYPE", iv=b"\x00"*12, chunk_size=b"ENCRYPTED_CHUNK_SIZE", key_sign=b"")
 
@@ -21,6 +34,19 @@ def test_api_config(app_backend_files):
     _, response = app_backend_files.test_client.get("/v1/config")
     assert(response.status == 200)
     assert(response.json['filesize_limit'] == 0)
+    assert(response.json['chunk_size_preferred'] == 1024*1024)
+    assert(response.json['chunk_size_max'] == 16*1024*1024)
+
+def test_api_config_chunk_size():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        with patch.dict(os.environ, {'SECSEND_CHUNK_SIZE_PREFERRED': "4194304", 'SECSEND_CHUNK_SIZE_MAX': "67108864"}):
+            app = declare_app(backend_files_root=root)
+        _, response = app.test_client.get("/v1/config")
+        assert(response.json['chunk_size_preferred'] == 4*1024*1024)
+        assert(response.json['chunk_size_max'] == 64*1024*1024)
+        with patch.dict(os.environ, {'SECSEND_CHUNK_SIZE_PREFERRED': "4194304", 'SECSEND_CHUNK_SIZE_MAX': "1048576"}):
+            with pytest.raises(ValueError):
+                declare_app(backend_files_root=root)
 
 def test_api_invalid_metadata(app_backend_files):
     _, response = app_backend_files.test_client.post("/v1/upload/new", json={})
@@ -70,8 +96,10 @@ def test_api_upload_download_delete(app_backend_files):
     ret_metadata = d['metadata']
     assert(ret_metadata['complete'])
     del ret_metadata['complete']
-    ref = METADATA.jsonable()
+    assert(ret_metadata.pop('digest') == RollingDigest().update(data).hexdigest())
+    ref = METADATA.public_jsonable()
     del ref['complete']
+    del ref['digest']
     assert(ret_metadata == ref)
 
     _, response = client.get("/v1/download/%s" % id_)
@@ -196,3 +224,642 @@ def test_html_index(app_backend_files_html):
     assert(response.text == "hello")
     _, response = app_backend_files_html.test_client.get("/style.css")
     assert(response.text == "hello css")
+
+@pytest.fixture
+def app_backend_files_webapp():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        with tempfile.TemporaryDirectory(prefix="secsend_html_root") as html_root:
+            files = {
+                "index.html": b"index",
+                "index.html.gz": gzip.compress(b"index"),
+                "dl.html": b"dl",
+                "main.0123456789abcdef0123.js": b"js",
+                "main.0123456789abcdef0123.js.gz": gzip.compress(b"js"),
+                "main.0123456789abcdef0123.js.br": b"js brotli",
+            }
+            for name, data in files.items():
+                with open(os.path.join(html_root, name), "wb") as f:
+                    f.write(data)
+            app = declare_app(enable_cors=False, backend_files_root=root, html_root=html_root, timeout_s_valid=[0,1])
+            yield app
+
+def test_webapp_precompressed(app_backend_files_webapp):
+    client = app_backend_files_webapp.test_client
+    js = "/main.0123456789abcdef0123.js"
+    # HEAD requests, so that the test client doesn't try to decode the fake
+    # brotli variant
+    _, response = client.head(js, headers={"Accept-Encoding": "gzip, br"})
+    assert(response.headers["Content-Encoding"] == "br")
+    assert(response.headers["Vary"] == "Accept-Encoding")
+    assert(response.headers["Cache-Control"] == "public, max-age=31536000, immutable")
+    assert(response.headers["Content-Type"].startswith("text/javascript") or response.headers["Content-Type"].startswith("application/javascript"))
+    br_etag = response.headers["ETag"]
+    assert(response.headers["Content-Length"] == "9")
+    _, response = client.get(js, headers={"Accept-Encoding": "gzip, br;q=0"})
+    assert(response.headers["Content-Encoding"] == "gzip")
+    assert(response.headers["ETag"] != br_etag)
+    assert(response.body == b"js")
+    _, response = client.get(js, headers={"Accept-Encoding": "identity"})
+    assert("Content-Encoding" not in response.headers)
+    assert(response.body == b"js")
+    _, response = client.head(js, headers={"Accept-Encoding": "br", "If-None-Match": br_etag})
+    assert(response.status == 304)
+    _, response = client.get(js, headers={"Accept-Encoding": "gzip", "If-None-Match": br_etag})
+    assert(response.status == 200)
+
+    # Pages are revalidated, and only offer the variants that exist
+    _, response = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert(response.headers["Cache-Control"] == "no-cache")
+    assert(response.headers["Content-Encoding"] == "gzip")
+    assert(response.body == b"index")
+    _, response = client.get("/dl", headers={"Accept-Encoding": "gzip, br"})
+    assert("Content-Encoding" not in response.headers)
+    assert("Vary" not in response.headers)
+    assert(response.body == b"dl")
+    _, response = client.get("/dl", headers={"If-None-Match": response.headers["ETag"]})
+    assert(response.status == 304)
+
+    _, response = client.get("/unknown.js")
+    assert(response.status == 404)
+    _, response = client.get("/main.0123456789abcdef0123.js.br")
+    assert(response.status == 404)
+
+def test_webapp_accept_encoding():
+    assert(accepted_encodings(None) == set())
+    assert(accepted_encodings("gzip, deflate, br") == {"gzip", "deflate", "br"})
+    assert(accepted_encodings("br;q=0, *") == {"gzip"})
+    assert(accepted_encodings("*;q=0, gzip;q=0.5") == {"gzip"})
+    assert(accepted_encodings("x-gzip") == {"gzip"})
+
+@pytest.fixture
+def app_backend_files_offload():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        app = declare_app(enable_cors=False, backend_files_root=root, html_root=None, timeout_s_valid=[0,1], download_offload="x-accel-redirect", download_offload_location="/internal/")
+        yield app
+
+def test_api_download_offload(app_backend_files_offload):
+    client = app_backend_files_offload.test_client
+    _, response = client.post("/v1/upload/new", json=METADATA.jsonable())
+    rid = RootID.from_str(response.json['root_id'])
+    fid = rid.file_id()
+    _, response = client.post("/v1/upload/push/%s" % rid, data=b"hello world!")
+    assert(response.status == 200)
+    _, response = client.post("/v1/upload/finish/%s" % rid)
+    assert(response.status == 200)
+
+    _, response = client.get("/v1/download/%s" % fid)
+    assert(response.status == 200)
+    assert(response.body == b"")
+    backend = app_backend_files_offload.ctx.backend
+    relpath = backend.open(fid).content_path.relative_to(backend.roots[0].path)
+    assert(response.headers["X-Accel-Redirect"] == "/internal/%s" % relpath.as_posix())
+
+    _, response = client.get("/v1/download/%s" % fid, headers={"Range": "bytes=20-"})
+    assert(response.status == 416)
+    # The range doesn't apply to another version of the content
+    _, response = client.get("/v1/download/%s" % fid, headers={"Range": "bytes=20-", "If-Range": '"stale"'})
+    assert(response.status == 200)
+    assert(response.headers["X-Accel-Redirect"] == "/internal/%s" % relpath.as_posix())
+    assert("Content-Range" not in response.headers)
+
+def test_api_download_cache(app_backend_files):
+    client = app_backend_files.test_client
+    _, response = client.post("/v1/upload/new", json=METADATA.jsonable())
+    rid = RootID.from_str(response.json['root_id'])
+    id_ = str(rid.file_id())
+    data = b"hello world!"
+    _, response = client.post("/v1/upload/push/%s" % rid, data=data)
+
+    # Incomplete uploads can still change
+    _, response = client.get("/v1/metadata/%s" % id_)
+    assert(response.headers["Cache-Control"] == "no-store")
+    assert("ETag" not in response.headers)
+
+    _, response = client.post("/v1/upload/finish/%s" % rid)
+    _, response = client.get("/v1/metadata/%s" % id_)
+    assert(response.headers["Cache-Control"] == "no-cache")
+    etag = response.headers["ETag"]
+    # The digest computed during the upload is a strong validator
+    assert(etag == '"%s"' % response.json['metadata']['digest'])
+    _, response = client.get("/v1/metadata/%s" % id_, headers={"If-None-Match": etag})
+    assert(response.status == 304)
+
+    access = app_backend_files.ctx.backend.access
+    recorded = access.stats()['recorded']
+    _, response = client.head("/v1/download/%s" % id_)
+    assert(response.status == 200)
+    assert(response.headers["ETag"] == etag)
+    # HEAD requests don't count as accesses
+    assert(access.stats()['recorded'] == recorded)
+    assert(int(response.headers["Content-Length"]) == len(data))
+    last_modified = response.headers["Last-Modified"]
+
+    _, response = client.get("/v1/download/%s" % id_, headers={"If-None-Match": 'W/%s, "other"' % etag})
+    assert(response.status == 304)
+    _, response = client.get("/v1/download/%s" % id_, headers={"If-Modified-Since": last_modified})
+    assert(response.status == 304)
+
+    _, response = client.get("/v1/download/%s" % id_, headers={"Range": "bytes=6-", "If-Range": etag})
+    assert(response.status == 206)
+    assert(response.body == data[6:])
+    _, response = client.get("/v1/download/%s" % id_, headers={"Range": "bytes=6-", "If-Range": '"other"'})
+    assert(response.status == 200)
+    assert(response.body == data)
+    _, response = client.get("/v1/download/%s" % id_, headers={"Range": "bytes=2-4"})
+    assert(response.status == 206)
+    assert(response.body == data[2:5])
+
+def test_api_download_range_past_end():
+    # Ranges that go past the end of the content are clamped to it
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        with patch.dict(os.environ, {'SECSEND_CACHE_SIZE': "0"}):
+            app = declare_app(backend_files_root=root)
+        client = app.test_client
+        _, response = client.post("/v1/upload/new", json=METADATA.jsonable())
+        rid = RootID.from_str(response.json['root_id'])
+        id_ = str(rid.file_id())
+        data = b"0123456789"
+        client.post("/v1/upload/push/%s" % rid, data=data)
+        client.post("/v1/upload/finish/%s" % rid)
+
+        _, response = client.get("/v1/download/%s" % id_, headers={"Range": "bytes=5-100"})
+        assert(response.status == 206)
+        assert(response.body == b"56789")
+        assert(int(response.headers["Content-Length"]) == 5)
+        assert(response.headers["Content-Range"] == "bytes 5-9/10")
+        _, response = client.get("/v1/download/%s" % id_, headers={"Range": "bytes=-100"})
+        assert(response.status == 206)
+        assert(response.body == data)
+        assert(response.headers["Content-Range"] == "bytes 0-9/10")
+        _, response = client.get("/v1/download/%s" % id_, headers={"Range": "bytes=10-20"})
+        assert(response.status == 416)
+
+def test_api_download_metadata_headers(app_backend_files):
+    client = app_backend_files.test_client
+    _, response = client.post("/v1/upload/new", json=METADATA.jsonable())
+    rid = RootID.from_str(response.json['root_id'])
+    id_ = str(rid.file_id())
+    data = b"hello world!"
+    client.post("/v1/upload/push/%s" % rid, data=data)
+    client.post("/v1/upload/finish/%s" % rid)
+
+    _, response = client.get("/v1/metadata/%s" % id_)
+    ref = response.json
+
+    _, response = client.get("/v1/download/%s" % id_, headers={"Range": "bytes=4-"})
+    assert(response.status == 206)
+    assert(int(response.headers["X-Secsend-Size"]) == len(data))
+    metadata = json.loads(base64.b64decode(response.headers["X-Secsend-Metadata"]))
+    assert(metadata == ref['metadata'])
+
+def test_api_upload_oneshot(app_backend_files):
+    client = app_backend_files.test_client
+    _, response = client.get("/v1/config")
+    oneshot_limit = response.json['oneshot_size_limit']
+    assert(oneshot_limit > 0)
+
+    data = b"hello world!"
+    headers = {"X-Secsend-Metadata": base64.b64encode(json.dumps(METADATA.jsonable()).encode("ascii")).decode("ascii")}
+    _, response = client.post("/v1/upload/oneshot", data=data, headers=headers)
+    assert(response.status == 200)
+    rid = RootID.from_str(response.json['root_id'])
+    id_ = str(rid.file_id())
+
+    _, response = client.get("/v1/metadata/%s" % id_)
+    assert(response.status == 200)
+    assert(response.json['metadata']['complete'])
+    assert(response.json['size'] == len(data))
+    _, response = client.get("/v1/download/%s" % id_)
+    assert(response.body == data)
+
+    _, response = client.post("/v1/upload/push/%s" % rid, data=data)
+    assert(response.status == 400)
+
+    _, response = client.post("/v1/upload/oneshot", data=b"A"*(oneshot_limit+1), headers=headers)
+    assert(response.status == 400)
+    _, response = client.post("/v1/upload/oneshot", data=data)
+    assert(response.status == 400)
+
+def test_api_batch(app_backend_files):
+    client = app_backend_files.test_client
+    rids = []
+    for i in range(3):
+        _, response = client.post("/v1/upload/new", json=METADATA.jsonable())
+        rids.append(RootID.from_str(response.json['root_id']))
+    client.post("/v1/upload/push/%s" % rids[0], data=b"hello")
+    unk = RootID.generate()
+
+    ids = [str(rids[0].file_id()), str(rids[1]), str(unk.file_id()), "0"]
+    _, response = client.post("/v1/batch/metadata", json={'ids': ids})
+    assert(response.status == 200)
+    results = response.json['results']
+    assert([r['id'] for r in results] == ids)
+    assert([r['status'] for r in results] == [200, 200, 404, 400])
+    assert(results[0]['size'] == 5)
+    assert(not results[1]['metadata']['complete'])
+
+    ids = [str(rids[0]), str(rids[1].file_id()), str(unk)]
+    _, response = client.post("/v1/batch/delete", json={'ids': ids})
+    assert(response.status == 200)
+    assert([r['status'] for r in response.json['results']] == [200, 400, 404])
+    _, response = client.get("/v1/metadata/%s" % rids[0].file_id())
+    assert(response.status == 404)
+    _, response = client.get("/v1/metadata/%s" % rids[1].file_id())
+    assert(response.status == 200)
+
+    limit = app_backend_files.config.BATCH_SIZE_LIMIT
+    _, response = client.post("/v1/batch/metadata", json={'ids': [str(unk)]*(limit+1)})
+    assert(response.status == 400)
+    _, response = client.post("/v1/batch/metadata", json={})
+    assert(response.status == 400)
+
+def test_api_upload_declared_size(app_backend_files_sizelimit):
+    client = app_backend_files_sizelimit.test_client
+    metadata = METADATA.jsonable()
+    metadata['size'] = FILESIZE_LIMIT
+    _, response = client.post("/v1/upload/new", json=metadata)
+    assert(response.status == 400)
+
+    data = b"hello world!"
+    metadata['size'] = len(data)
+    _, response = client.post("/v1/upload/new", json=metadata)
+    assert(response.status == 200)
+    rid = RootID.from_str(response.json['root_id'])
+
+    _, response = client.get("/v1/metadata/%s" % rid.file_id())
+    assert(response.json['size'] == 0)
+    _, response = client.post("/v1/upload/push/%s" % rid, data=data[:4])
+    assert(response.status == 200)
+    _, response = client.post("/v1/upload/finish/%s" % rid)
+    assert(response.status == 400)
+    _, response = client.post("/v1/upload/push/%s" % rid, data=data[4:] + b"!")
+    assert(response.status == 400)
+    _, response = client.post("/v1/upload/push/%s" % rid, data=data[4:])
+    assert(response.status == 200)
+    _, response = client.post("/v1/upload/finish/%s" % rid)
+    assert(response.status == 200)
+
+def test_api_upload_declared_size_no_space(app_backend_files):
+    metadata = METADATA.jsonable()
+    metadata['size'] = 1<<62
+    _, response = app_backend_files.test_client.post("/v1/upload/new", json=metadata)
+    assert(response.status == 507)
+
+def test_api_admin_stats(app_backend_files):
+    client = app_backend_files.test_client
+    _, response = client.get("/v1/admin/stats")
+    assert(response.status == 404)
+
+    app_backend_files.config.ADMIN_TOKEN = "secret"
+    _, response = client.get("/v1/admin/stats", headers={"Authorization": "Bearer nope"})
+    assert(response.status == 401)
+    _, response = client.get("/v1/admin/stats", headers={"Authorization": "Bearer secret"})
+    assert(response.status == 200)
+    assert(response.json['deletion']['queue'] == 0)
+
+def test_api_multi_roots_offload():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as r0, tempfile.TemporaryDirectory(prefix="secsend_api") as r1:
+        app = declare_app(enable_cors=False, backend_files_root="%s,%s" % (r0, r1), html_root=None, download_offload="x-accel-redirect", download_offload_location="/internal")
+        client = app.test_client
+        backend = app.ctx.backend
+        seen = set()
+        for i in range(16):
+            _, response = client.post("/v1/upload/oneshot", content=b"hello", headers={"X-Secsend-Metadata": base64.b64encode(json.dumps(METADATA.jsonable()).encode("ascii")).decode("ascii")})
+            assert(response.status == 200)
+            fid = RootID.from_str(response.json['root_id']).file_id()
+            f = backend.open(fid)
+            idx = backend.roots.index(f.root)
+            seen.add(idx)
+            _, response = client.get("/v1/download/%s" % fid)
+            relpath = f.content_path.relative_to(f.root.path)
+            assert(response.headers["X-Accel-Redirect"] == "/internal/%d/%s" % (idx, relpath.as_posix()))
+        assert(seen == {0, 1})
+
+def test_api_multi_roots_full():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as r0, tempfile.TemporaryDirectory(prefix="secsend_api") as r1:
+        app = declare_app(enable_cors=False, backend_files_root="%s,%s" % (r0, r1), html_root=None)
+        full = app.ctx.backend.roots[0]
+        metadata = METADATA.jsonable()
+        metadata['size'] = 10
+        with patch.object(StorageRoot, "free_space", lambda self: 0 if self is full else 1<<20):
+            # New IDs are always placed on the root with free space left
+            for i in range(8):
+                _, response = app.test_client.post("/v1/upload/new", json=metadata)
+                assert(response.status == 200)
+                fid = RootID.from_str(response.json['root_id']).file_id()
+                assert(app.ctx.backend.root_of(fid) is not full)
+
+def test_api_download_memory_cache(app_backend_files):
+    client = app_backend_files.test_client
+    cache = app_backend_files.ctx.backend.cache
+    _, response = client.post("/v1/upload/new", json=METADATA.jsonable())
+    rid = RootID.from_str(response.json['root_id'])
+    fid = rid.file_id()
+    data = b"hello world!"
+    client.post("/v1/upload/push/%s" % rid, data=data)
+    client.post("/v1/upload/finish/%s" % rid)
+
+    _, response = client.get("/v1/download/%s" % fid)
+    assert(response.body == data)
+    assert(cache.stats()['misses'] == 1 and cache.stats()['size'] == len(data))
+    _, response = client.get("/v1/download/%s" % fid)
+    assert(response.body == data)
+    _, response = client.get("/v1/download/%s" % fid, headers={"Range": "bytes=6-"})
+    assert(response.status == 206)
+    assert(response.body == b"world!")
+    assert(response.headers["Content-Range"] == "bytes 6-11/12")
+    _, response = client.get("/v1/download/%s" % fid, headers={"Range": "bytes=6-100"})
+    assert(response.body == b"world!")
+    assert(response.headers["Content-Range"] == "bytes 6-11/12")
+    _, response = client.get("/v1/download/%s" % fid, headers={"Range": "bytes=20-"})
+    assert(response.status == 416)
+    assert(cache.stats()['hits'] == 3)
+
+    # Cached contents are subject to admission control too
+    downloads = app_backend_files.ctx.admission['download']
+    downloads.limit = 1
+    downloads.queue_size = 0
+    downloads.active = 1
+    _, response = client.get("/v1/download/%s" % fid)
+    assert(response.status == 503)
+    assert(cache.stats()['hits'] == 3)
+    downloads.active = 0
+
+    _, response = client.post("/v1/delete/%s" % rid)
+    assert(response.status == 200)
+    assert(cache.stats()['entries'] == 0)
+    _, response = client.get("/v1/download/%s" % fid)
+    assert(response.status == 404)
+
+def test_api_admission(app_backend_files):
+    client = app_backend_files.test_client
+    _, response = client.post("/v1/upload/new", json=METADATA.jsonable())
+    rid = RootID.from_str(response.json['root_id'])
+    fid = rid.file_id()
+    client.post("/v1/upload/push/%s" % rid, data=b"A"*(2<<20))
+    client.post("/v1/upload/finish/%s" % rid)
+
+    uploads = app_backend_files.ctx.admission['upload']
+    downloads = app_backend_files.ctx.admission['download']
+    downloads.limit = 1
+    downloads.queue_size = 0
+    # Simulate a running download
+    downloads.active = 1
+    _, response = client.get("/v1/download/%s" % fid)
+    assert(response.status == 503)
+    assert(response.headers["Retry-After"] == "1")
+    downloads.active = 0
+    _, response = client.get("/v1/download/%s" % fid)
+    assert(response.status == 200)
+    assert(len(response.body) == 2<<20)
+
+    uploads.per_client = 1
+    uploads._clients["127.0.0.1"] = 1
+    _, response = client.post("/v1/upload/push/%s" % rid, data=b"A")
+    assert(response.status == 503)
+
+    app_backend_files.config.ADMIN_TOKEN = "secret"
+    _, response = client.get("/v1/admin/stats", headers={"Authorization": "Bearer secret"})
+    stats = response.json['admission']
+    assert(stats['download']['rejected'] == 1 and stats['download']['admitted'] == 1 and stats['download']['active'] == 0)
+    assert(stats['upload']['rejected'] == 1)
+
+@pytest.mark.asyncio
+async def test_admission_queue():
+    admission = AdmissionControl(limit=2, per_client=1, queue_size=1, queue_timeout=0.5)
+    await admission.acquire("a")
+    await admission.acquire("b")
+    # Waits for "a" to finish
+    waiter = asyncio.create_task(admission.acquire("a"))
+    await asyncio.sleep(0.01)
+    assert(admission.stats()['queued'] == 1)
+    # The queue is full
+    with pytest.raises(ServerBusy):
+        await admission.acquire("c")
+    await admission.release("a")
+    await waiter
+    assert(admission.stats()['active'] == 2)
+    # Times out
+    with pytest.raises(ServerBusy):
+        await admission.acquire("b")
+    assert(admission.stats()['rejected'] == 2)
+
+def test_token_bucket():
+    with patch("time.monotonic", return_value=100.0) as now:
+        bucket = TokenBucket(rate=1000, burst=500)
+        assert(bucket.take(400) == 0)
+        # Debt of 400 bytes
+        assert(bucket.take(500) == pytest.approx(0.4))
+        now.return_value = 101.0
+        # Refilled up to the burst size
+        assert(bucket.take(500) == 0)
+        assert(bucket.take(1) > 0)
+
+def test_api_download_rate_limit(app_backend_files):
+    client = app_backend_files.test_client
+    _, response = client.post("/v1/upload/new", json=METADATA.jsonable())
+    rid = RootID.from_str(response.json['root_id'])
+    data = os.urandom(3<<20)
+    client.post("/v1/upload/push/%s" % rid, data=data)
+    client.post("/v1/upload/finish/%s" % rid)
+
+    app_backend_files.ctx.ratelimit['download'] = RateLimiter(per_client=4<<20, burst=1<<20)
+    start = time.monotonic()
+    _, response = client.get("/v1/download/%s" % rid.file_id())
+    assert(response.body == data)
+    # The first MB is sent as a burst
+    assert(time.monotonic() - start >= 0.4)
+    stats = app_backend_files.ctx.ratelimit['download'].stats()
+    assert(stats['delays'] > 0 and stats['clients'] == 0)
+
+class FakeStream:
+    def __init__(self, chunks, delay):
+        self.chunks = list(chunks)
+        self.delay = delay
+        self.keep_alive = True
+        self.request_body = True
+
+    async def read(self):
+        await asyncio.sleep(self.delay)
+        return self.chunks.pop(0) if self.chunks else None
+
+@pytest.mark.asyncio
+async def test_push_timeouts():
+    timeouts = StreamTimeouts(idle_timeout=0.1, min_rate=1000, window=0.2)
+    reader = timeouts.reader(FakeStream([b"A"*1000]*10, 0.01))
+    while await reader.read() is not None:
+        pass
+
+    stream = FakeStream([b"A"], 0.5)
+    with pytest.raises(exceptions.RequestTimeout):
+        await timeouts.reader(stream).read()
+    assert(not stream.keep_alive)
+
+    reader = timeouts.reader(FakeStream([b"A"]*100, 0.05))
+    with pytest.raises(exceptions.RequestTimeout):
+        while await reader.read() is not None:
+            pass
+    assert(timeouts.stats() == {'idle': 1, 'slow': 1})
+
+def test_cluster():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        members = os.path.join(root, "members.json")
+        with open(members, "w") as f:
+            json.dump({'nodes': [{'id': 0, 'url': "http://node0"}, {'id': 1, 'url': "http://node1/"}]}, f)
+        with patch.dict(os.environ, {'SECSEND_CLUSTER_MEMBERS': members, 'SECSEND_CLUSTER_NODE': "0"}):
+            app = declare_app(enable_cors=False, backend_files_root=os.path.join(root, "files"), html_root=None, timeout_s_valid=[0,1])
+        cluster = app.ctx.cluster
+        client = app.test_client
+
+        # New IDs carry the node that stores them
+        _, response = client.post("/v1/upload/new", json=METADATA.jsonable())
+        assert(response.status == 200)
+        rid = RootID.from_str(response.json['root_id'])
+        assert(rid.file_id().bytes[0] == 0)
+        _, response = client.get("/v1/metadata/%s" % rid.file_id())
+        assert(response.status == 200)
+
+        # IDs of other nodes are redirected
+        remote = RootID.generate()
+        while remote.file_id().bytes[0] != 1:
+            remote = RootID.generate()
+        _, response = client.get("/v1/download/%s?v=1" % remote.file_id(), allow_redirects=False)
+        assert(response.status == 307)
+        assert(response.headers['location'] == "http://node1/v1/download/%s?v=1" % remote.file_id())
+        _, response = client.post("/v1/upload/push/%s" % remote, content=b"data", allow_redirects=False)
+        assert(response.status == 307)
+        assert(response.headers['location'] == "http://node1/v1/upload/push/%s" % remote)
+
+        _, response = client.post("/v1/batch/metadata", json={'ids': [str(rid), str(remote)]})
+        assert(response.status == 200)
+        results = response.json['results']
+        assert(results[0]['status'] == 200)
+        assert(results[1]['status'] == 307 and results[1]['location'] == "http://node1")
+
+        # Uploads go to the least loaded node
+        cluster.update(1, {'uploads': 0, 'free': app.ctx.backend.free_space() + 1})
+        _, response = client.post("/v1/upload/new", json=METADATA.jsonable(), allow_redirects=False)
+        assert(response.status == 307)
+        assert(response.headers['location'] == "http://node1/v1/upload/new?node=1")
+        _, response = client.post("/v1/upload/new?node=0", json=METADATA.jsonable(), allow_redirects=False)
+        assert(response.status == 200)
+        app.ctx.admission['upload'].active = 0
+        cluster.update(1, {'uploads': 1, 'free': 0})
+        _, response = client.post("/v1/upload/new", json=METADATA.jsonable(), allow_redirects=False)
+        assert(response.status == 200)
+
+        _, response = client.get("/v1/cluster/status")
+        assert(response.json['node'] == 0 and response.json['uploads'] == 0 and response.json['free'] > 0)
+
+def test_cluster_legacy():
+    # Files stored by node 0 before cluster mode was enabled, whose IDs name
+    # node 1
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        members = os.path.join(root, "members.json")
+        with open(members, "w") as f:
+            json.dump({'nodes': [{'id': 0, 'url': "http://node0", 'legacy': True}, {'id': 1, 'url': "http://node1"}]}, f)
+        def declare_node(node):
+            with patch.dict(os.environ, {'SECSEND_CLUSTER_MEMBERS': members, 'SECSEND_CLUSTER_NODE': str(node)}):
+                return declare_app(enable_cors=False, backend_files_root=os.path.join(root, "files%d" % node), html_root=None, timeout_s_valid=[0,1])
+
+        app = declare_node(0)
+        legacy = RootID.generate()
+        while legacy.file_id().bytes[0] != 1:
+            legacy = RootID.generate()
+        backend0 = app.ctx.backend
+        backend0.create_complete(legacy.file_id(), dataclasses.replace(METADATA), b"data")
+        _, response = app.test_client.get("/v1/metadata/%s" % legacy.file_id())
+        assert(response.status == 200)
+        _, response = app.test_client.get("/v1/cluster/stored/%s" % legacy.file_id())
+        assert(response.json == {'stored': True})
+
+        # Node 1 looks the IDs it doesn't store up on the legacy node
+        app = declare_node(1)
+        def stored(url, fid, timeout):
+            assert(url == "http://node0")
+            return backend0.open(fid).metadata_path.exists()
+        with patch("secsend_api.cluster._fetch_stored", stored):
+            _, response = app.test_client.get("/v1/download/%s" % legacy.file_id(), allow_redirects=False)
+            assert(response.status == 307)
+            assert(response.headers['location'] == "http://node0/v1/download/%s" % legacy.file_id())
+            _, response = app.test_client.post("/v1/batch/metadata", json={'ids': [str(legacy)]})
+            assert(response.json['results'][0]['status'] == 307 and response.json['results'][0]['location'] == "http://node0")
+
+            unknown = RootID.generate()
+            while unknown.file_id().bytes[0] != 1:
+                unknown = RootID.generate()
+            _, response = app.test_client.get("/v1/metadata/%s" % unknown.file_id(), allow_redirects=False)
+            assert(response.status == 404)
+            # Unknown IDs are only looked up once
+            _, response = app.test_client.post("/v1/batch/metadata", json={'ids': [str(unknown)]})
+            assert(response.json['results'][0]['status'] == 404)
+            assert(app.ctx.cluster.stats()['probe_cached'] == 1)
+
+        # Probes of a batch request stop after the probe timeout
+        app.ctx.cluster._unknown.clear()
+        def slow(url, fid, timeout):
+            time.sleep(timeout)
+            return False
+        app.ctx.cluster.probe_timeout = 0.2
+        ids = []
+        for i in range(8):
+            rid = RootID.generate()
+            while rid.file_id().bytes[0] != 1:
+                rid = RootID.generate()
+            ids.append(str(rid))
+        with patch("secsend_api.cluster._fetch_stored", slow):
+            start = time.monotonic()
+            _, response = app.test_client.post("/v1/batch/metadata", json={'ids': ids})
+            assert(time.monotonic() - start < 2)
+        assert(all(r['status'] == 404 for r in response.json['results']))
+        # Timed out probes aren't remembered
+        assert(len(app.ctx.cluster._unknown) == 0)
+
+def test_quotas():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        with patch.dict(os.environ, {'SECSEND_QUOTA_BYTES': "100", 'SECSEND_QUOTA_UPLOADS': "1", 'SECSEND_QUOTA_KEY': "header:X-Remote-User"}):
+            app = declare_app(enable_cors=False, backend_files_root=root, html_root=None, timeout_s_valid=[0,1])
+        app.config.ADMIN_TOKEN = "secret"
+        client = app.test_client
+        alice = {"X-Remote-User": "alice"}
+        quotas = app.ctx.backend.quotas
+
+        _, response = client.post("/v1/upload/new", json=METADATA.jsonable(), headers=alice)
+        assert(response.status == 200)
+        rid = response.json['root_id']
+        _, response = client.post("/v1/upload/new", json=METADATA.jsonable(), headers=alice)
+        assert(response.status == 413)
+        # Other clients have their own quota
+        _, response = client.post("/v1/upload/new", json=METADATA.jsonable(), headers={"X-Remote-User": "bob"})
+        assert(response.status == 200)
+
+        _, response = client.post("/v1/upload/push/%s" % rid, content=b"A"*60)
+        assert(response.status == 200)
+        _, response = client.post("/v1/upload/finish/%s" % rid)
+        assert(response.status == 200)
+        assert(quotas.usage("user:alice") == {'owner': "user:alice", 'bytes': 60, 'uploads': 0})
+        # The owner isn't sent to clients
+        _, response = client.get("/v1/metadata/%s" % RootID.from_str(rid).file_id())
+        assert('owner' not in response.json['metadata'])
+
+        _, response = client.post("/v1/upload/new", json=dict(METADATA.jsonable(), size=50), headers=alice)
+        assert(response.status == 413)
+        _, response = client.post("/v1/upload/new", json=METADATA.jsonable(), headers=alice)
+        assert(response.status == 200)
+        rid2 = response.json['root_id']
+        _, response = client.post("/v1/upload/push/%s" % rid2, content=b"A"*50)
+        assert(response.status == 413)
+        _, response = client.post("/v1/upload/push/%s" % rid2, content=b"A"*40)
+        assert(response.status == 200)
+        assert(quotas.usage("user:alice")['bytes'] == 100)
+
+        _, response = client.post("/v1/delete/%s" % rid)
+        assert(response.status == 200)
+        _, response = client.post("/v1/delete/%s" % rid2)
+        assert(response.status == 200)
+        assert(quotas.usage("user:alice") == {'owner': "user:alice", 'bytes': 0, 'uploads': 0})
+
+        _, response = client.get("/v1/admin/quotas", headers={"Authorization": "Bearer secret"})
+        assert(response.status == 200)
+        assert(response.json['max_bytes'] == 100 and response.json['rejected'] == 3)
+        assert(sorted((c['owner'], c['uploads']) for c in response.json['clients']) == [("user:alice", 0), ("user:bob", 1)])
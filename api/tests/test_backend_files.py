@@ -1,9 +1,23 @@
 import pytest
 import tempfile
+import asyncio
+import sys
+import os
+import dataclasses
+from unittest.mock import patch
 
-from secsend_api.backend import RootID, FileID, BackendErrorIDExists, BackendErrorIDUnknown, BackendErrorFileLocked
+from secsend_api.backend import RootID, FileID, BackendErrorIDExists, BackendErrorIDUnknown, BackendErrorFileLocked, BackendErrorNoSpace, BackendErrorRootFull
 from secsend_api.metadata import EncryptedFileMetadata
 from secsend_api.backend_files import BackendFiles
+from secsend_api.roots import StorageRoot
+from secsend_api.tools import rebalance
+from secsend_api.digest import RollingDigest, file_digest
+from secsend_api.scrubber import Scrubber
+from secsend_api.fsck import fsck, POLICIES
+from secsend_api.tiering import Tiering
+from secsend_api.sweeper import Sweeper
+from secsend_api.quota import Quotas
+from secsend_api.durability import GroupCommit
 
 pytest_plugins = ('pytest_asyncio',)
 
@@ -46,3 +60,583 @@ def test_read_unk(backend):
         # Force calling the metadata, otherwise it is lazy loaded and no
         # exception happens
         backend.open(fid).metadata
+
+@pytest.mark.asyncio
+async def test_create_declared_size(backend):
+    fid = RootID.generate().file_id()
+    metadata = dataclasses.replace(METADATA, declared_size=1024*1024)
+    f = backend.create(fid, metadata)
+    # Preallocation must not change the size, which is the resume offset
+    assert(f.size == 0)
+    async with f.stream_append() as s:
+        await s.write(b"coucou")
+    assert(backend.open(fid).size == 6)
+
+def test_create_no_space(backend):
+    fid = RootID.generate().file_id()
+    with pytest.raises(BackendErrorNoSpace):
+        backend.create(fid, dataclasses.replace(METADATA, declared_size=1<<62))
+    with pytest.raises(BackendErrorIDUnknown):
+        backend.open(fid).metadata
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("durability", ["none", "finish", "periodic"])
+async def test_append_durability(durability):
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        backend = BackendFiles(root, durability=durability, write_buffer_size=16, sync_interval=0.01)
+        fid = RootID.generate().file_id()
+        f = backend.create(fid, dataclasses.replace(METADATA))
+        data = bytes(range(100))
+        async with f.stream_append() as s:
+            for i in range(0, len(data), 7):
+                await s.write(data[i:i+7])
+                # Only whole buffers are written before the end
+                assert(f.size % 16 == 0)
+        async with f.stream_append() as s:
+            await s.write(data)
+        f.set_as_complete()
+
+        f = backend.open(fid)
+        assert(f.metadata.complete)
+        async with f.stream_read() as s:
+            assert(await s.read() == data*2)
+        if durability == "periodic":
+            assert(backend.group_commit.fsyncs == 2)
+
+@pytest.mark.asyncio
+async def test_group_commit_cancelled():
+    gc = GroupCommit(0.05)
+    with tempfile.TemporaryFile() as f:
+        task = asyncio.create_task(gc.sync(f.fileno()))
+        await asyncio.sleep(0)
+        task.cancel()
+    # The file has been closed, and its descriptor number can be reused by
+    # another file before the group commit happens
+    with tempfile.TemporaryFile() as f:
+        await gc.sync(f.fileno())
+        assert(os.fstat(f.fileno()))
+    assert(gc.commits == 1)
+    assert(gc.fsyncs == 2)
+
+@pytest.mark.asyncio
+async def test_lock_stale(backend):
+    fid = RootID.generate().file_id()
+    f = backend.create(fid, dataclasses.replace(METADATA))
+    # Lock file left behind by a killed worker
+    open(f.lock_path, "w").close()
+    async with f.lock_write(): pass
+    # The lock file is kept until the upload is complete
+    assert(f.lock_path.exists())
+    async with f.lock_write():
+        f.set_as_complete()
+    assert(not f.lock_path.exists())
+
+@pytest.mark.asyncio
+async def test_lock_other_process(backend):
+    fid = RootID.generate().file_id()
+    f = backend.create(fid, METADATA)
+    async with f.lock_write(): pass
+    proc = await asyncio.create_subprocess_exec(sys.executable, "-c",
+        "import fcntl,sys,time; f=open(sys.argv[1],'r+'); fcntl.flock(f, fcntl.LOCK_EX); print('ok', flush=True); time.sleep(60)",
+        str(f.lock_path), stdout=asyncio.subprocess.PIPE)
+    assert(await proc.stdout.readline() == b"ok\n")
+    try:
+        with pytest.raises(BackendErrorFileLocked):
+            async with f.lock_write(): pass
+    finally:
+        proc.kill()
+        await proc.wait()
+    async with f.lock_write(): pass
+
+@pytest.mark.asyncio
+async def test_lock_wait():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        backend = BackendFiles(root, lock_timeout=5)
+        fid = RootID.generate().file_id()
+        f = backend.create(fid, METADATA)
+        order = []
+        async def hold():
+            async with f.lock_write():
+                order.append(1)
+                await asyncio.sleep(0.1)
+            order.append(2)
+        task = asyncio.create_task(hold())
+        await asyncio.sleep(0.01)
+        async with backend.open(fid).lock_write():
+            order.append(3)
+        await task
+        assert(order == [1, 2, 3])
+
+@pytest.mark.asyncio
+async def test_delete_background(backend):
+    fid = RootID.generate().file_id()
+    f = backend.create(fid, METADATA)
+    async with f.stream_append() as s:
+        await s.write(b"coucou")
+    backend.open(fid).delete()
+    with pytest.raises(BackendErrorIDUnknown):
+        backend.open(fid).metadata
+    assert(backend.stats()['deletion']['queue'] == 2)
+    assert(len(list(backend.roots[0].trash_dir.iterdir())) == 2)
+
+    await backend.reaper.reap()
+    assert(backend.stats()['deletion']['queue'] == 0)
+    assert(len(list(backend.roots[0].trash_dir.iterdir())) == 0)
+
+    with pytest.raises(BackendErrorIDUnknown):
+        backend.open(fid).delete()
+
+@pytest.mark.asyncio
+async def test_delete_while_downloading(backend):
+    # Downloads in progress keep reading the deleted content until the end
+    fid = RootID.generate().file_id()
+    f = backend.create(fid, METADATA)
+    data = os.urandom(1024*1024)
+    async with f.stream_append() as s:
+        await s.write(data)
+    f = backend.open(fid)
+    chunks = f.stream_range(0, len(data), 64*1024)
+    received = await chunks.__anext__()
+    f.delete()
+    await backend.reaper.reap()
+    assert(len(list(backend.roots[0].trash_dir.iterdir())) == 0)
+    async for chunk in chunks:
+        received += chunk
+    assert(received == data)
+
+@pytest.mark.asyncio
+async def test_delete_leftovers(backend):
+    # Files left in the trash by a previous run are removed on startup
+    fid = RootID.generate().file_id()
+    backend.create(fid, METADATA).delete()
+    backend = BackendFiles(backend.roots[0].path)
+    assert(backend.stats()['deletion']['queue'] == 1)
+    await backend.reaper.reap()
+    assert(len(list(backend.roots[0].trash_dir.iterdir())) == 0)
+
+def test_multi_roots():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as r0, tempfile.TemporaryDirectory(prefix="secsend_api") as r1:
+        backend = BackendFiles("%s,%s:3" % (r0, r1))
+        assert([r.weight for r in backend.roots] == [1, 3])
+        counts = [0, 0]
+        for i in range(400):
+            fid = RootID.generate().file_id()
+            f = backend.create(fid, dataclasses.replace(METADATA))
+            counts[backend.roots.index(f.root)] += 1
+            assert(f.content_path.is_relative_to(f.root.path))
+            assert(backend.open(fid).metadata == METADATA)
+        # Weights are respected
+        assert(200 < counts[1] < 400)
+
+        # Placement doesn't depend on the order of the roots, nor on their
+        # paths
+        backend2 = BackendFiles([StorageRoot(r1, 3), StorageRoot(r0)])
+        fid = RootID.generate().file_id()
+        assert(backend.root_of(fid).path == backend2.root_of(fid).path)
+
+def test_multi_roots_full():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as r0, tempfile.TemporaryDirectory(prefix="secsend_api") as r1:
+        backend = BackendFiles([r0, r1])
+        full = backend.roots[0]
+        with patch.object(StorageRoot, "free_space", lambda self: 0 if self is full else 1<<20):
+            fid = RootID.generate().file_id()
+            while backend.root_of(fid) is not full:
+                fid = RootID.generate().file_id()
+            with pytest.raises(BackendErrorRootFull):
+                backend.create(fid, dataclasses.replace(METADATA, declared_size=10))
+            with pytest.raises(BackendErrorNoSpace):
+                backend.create(fid, dataclasses.replace(METADATA, declared_size=1<<30))
+            with pytest.raises(BackendErrorRootFull):
+                backend.create_complete(fid, dataclasses.replace(METADATA), b"coucou")
+
+def test_rebalance():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as r0, tempfile.TemporaryDirectory(prefix="secsend_api") as r1:
+        backend = BackendFiles(r0)
+        fids = [RootID.generate().file_id() for _ in range(20)]
+        for fid in fids:
+            backend.create_complete(fid, dataclasses.replace(METADATA), fid.bytes)
+        backend.create(RootID.generate().file_id(), dataclasses.replace(METADATA))
+
+        # Add a root
+        backend = BackendFiles([r0, r1])
+        moved, errors = rebalance(backend, log=lambda _: None)
+        assert(errors == 0 and 0 < moved < 21)
+        assert(rebalance(backend, log=lambda _: None) == (0, 0))
+        for fid in fids:
+            f = backend.open(fid)
+            assert(f.metadata.complete)
+            assert(f.content_path.read_bytes() == fid.bytes)
+
+        # Remove it
+        backend = BackendFiles(r0)
+        moved, errors = rebalance(backend, drain=[StorageRoot(r1)], log=lambda _: None)
+        assert(errors == 0 and moved > 0)
+        for fid in fids:
+            assert(backend.open(fid).content_path.read_bytes() == fid.bytes)
+
+@pytest.mark.asyncio
+async def test_content_cache():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        backend = BackendFiles(root, cache_size=25, cache_max_object_size=16)
+        files = []
+        for size in (10, 10, 10, 20):
+            fid = RootID.generate().file_id()
+            files.append(backend.create_complete(fid, dataclasses.replace(METADATA), bytes(size)))
+
+        async def get(f):
+            return await f.cached_content(os.stat(f.content_path))
+        assert(await get(files[3]) is None)
+        assert(await asyncio.gather(get(files[0]), get(files[0])) == [bytes(10)]*2)
+        await get(files[1])
+        await get(files[0])
+        # The least recently used file is evicted
+        await get(files[2])
+        stats = backend.cache.stats()
+        assert(stats['entries'] == 2 and stats['size'] == 20 and stats['evictions'] == 1)
+        assert(stats['hits'] == 1 and stats['misses'] == 4)
+        await get(files[0])
+        assert(backend.cache.stats()['hits'] == 2)
+
+        # Expired files are removed from the cache
+        files[0].metadata.timeout_s = 1
+        files[0].metadata.timeout_ts = 1
+        with pytest.raises(BackendErrorIDUnknown):
+            files[0].check_validity()
+        assert(backend.cache.stats()['entries'] == 1)
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not hasattr(os, "posix_fadvise"), reason="posix_fadvise not available")
+async def test_stream_range_fadvise():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        backend = BackendFiles(root, fadvise_drop_threshold=64)
+        fid = RootID.generate().file_id()
+        data = bytes(range(100))
+        f = backend.create(fid, dataclasses.replace(METADATA))
+        async with f.stream_append() as s:
+            await s.write(data)
+
+        calls = []
+        with patch("os.posix_fadvise", lambda fd, offset, length, advice: calls.append((offset, length, advice))):
+            chunks = [c async for c in f.stream_range(10, 80, 32)]
+            assert(chunks == [data[10:42], data[42:74], data[74:90]])
+            assert(calls[:2] == [(10, 80, os.POSIX_FADV_SEQUENTIAL), (10, 32, os.POSIX_FADV_WILLNEED)])
+            assert((42, 32, os.POSIX_FADV_WILLNEED) in calls)
+            assert((10, 32, os.POSIX_FADV_DONTNEED) in calls)
+            assert(calls[-1] == (10, 80, os.POSIX_FADV_DONTNEED))
+
+            # Small ranges are kept in the cache
+            calls.clear()
+            assert([c async for c in f.stream_range(0, 10, 32)] == [data[:10]])
+            assert(all(advice != os.POSIX_FADV_DONTNEED for _, _, advice in calls))
+
+            # Uploads are dropped once finished
+            calls.clear()
+            f.set_as_complete()
+            assert(calls == [(0, 0, os.POSIX_FADV_DONTNEED)])
+
+        backend.fadvise = False
+        calls.clear()
+        with patch("os.posix_fadvise", lambda fd, offset, length, advice: calls.append((offset, length, advice))):
+            assert(b"".join([c async for c in f.stream_range(0, 100, 32)]) == data)
+        assert(calls == [])
+
+@pytest.mark.asyncio
+async def test_upload_digest():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root, patch("secsend_api.digest.BLOCK_SIZE", 16):
+        backend = BackendFiles(root, write_buffer_size=8)
+        fid = RootID.generate().file_id()
+        data = os.urandom(100)
+        f = backend.create(fid, dataclasses.replace(METADATA))
+        async with f.stream_append() as s:
+            await s.write(data[:30])
+        assert(os.path.getsize(f.digest_path) == 32)
+        # Resumed by this worker
+        async with f.stream_append() as s:
+            await s.write(data[30:50])
+        assert(backend.digests.rebuilds == 1)
+        # Resumed by another worker, after a crash that lost the last block
+        # digest
+        os.truncate(f.digest_path, 32*2)
+        other = BackendFiles(root, write_buffer_size=8)
+        f = other.open(fid)
+        async with f.stream_append() as s:
+            await s.write(data[50:])
+        assert(other.digests.rebuilds == 1)
+        assert(os.path.getsize(f.digest_path) == 32*6)
+
+        f.set_as_complete()
+        assert(f.metadata.digest == RollingDigest().update(data).hexdigest())
+        assert(f.metadata.digest == file_digest(f.content_path))
+        assert(not f.digest_path.exists())
+        assert(backend.open(fid).metadata.digest == f.metadata.digest)
+
+        fid = RootID.generate().file_id()
+        f = backend.create_complete(fid, dataclasses.replace(METADATA), data)
+        assert(f.metadata.digest == file_digest(f.content_path))
+
+@pytest.mark.asyncio
+async def test_file_modes(backend):
+    # Files created in one go get the same mode as streamed ones, so that a
+    # reverse proxy can serve both
+    streamed = backend.create(RootID.generate().file_id(), dataclasses.replace(METADATA))
+    async with streamed.stream_append() as s:
+        await s.write(b"data")
+    streamed.set_as_complete()
+    oneshot = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(METADATA), b"data")
+    mask = os.umask(0)
+    os.umask(mask)
+    for f in (streamed, oneshot):
+        for path in (f.content_path, f.metadata_path):
+            assert(os.stat(path).st_mode & 0o777 == 0o666 & ~mask)
+
+@pytest.mark.asyncio
+async def test_scrubber():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        backend = BackendFiles(root)
+        good = RootID.generate().file_id()
+        backend.create_complete(good, dataclasses.replace(METADATA), b"good")
+        bad = RootID.generate().file_id()
+        f = backend.create_complete(bad, dataclasses.replace(METADATA), b"bad")
+        with open(f.content_path, "r+b") as fd:
+            fd.write(b"B")
+        # Uploaded before digests existed
+        legacy = RootID.generate().file_id()
+        f = backend.create(legacy, dataclasses.replace(METADATA))
+        async with f.stream_append() as s:
+            await s.write(b"legacy")
+
+        scrubber = Scrubber(backend, rate=1024*1024)
+        assert(scrubber.elect())
+        assert(not Scrubber(backend, rate=1024*1024).elect())
+        await scrubber.scrub()
+        stats = scrubber.stats()
+        assert(stats['files'] == 2)
+        assert([c['id'] for c in stats['corrupted']] == [str(bad)])
+        with pytest.raises(BackendErrorIDUnknown):
+            backend.open(bad).metadata
+        assert(backend.open(good).metadata.complete)
+        assert(len(list((backend.roots[0].path / ".quarantine").iterdir())) == 2)
+
+@pytest.mark.asyncio
+async def test_scrubber_quotas():
+    # Quarantined files don't count against quotas anymore
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        quotas = Quotas(os.path.join(root, ".quotas"), max_bytes=100)
+        backend = BackendFiles(root, quotas=quotas)
+        owned = dataclasses.replace(METADATA, owner="ip:127.0.0.1")
+        backend.create_complete(RootID.generate().file_id(), dataclasses.replace(owned), b"good")
+        f = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(owned), b"bad")
+        with open(f.content_path, "r+b") as fd:
+            fd.write(b"B")
+        assert(quotas.usage("ip:127.0.0.1")['bytes'] == 7)
+
+        await Scrubber(backend, rate=1024*1024).scrub()
+        assert(quotas.usage("ip:127.0.0.1") == {'owner': "ip:127.0.0.1", 'bytes': 4, 'uploads': 0})
+
+@pytest.mark.asyncio
+async def test_sweeper():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        quotas = Quotas(os.path.join(root, ".quotas"), max_bytes=100)
+        backend = BackendFiles(root, quotas=quotas)
+        owned = dataclasses.replace(METADATA, owner="ip:127.0.0.1")
+        expired = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(owned, timeout_s=1), b"expired")
+        kept = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(owned), b"kept")
+        abandoned = backend.create(RootID.generate().file_id(), dataclasses.replace(owned))
+        async with abandoned.stream_append() as s:
+            await s.write(b"abandoned")
+        for path in (abandoned.metadata_path, abandoned.content_path):
+            os.utime(path, (1000, 1000))
+        recent = backend.create(RootID.generate().file_id(), dataclasses.replace(owned))
+        async with recent.stream_append() as s:
+            await s.write(b"recent")
+        # Being pushed to
+        pushed = backend.create(RootID.generate().file_id(), dataclasses.replace(owned))
+        os.utime(pushed.metadata_path, (1000, 1000))
+        assert(quotas.usage("ip:127.0.0.1") == {'owner': "ip:127.0.0.1", 'bytes': 26, 'uploads': 3})
+
+        # Abandoned uploads are kept by default
+        default = Sweeper(backend)
+        assert(not await default.check(abandoned.id))
+        assert(default.stats()['abandoned'] == 0)
+
+        sweeper = Sweeper(backend, abandoned_age=3600)
+        assert(sweeper.elect())
+        assert(not Sweeper(backend).elect())
+        with patch("secsend_api.sweeper.ts_has_expired", lambda ts: ts == expired.metadata.timeout_ts):
+            async with backend.open(pushed.id).lock_write():
+                await sweeper.sweep()
+        stats = sweeper.stats()
+        assert(stats['expired'] == 1 and stats['abandoned'] == 1 and stats['errors'] == 0)
+        for f in (expired, abandoned):
+            with pytest.raises(BackendErrorIDUnknown):
+                backend.open(f.id).metadata
+        for f in (kept, recent, pushed):
+            backend.open(f.id).metadata
+        assert(quotas.usage("ip:127.0.0.1") == {'owner': "ip:127.0.0.1", 'bytes': 10, 'uploads': 2})
+
+        await sweeper.sweep()
+        assert(sweeper.stats()['abandoned'] == 2)
+        assert(quotas.usage("ip:127.0.0.1")['uploads'] == 1)
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("policy", POLICIES)
+async def test_fsck(policy):
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as root:
+        backend = BackendFiles(root)
+        good = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(METADATA), b"good")
+        incomplete = backend.create(RootID.generate().file_id(), dataclasses.replace(METADATA))
+        async with incomplete.lock_write(), incomplete.stream_append() as s:
+            await s.write(b"data")
+        # Debris of an unclean shutdown
+        tmp = good.content_path.parent / (good.content_path.name + "abcd_123")
+        tmp.write_bytes(b"tmp")
+        good.lock_path.write_bytes(b"")
+        orphan = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(METADATA), b"orphan")
+        os.unlink(orphan.metadata_path)
+        missing = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(METADATA), b"missing")
+        os.unlink(missing.content_path)
+        empty = backend.create(RootID.generate().file_id(), dataclasses.replace(METADATA))
+        empty.set_as_complete()
+        invalid = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(METADATA), b"invalid")
+        invalid.metadata_path.write_bytes(b"\xff")
+        expired = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(METADATA, timeout_s=1), b"expired")
+        with patch("secsend_api.fsck.ts_has_expired", lambda ts: ts == expired.metadata.timeout_ts):
+            lines = []
+            counts = fsck(backend, policy=policy, jobs=4, log=lines.append)
+        assert(counts['ok'] == 1)
+        assert(counts['incomplete'] == 1)
+        for category in ("tmp", "orphan_lock", "orphan_content", "missing_content", "empty_content", "invalid_metadata", "expired"):
+            assert(counts[category] == 1)
+        assert(counts['errors'] == 0)
+        assert(len(lines) == 7)
+
+        quarantine = backend.roots[0].path / ".quarantine"
+        if policy == "report":
+            assert(tmp.exists() and good.lock_path.exists() and orphan.content_path.exists())
+            assert(not quarantine.exists())
+            return
+        assert(not tmp.exists() and not good.lock_path.exists())
+        assert(backend.open(good.id).metadata.complete)
+        assert(incomplete.lock_path.exists())
+        assert(empty.content_path.read_bytes() == b"")
+        for f in (orphan, missing, invalid):
+            assert(not f.metadata_path.exists() and not f.content_path.exists())
+        if policy == "repair":
+            assert(counts['fixed'] == 6)
+            assert(len(list(quarantine.iterdir())) == 4)
+            assert(expired.content_path.exists())
+        else:
+            assert(counts['fixed'] == 7)
+            assert(not quarantine.exists())
+            assert(not expired.content_path.exists())
+            assert(counts['empty_dirs'] > 0)
+            assert(not orphan.content_path.parent.exists())
+        assert(fsck(backend, policy=policy, log=lambda _: None)['fixed'] == 0)
+
+@pytest.mark.asyncio
+async def test_access_tracker(backend):
+    f = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(METADATA), b"data")
+    os.utime(f.content_path, (1000, 2000))
+    f.touch()
+    assert(os.stat(f.content_path).st_atime == 1000)
+    await backend.access.flush()
+    stats = os.stat(f.content_path)
+    assert(stats.st_atime > 1000)
+    assert(stats.st_mtime == 2000)
+    assert(backend.access.stats()['flushed'] == 1)
+
+@pytest.mark.asyncio
+async def test_tiering():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as hot, tempfile.TemporaryDirectory(prefix="secsend_api") as cold:
+        backend = BackendFiles(hot, cold_root=cold)
+        tiering = Tiering(backend, cold_age=3600, promote=True)
+        old = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(METADATA), b"old")
+        os.utime(old.content_path, (1000, 2000))
+        recent = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(METADATA), b"recent")
+        incomplete = backend.create(RootID.generate().file_id(), dataclasses.replace(METADATA))
+        async with incomplete.stream_append() as s:
+            await s.write(b"data")
+        os.utime(incomplete.content_path, (1000, 2000))
+
+        assert(tiering.elect())
+        await tiering.demote_all()
+        assert(tiering.stats()['demoted'] == 1)
+        f = backend.open(old.id)
+        assert(f.is_cold)
+        assert(f.content_path.read_bytes() == b"old")
+        assert(os.stat(f.content_path).st_mtime == 2000)
+        assert(os.stat(f.content_path).st_mode == os.stat(recent.content_path).st_mode)
+        assert(not old.metadata_path.exists())
+        assert(not backend.open(recent.id).is_cold)
+        assert(not backend.open(incomplete.id).is_cold)
+        with pytest.raises(BackendErrorIDExists):
+            backend.create(old.id, dataclasses.replace(METADATA))
+
+        # Promoted when accessed
+        tiering.promote(f)
+        while tiering.stats()['promoted'] == 0:
+            await asyncio.sleep(0.01)
+        f = backend.open(old.id)
+        assert(not f.is_cold)
+        assert(f.content_path.read_bytes() == b"old")
+        assert(os.stat(f.content_path).st_atime > 1000)
+
+        # Cold files can be deleted
+        await tiering.demote(old.id)
+        f = backend.open(old.id)
+        assert(f.is_cold)
+        f.delete()
+        with pytest.raises(BackendErrorIDUnknown):
+            backend.open(old.id).metadata
+
+@pytest.mark.asyncio
+async def test_tiering_while_downloading():
+    # Downloads of a file being moved keep reading its old copy
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as hot, tempfile.TemporaryDirectory(prefix="secsend_api") as cold:
+        backend = BackendFiles(hot, cold_root=cold)
+        tiering = Tiering(backend, promote=True)
+        data = os.urandom(1024*1024)
+        f = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(METADATA), data)
+        await tiering.demote(f.id)
+        f = backend.open(f.id)
+        assert(f.is_cold)
+
+        chunks = f.stream_range(0, len(data), 64*1024)
+        received = await chunks.__anext__()
+        tiering.promote(f)
+        while tiering.stats()['promoted'] == 0:
+            await asyncio.sleep(0.01)
+        assert(not backend.open(f.id).is_cold)
+        assert(not f.content_path.exists())
+        assert(not backend.cold_root.trash_dir.exists())
+        async for chunk in chunks:
+            received += chunk
+        assert(received == data)
+
+@pytest.mark.asyncio
+async def test_scrubbed_files_become_cold():
+    # Reading files back in the background must not count as accesses
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as hot, tempfile.TemporaryDirectory(prefix="secsend_api") as cold:
+        backend = BackendFiles(hot, cold_root=cold)
+        f = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(METADATA), b"old")
+        os.utime(f.content_path, (1000, 2000))
+        await Scrubber(backend, rate=1024*1024).scrub()
+        assert(os.stat(f.content_path).st_atime == 1000)
+
+        tiering = Tiering(backend, cold_age=3600)
+        await tiering.demote_all()
+        assert(tiering.stats()['demoted'] == 1)
+        f = backend.open(f.id)
+        assert(f.is_cold)
+        assert(os.stat(f.content_path).st_atime == 1000)
+
+@pytest.mark.asyncio
+async def test_tiering_corrupted_copy():
+    with tempfile.TemporaryDirectory(prefix="secsend_api") as hot, tempfile.TemporaryDirectory(prefix="secsend_api") as cold:
+        backend = BackendFiles(hot, cold_root=cold)
+        f = backend.create_complete(RootID.generate().file_id(), dataclasses.replace(METADATA), b"data")
+        f.content_path.write_bytes(b"DATA")
+        with pytest.raises(OSError):
+            await Tiering(backend).demote(f.id)
+        assert(not backend.open(f.id).is_cold)
+        assert(not backend.cold_paths(f.id).content.exists())
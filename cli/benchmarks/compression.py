@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# Compression ratio and CPU cost of the "aes-gcm-zlib" algorithm, compared to
+# "aes-gcm", on generated payloads (logs, CSV, SQL dump, random data) or on
+# the given files.
+#
+# Reports the size of the encrypted content relative to the input, and the
+# throughput of encryption and decryption on a single core, for several zlib
+# levels. It also tells whether "secupload --compress auto" would compress
+# each payload.
+import argparse
+import io
+import os
+import random
+import secrets
+import time
+
+from secsend.crypto import AESGCMChunks
+from secsend.stream import StreamTransform
+from secsend.compression import CompressStream, ChunkIndex, decompress_stream, compressible, sample_stream
+
+CHUNK_SIZE = 1024*1024
+
+def gen_logs(size):
+    rnd = random.Random(0)
+    lines = []
+    n = 0
+    while n < size:
+        line = "2026-10-19T%02d:%02d:%02d.%03d host%d nginx[%d]: 10.%d.%d.%d - - \"GET /v1/download/%s HTTP/1.1\" %d %d\n" % (
+            rnd.randrange(24), rnd.randrange(60), rnd.randrange(60), rnd.randrange(1000), rnd.randrange(8), rnd.randrange(1, 65536),
+            rnd.randrange(256), rnd.randrange(256), rnd.randrange(256), "%014x" % rnd.getrandbits(56), rnd.choice((200, 206, 304, 404)), rnd.randrange(1 << 24))
+        lines.append(line)
+        n += len(line)
+    return "".join(lines).encode("ascii")[:size]
+
+def gen_csv(size):
+    rnd = random.Random(1)
+    lines = ["id,date,customer,amount,currency,status\n"]
+    n = 0
+    i = 0
+    while n < size:
+        line = "%d,2026-%02d-%02d,customer%05d,%.2f,%s,%s\n" % (i, rnd.randrange(1, 13), rnd.randrange(1, 29), rnd.randrange(20000), rnd.random()*1000, rnd.choice(("EUR", "USD")), rnd.choice(("paid", "pending", "refunded")))
+        lines.append(line)
+        n += len(line)
+        i += 1
+    return "".join(lines).encode("ascii")[:size]
+
+def gen_sql(size):
+    rnd = random.Random(2)
+    lines = []
+    n = 0
+    i = 0
+    while n < size:
+        line = "INSERT INTO `files` (`id`, `name`, `size`, `created`) VALUES (%d, 'file_%s.bin', %d, '2026-10-%02d %02d:%02d:%02d');\n" % (
+            i, "%08x" % rnd.getrandbits(32), rnd.randrange(1 << 30), rnd.randrange(1, 29), rnd.randrange(24), rnd.randrange(60), rnd.randrange(60))
+        lines.append(line)
+        n += len(line)
+        i += 1
+    return "".join(lines).encode("ascii")[:size]
+
+def gen_random(size):
+    return os.urandom(size)
+
+PAYLOADS = {'logs': gen_logs, 'csv': gen_csv, 'sql': gen_sql, 'random': gen_random}
+
+def encrypt(data, key, iv, level):
+    crypto = AESGCMChunks(iv, key, encrypt=True)
+    if level is None:
+        stream = StreamTransform(crypto, CHUNK_SIZE)
+    else:
+        stream = CompressStream(crypto, CHUNK_SIZE, level=level)
+    start = time.process_time()
+    out = b"".join(stream(io.BytesIO(data)))
+    return out, time.process_time() - start
+
+def decrypt(content, key, iv, level):
+    crypto = AESGCMChunks(iv, key, encrypt=False)
+    start = time.process_time()
+    if level is None:
+        out = b"".join(StreamTransform(crypto, CHUNK_SIZE + AESGCMChunks.TAG_SIZE)(io.BytesIO(content)))
+    else:
+        index = ChunkIndex.load(crypto, lambda s, l: content[s:s+l], len(content))
+        out = b"".join(decompress_stream(crypto, index, CHUNK_SIZE, 0, io.BytesIO(content)))
+    return out, time.process_time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of compress-then-encrypt")
+    parser.add_argument("--size", type=int, default=64*1024*1024, help="Size of the generated payloads")
+    parser.add_argument("--levels", type=str, default="1,6,9", help="zlib levels, comma-separated")
+    parser.add_argument("files", type=str, nargs="*", help="Files to use instead of the generated payloads")
+    args = parser.parse_args()
+
+    if args.files:
+        payloads = {os.path.basename(p): open(p, "rb").read() for p in args.files}
+    else:
+        payloads = {name: gen(args.size) for name, gen in PAYLOADS.items()}
+    levels = [None] + [int(l) for l in args.levels.split(",")]
+    key = secrets.token_bytes(16)
+    iv = secrets.token_bytes(AESGCMChunks.IV_LEN)
+
+    print("%-10s %-8s %8s %12s %12s  %s" % ("payload", "algo", "ratio", "encr MB/s", "decr MB/s", "auto"))
+    for name, data in payloads.items():
+        auto = "yes" if compressible(sample_stream(io.BytesIO(data))) else "no"
+        for level in levels:
+            content, t_encr = encrypt(data, key, iv, level)
+            out, t_decr = decrypt(content, key, iv, level)
+            assert(out == data)
+            algo = "aes-gcm" if level is None else "zlib-%d" % level
+            print("%-10s %-8s %8.3f %12.1f %12.1f  %s" % (name, algo, len(content)/len(data), len(data)/t_encr/1e6, len(data)/t_decr/1e6, auto))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Startup time of the command line tools, for scripts that run them many
+# times. Each case is run several times in a new interpreter, and its median
+# wall-clock time is compared to a threshold: the script fails if one of them
+# is over it, so that it can be used to catch regressions (e.g. a module
+# imported again before arguments are parsed).
+#
+# The "--help" cases don't need a server. With --server, a small file is
+# uploaded to it, and its status is queried with "secadmin -s".
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+CLI_DIR = Path(__file__).resolve().parent.parent
+
+def run(args, env):
+    start = time.perf_counter()
+    p = subprocess.run([sys.executable] + args, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start, p.stdout.decode("utf8")
+
+def measure(args, env, runs):
+    return statistics.median(run(args, env)[0] for _ in range(runs))*1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the startup time of the CLI")
+    parser.add_argument("--runs", type=int, default=10, help="Number of runs of each case")
+    parser.add_argument("--server", type=str, help="URL of a server to upload a small file to")
+    parser.add_argument("--max-help-ms", type=float, default=150, help="Threshold of the --help cases")
+    parser.add_argument("--max-upload-ms", type=float, default=500, help="Threshold of the upload case")
+    parser.add_argument("--max-metadata-ms", type=float, default=300, help="Threshold of the metadata case")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (str(CLI_DIR), env.get('PYTHONPATH')) if p)
+    bin_dir = CLI_DIR / "bin"
+
+    results = []
+    baseline = measure(["-c", "pass"], env, args.runs)
+    for script in ("secupload", "secdownload", "secadmin"):
+        results.append(("%s --help" % script, measure([str(bin_dir / script), "--help"], env, args.runs), args.max_help_ms))
+    if args.server is not None:
+        with tempfile.NamedTemporaryFile(prefix="secsend-bench", suffix=".txt") as f:
+            f.write(b"hello world!\n"*100)
+            f.flush()
+            upload = [str(bin_dir / "secupload"), "--timeout", "0", f.name, args.server]
+            _, out = run(upload, env)
+            admin_url = [l for l in out.splitlines() if l.startswith("[+] Admin URL: ")][0].split(": ", 1)[1]
+            results.append(("secupload (small file)", measure(upload, env, args.runs), args.max_upload_ms))
+            results.append(("secadmin -s", measure([str(bin_dir / "secadmin"), "-s", admin_url], env, args.runs), args.max_metadata_ms))
+
+    print("%-24s %10s %10s" % ("case", "median ms", "max ms"))
+    print("%-24s %10.1f %10s" % ("python -c pass", baseline, "-"))
+    failed = False
+    for name, ms, threshold in results:
+        over = ms > threshold
+        failed |= over
+        print("%-24s %10.1f %10.1f%s" % (name, ms, threshold, "  REGRESSION" if over else ""))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,13 @@
+import argparse
+import shutil
 import sys
-import progressbar
 
-from secsend.client import DownloadURL
+# Commands import what they need once their arguments are parsed, so that
+# e.g. "--help" doesn't load requests, cryptography or libmagic. Scripts that
+# run them many times pay for every import on every call.
 
 def get_progressbar(name, size):
+    import progressbar
     if name is None:
         name = ''
     widgets = [
@@ -13,9 +17,15 @@ def get_progressbar(name, size):
     ]
     if size is None:
         size = progressbar.base.UnknownLength
-    return progressbar.ProgressBar(max_value=size,widgets=widgets)
+    kwargs = {}
+    if not sys.stderr.isatty():
+        # Detecting the terminal width (and following its changes) imports
+        # IPython if it is installed, which takes longer than a small upload
+        kwargs['term_width'] = shutil.get_terminal_size().columns
+    return progressbar.ProgressBar(max_value=size,widgets=widgets,**kwargs)
 
-def ask_password(url: DownloadURL):
+def ask_password(url):
+    from secsend.client import DownloadURL
     while True:
         pwd = input("Enter password: ")
         try:
@@ -25,6 +35,22 @@ def ask_password(url: DownloadURL):
             print("Invalid value.", file=sys.stderr)
             continue
 
+SIZE_SUFFIXES = {'k': 1024, 'm': 1024**2, 'g': 1024**3}
+
+def parse_size(value: str) -> int:
+    # Size in bytes, with an optional K, M or G suffix (e.g. "500K")
+    value = value.strip()
+    mult = SIZE_SUFFIXES.get(value[-1:].lower(), 1)
+    if mult > 1:
+        value = value[:-1]
+    try:
+        ret = int(float(value) * mult)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size '%s'" % value)
+    if ret <= 0:
+        raise argparse.ArgumentTypeError("size must be positive")
+    return ret
+
 def process_error(exc):
     print("Error: %s" % str(exc), file=sys.stderr)
     sys.exit(1)
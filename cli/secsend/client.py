@@ -1,10 +1,15 @@
 import binascii
 import base64
+import json
 import struct
 import hashlib
 import secrets
+import time
+import requests
+from collections import defaultdict
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlparse, parse_qsl
 
 from .metadata import EncryptedFileMetadata
@@ -63,6 +68,13 @@ class RootID(BaseID):
 @dataclass
 class ServerConfig:
     timeout_s_valid: List[int]
+    # 0 if the server doesn't support one-shot uploads
+    oneshot_size_limit: int = 0
+    batch_size_limit: int = 1000
+    # Chunk sizes advertised by the server. Servers that don't advertise them
+    # get the chunk size used before they existed.
+    chunk_size_preferred: int = 1024*1024
+    chunk_size_max: int = 1024*1024
 
     @classmethod
     def from_jsonable(cls, data):
@@ -70,9 +82,19 @@ class ServerConfig:
         if len(timeout_s_valid) > 1 and timeout_s_valid[0] == 0:
             timeout_s_valid.append(0)
             timeout_s_valid.pop(0)
-        return ServerConfig(timeout_s_valid=timeout_s_valid)
+        return ServerConfig(
+            timeout_s_valid=timeout_s_valid,
+            oneshot_size_limit=data.get('oneshot_size_limit', 0),
+            batch_size_limit=data.get('batch_size_limit', 1000),
+            chunk_size_preferred=data.get('chunk_size_preferred', 1024*1024),
+            chunk_size_max=data.get('chunk_size_max', 1024*1024))
 
 class ClientAPI:
+    # Requests rejected because the server is busy are retried after the
+    # delay it asks for, at most MAX_RETRIES times
+    MAX_RETRIES = 5
+    MAX_RETRY_AFTER = 60
+
     def __init__(self, session, server: str):
         self.server = server.rstrip(" /")
         self.server = server
@@ -81,13 +103,52 @@ class ClientAPI:
     def _get_url(self, uri: str) -> str:
         return "%s/v1/%s" % (self.server,uri)
 
+    @classmethod
+    def retry_after(cls, r) -> Optional[float]:
+        # Delay (in seconds) after which a rejected request can be retried,
+        # or None if it can't
+        if r.status_code not in (429, 503):
+            return None
+        value = r.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(max(delay, 0), cls.MAX_RETRY_AFTER)
+
+    def _follow(self, r):
+        # In cluster mode, servers redirect requests to the node that stores
+        # the file (or that has been picked for a new upload). The following
+        # requests of this client go straight to this node.
+        if any(h.status_code == 307 for h in r.history):
+            self._move_to(r.url)
+
+    def _move_to(self, url: str):
+        url = urlparse(url)
+        self.server = "%s://%s" % (url.scheme, url.netloc)
+
+    def _request(self, method: str, uri: str, **kwargs):
+        for i in range(self.MAX_RETRIES+1):
+            r = self.session.request(method, self._get_url(uri), **kwargs)
+            self._follow(r)
+            delay = self.retry_after(r)
+            if delay is None or i == self.MAX_RETRIES:
+                return r
+            r.close()
+            time.sleep(delay)
+
     def config(self) -> ServerConfig:
-        r = self.session.get(self._get_url("config"))
+        r = self._request("GET", "config")
         r.raise_for_status()
         return ServerConfig.from_jsonable(r.json())
 
     def metadata(self, id_: FileID) -> EncryptedFileMetadata:
-        r = self.session.get(self._get_url("metadata/%s" % str(id_)))
+        r = self._request("GET", "metadata/%s" % str(id_))
         r.raise_for_status()
         d = r.json()
         metadata = EncryptedFileMetadata.from_jsonable(d['metadata'])
@@ -95,33 +156,95 @@ class ClientAPI:
         return metadata, size
 
     def delete(self, id_: RootID):
-        r = self.session.post(self._get_url("delete/%s" % str(id_)))
+        r = self._request("POST", "delete/%s" % str(id_))
         r.raise_for_status()
 
+    def _batch(self, uri: str, ids: List[BaseID], batch_size: int, follow: bool = True):
+        ret = []
+        for i in range(0, len(ids), batch_size):
+            r = self._request("POST", uri, json={'ids': [str(id_) for id_ in ids[i:i+batch_size]]})
+            r.raise_for_status()
+            ret.extend(r.json()['results'])
+        if follow:
+            # IDs stored by other nodes of a cluster are sent to them
+            nodes = defaultdict(list)
+            for i, res in enumerate(ret):
+                if res['status'] == 307:
+                    nodes[res['location']].append(i)
+            for location, idxs in nodes.items():
+                node = ClientAPI(self.session, location)
+                results = node._batch(uri, [ids[i] for i in idxs], batch_size, follow=False)
+                for i, res in zip(idxs, results):
+                    ret[i] = res
+        return ret
+
+    def metadata_batch(self, ids: List[BaseID], batch_size: int = 1000):
+        # Returns one result per ID, as a dictionary with a 'status' key. On
+        # success, 'metadata' and 'size' are set. Otherwise, 'message'
+        # describes the error.
+        ret = self._batch("batch/metadata", ids, batch_size)
+        for res in ret:
+            if res['status'] == 200:
+                res['metadata'] = EncryptedFileMetadata.from_jsonable(res['metadata'])
+        return ret
+
+    def delete_batch(self, ids: List[RootID], batch_size: int = 1000):
+        return self._batch("batch/delete", ids, batch_size)
+
     def download(self, id_: FileID, seek = 0):
         headers = {}
         if seek > 0:
             headers["Range"] = "bytes=%d-" % seek
-        r = self.session.get(self._get_url("download/%s" % str(id_)), headers=headers, stream=True)
+        r = self._request("GET", "download/%s" % str(id_), headers=headers, stream=True)
+        if not r.ok:
+            r.close()
         r.raise_for_status()
         return r
 
-    def upload_new(self, metadata: EncryptedFileMetadata):
-        r = self.session.post(self._get_url("upload/new"), json=metadata.jsonable())
+    @staticmethod
+    def download_metadata(r):
+        # Metadata sent along with a download response, in the
+        # X-Secsend-Metadata and X-Secsend-Size headers. Returns None if the
+        # server doesn't send them.
+        data = r.headers.get("X-Secsend-Metadata")
+        if data is None:
+            return None
+        d = json.loads(base64.b64decode(data))
+        metadata = EncryptedFileMetadata.from_jsonable(d)
+        size = int(r.headers["X-Secsend-Size"])
+        return metadata, size
+
+    def upload_new(self, metadata: EncryptedFileMetadata, size: Optional[int] = None):
+        data = metadata.jsonable()
+        if size is not None:
+            # Let the server reject the upload early and reserve space
+            data['size'] = size
+        r = self._request("POST", "upload/new", json=data)
         r.raise_for_status()
         rid = r.json()['root_id']
         return RootID.from_str(rid)
 
-    def upload_push(self, id_: RootID, data):
-        r = self.session.post(self._get_url("upload/push/%s" % str(id_)), data=data)
+    def upload_oneshot(self, metadata: EncryptedFileMetadata, data: bytes):
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "X-Secsend-Metadata": base64.b64encode(json.dumps(metadata.jsonable()).encode("ascii")).decode("ascii")
+        }
+        r = self._request("POST", "upload/oneshot", data=data, headers=headers)
         r.raise_for_status()
+        rid = r.json()['root_id']
+        return RootID.from_str(rid)
 
-    def upload_finish(self, id_: RootID):
-        r = self.session.post(self._get_url("upload/finish/%s" % str(id_)))
+    def upload_push(self, id_: RootID, data):
+        # The data can only be consumed once, so this request is never retried
+        # nor redirected here. See UploadCtx.upload_push.
+        r = self.session.post(self._get_url("upload/push/%s" % str(id_)), data=data, allow_redirects=False)
+        if r.status_code == 307:
+            self._move_to(r.headers["Location"])
+            raise requests.HTTPError("upload redirected to %s" % self.server, response=r)
         r.raise_for_status()
 
-    def delete(self, id_: RootID):
-        r = self.session.post(self._get_url("delete/%s" % str(id_)))
+    def upload_finish(self, id_: RootID):
+        r = self._request("POST", "upload/finish/%s" % str(id_))
         r.raise_for_status()
 
 class DownloadURL:
@@ -0,0 +1,178 @@
+import io
+import struct
+import zlib
+from typing import List, Optional
+
+from .crypto import AESGCMChunks
+
+# "aes-gcm-zlib": chunks of the file are compressed with zlib before being
+# encrypted as with "aes-gcm". Chunks that don't shrink are stored as is.
+# Compressed chunks have variable sizes, so each one is stored as a record:
+#
+#   u32 LE length of the encrypted chunk | encrypted chunk
+#
+# The first byte of a decrypted chunk tells whether it is compressed. The
+# content ends with an encrypted index (the size of the file and the offset
+# of every record), followed by its length as a u32 LE. Downloads read the
+# index first, so that they can start at any chunk.
+#
+# Compressed sizes are visible to the server, which tells something about
+# the content of the file. This is why compression is opt-in.
+ALGO = "aes-gcm-zlib"
+
+STORED = 0
+DEFLATE = 1
+RECORD_HEADER = struct.Struct("<I")
+TRAILER = struct.Struct("<I")
+# The index is encrypted with the metadata key. Indexes 0 to 2 are used by
+# the name, mime type and chunk size.
+INDEX_IDX = 3
+INDEX_SIGN = b"secsend_index"
+
+class InvalidIndex(Exception):
+    def __init__(self):
+        super().__init__("invalid chunk index")
+
+def compress_chunk(data: bytes, level: int) -> bytes:
+    ret = zlib.compress(data, level)
+    if len(ret) >= len(data):
+        return bytes((STORED,)) + data
+    return bytes((DEFLATE,)) + ret
+
+def decompress_chunk(data: bytes, chunk_size: int) -> bytes:
+    if data[0] == STORED:
+        return data[1:]
+    # Chunks can't be bigger than chunk_size once decompressed
+    d = zlib.decompressobj()
+    ret = d.decompress(data[1:], chunk_size)
+    if d.unconsumed_tail or not d.eof:
+        raise zlib.error("invalid compressed chunk")
+    return ret
+
+def record_size(payload_len: int) -> int:
+    return RECORD_HEADER.size + payload_len + AESGCMChunks.TAG_SIZE
+
+class CompressStream:
+    # Counterpart of StreamTransform for uploads. Compressed sizes aren't
+    # known in advance, so resuming an upload reads the input from the start,
+    # and only compresses what the server already has to find where to
+    # restart. Only the record being cut is encrypted again.
+    def __init__(self, encrypt: AESGCMChunks, in_chunk_size: int, out_seek: int = 0, rate_limit=None, level: int = 6):
+        self.encrypt = encrypt
+        self.in_chunk_size = in_chunk_size
+        self.out_seek = out_seek
+        self.rate_limit = rate_limit
+        self.level = level
+        self.chunk_seek = 0
+
+    def __call__(self, source_stream: io.IOBase, cb_done=lambda l: l):
+        encrypt = self.encrypt
+        offsets = []
+        offset = 0
+        size = 0
+        while True:
+            data = source_stream.read(self.in_chunk_size)
+            if data is None or len(data) == 0:
+                break
+            cb_done(len(data))
+            payload = compress_chunk(data, self.level)
+            end = offset + record_size(len(payload))
+            offsets.append(offset)
+            size += len(data)
+            if end > self.out_seek:
+                if self.rate_limit is not None:
+                    self.rate_limit.consume(len(data))
+                encrypt.seek_chunk_idx(len(offsets)-1)
+                payload = encrypt.process(payload)
+                record = RECORD_HEADER.pack(len(payload)) + payload
+                yield record[max(self.out_seek - offset, 0):]
+            offset = end
+        index = encrypt.encr_sign_metadata(INDEX_IDX, struct.pack("<Q%dQ" % len(offsets), size, *offsets), INDEX_SIGN)
+        trailer = index + TRAILER.pack(len(index))
+        yield trailer[max(self.out_seek - offset, 0):]
+
+class ChunkIndex:
+    def __init__(self, size: int, offsets: List[int], records_end: int):
+        self.size = size
+        self.offsets = offsets
+        self.records_end = records_end
+
+    @classmethod
+    def load(cls, decrypt: AESGCMChunks, read_range, content_size: int) -> "ChunkIndex":
+        # read_range(start, length) returns these bytes of the content
+        if content_size < TRAILER.size:
+            raise InvalidIndex()
+        index_len, = TRAILER.unpack(read_range(content_size - TRAILER.size, TRAILER.size))
+        records_end = content_size - TRAILER.size - index_len
+        if records_end < 0:
+            raise InvalidIndex()
+        data = decrypt.decr_verify_metadata(INDEX_IDX, read_range(records_end, index_len), INDEX_SIGN)
+        if len(data) < 8 or len(data) % 8 != 0:
+            raise InvalidIndex()
+        size, *offsets = struct.unpack("<Q%dQ" % (len(data)//8 - 1), data)
+        return cls(size, offsets, records_end)
+
+def decompress_stream(decrypt: AESGCMChunks, index: ChunkIndex, chunk_size: int, first_chunk: int, source_stream: io.IOBase, rate_limit=None):
+    # Yields the decrypted chunks of the file, starting at first_chunk.
+    # source_stream starts at the record of this chunk. Records are checked
+    # against the index, which is authenticated: each one must start at its
+    # offset, and they must add up to the size of the file, so that records
+    # dropped or reordered by the server are detected.
+    offsets = index.offsets
+    offset = offsets[first_chunk]
+    remaining = index.size - first_chunk*chunk_size
+    decrypt.seek_chunk_idx(first_chunk)
+    for i in range(first_chunk, len(offsets)):
+        if offset != offsets[i] or offset >= index.records_end:
+            raise InvalidIndex()
+        header = read_exact(source_stream, RECORD_HEADER.size)
+        length, = RECORD_HEADER.unpack(header)
+        if length > 1 + chunk_size + AESGCMChunks.TAG_SIZE:
+            raise InvalidIndex()
+        data = read_exact(source_stream, length)
+        if rate_limit is not None:
+            rate_limit.consume(len(data))
+        data = decompress_chunk(decrypt.process(data), chunk_size)
+        # Only the last chunk can be shorter
+        if len(data) > remaining or (i < len(offsets) - 1 and len(data) != chunk_size):
+            raise InvalidIndex()
+        remaining -= len(data)
+        yield data
+        offset += RECORD_HEADER.size + length
+    if offset != index.records_end or remaining != 0:
+        raise InvalidIndex()
+
+def read_exact(stream: io.IOBase, n: int) -> bytes:
+    ret = bytearray()
+    while len(ret) < n:
+        data = stream.read(n - len(ret))
+        if not data:
+            raise EOFError("truncated content")
+        ret += data
+    return bytes(ret)
+
+def compressible(sample: bytes, threshold: float = 0.9) -> bool:
+    # Whether a sample of the file shrinks enough to be worth compressing.
+    # A fast compression level is enough to tell.
+    if len(sample) == 0:
+        return False
+    return len(zlib.compress(sample, 1)) <= threshold*len(sample)
+
+def sample_stream(stream: io.IOBase, size: int = 256*1024, parts: int = 4) -> Optional[bytes]:
+    # Reads parts of the stream spread across it, without moving its
+    # position. Streams that can't be sought are peeked at, if possible.
+    if stream.seekable():
+        pos = stream.tell()
+        total = stream.seek(0, io.SEEK_END)
+        if total <= size:
+            parts = 1
+        ret = bytearray()
+        for i in range(parts):
+            stream.seek(i*(total//parts))
+            ret += stream.read(size//parts)
+        stream.seek(pos)
+        return bytes(ret)
+    peek = getattr(stream, "peek", None)
+    if peek is None:
+        return None
+    return peek(size)
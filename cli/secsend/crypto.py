@@ -8,6 +8,8 @@ from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 # than 2**32 bytes (~4GB).
 class GCMIV:
     IV_LEN = 12
+    # Also the biggest size the metadata can store
+    MAX_CHUNK_SIZE = 2**32-1
     def __init__(self, iv_base: bytes):
         assert(len(iv_base) == self.IV_LEN)
         self._iv_base = iv_base
@@ -0,0 +1,192 @@
+import fcntl
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Optional
+
+import requests
+
+from .client import ClientAPI, DownloadURL
+from .crypto import VerifyKey
+
+# Journal of the files uploaded by secupload, so that uploading a file that
+# hasn't changed since its last upload to the same server gives back the
+# links of that upload, as long as it still exists on the server.
+#
+# Files are identified by their path, size and modification time, and
+# optionally by the SHA-256 of their content (which costs a full read of the
+# file, but catches changes that keep the modification time). The name and
+# mime type they are uploaded with must also be the same. The journal is
+# a JSON lines file: each upload appends a line, and the last line of a file
+# wins. It is compacted when most of its lines are stale. It contains the
+# administration links of the files, and thus their keys: it is only readable
+# by its owner.
+
+def default_path() -> Path:
+    state = os.environ.get("XDG_STATE_HOME") or os.path.join(os.path.expanduser("~"), ".local", "state")
+    return Path(state) / "secsend" / "journal.jsonl"
+
+@dataclass
+class JournalKey:
+    path: str
+    size: int
+    mtime_ns: int
+    server: str
+    name: str
+    mime_type: str
+    sha256: Optional[str] = None
+
+    @classmethod
+    def from_file(cls, path, server: str, name: str, mime_type: str, hash_content: bool = False):
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        sha256 = None
+        if hash_content:
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for data in iter(lambda: f.read(1024*1024), b""):
+                    h.update(data)
+            sha256 = h.hexdigest()
+        return cls(path=path, size=st.st_size, mtime_ns=st.st_mtime_ns, server=server.rstrip("/"), name=name, mime_type=mime_type, sha256=sha256)
+
+class Journal:
+    # Compacted when it has more than COMPACT_MIN_LINES lines, and more than
+    # COMPACT_RATIO lines per live entry
+    COMPACT_MIN_LINES = 1000
+    COMPACT_RATIO = 2
+
+    def __init__(self, path):
+        self.path = Path(path)
+        # (path, server) => entry
+        self.entries = {}
+        self.lines = 0
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        self.lines = 0
+        try:
+            with open(self.path, "r") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+                self._parse(f)
+        except FileNotFoundError:
+            pass
+
+    def _parse(self, f):
+        for line in f:
+            self.lines += 1
+            try:
+                entry = json.loads(line)
+                k = (entry['path'], entry['server'])
+            except (ValueError, KeyError, TypeError):
+                # e.g. the last line if secupload was killed while writing it
+                continue
+            if entry.get('url') is None:
+                self.entries.pop(k, None)
+            else:
+                self.entries[k] = entry
+
+    def find(self, key: JournalKey) -> Optional[dict]:
+        # Entry of the last upload of this file, if it hasn't changed since
+        entry = self.entries.get((key.path, key.server))
+        if entry is None:
+            return None
+        if (entry['size'], entry['mtime_ns'], entry['name'], entry['mime_type']) != (key.size, key.mtime_ns, key.name, key.mime_type):
+            return None
+        if key.sha256 is not None and entry.get('sha256') != key.sha256:
+            return None
+        if _has_expired(entry):
+            return None
+        return entry
+
+    def reusable(self, entry: dict, session, timeout_s: Optional[int] = None) -> Optional[DownloadURL]:
+        # Returns the administration link of the entry if its upload can be
+        # given back: it must still be valid for at least half of its time
+        # limit, and still exist on the server.
+        if timeout_s is not None and entry['timeout_s'] != timeout_s:
+            return None
+        if entry['expires'] != 0 and entry['expires'] - time.time() < entry['timeout_s']/2:
+            return None
+        url = DownloadURL.from_url(entry['url'])
+        try:
+            metadata, _ = ClientAPI(session, url.server).metadata(url.id.file_id())
+        except requests.HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+            self.forget(entry)
+            return None
+        if not metadata.complete or not VerifyKey(metadata.key_sign, url.key, metadata.iv):
+            return None
+        return url
+
+    def record(self, key: JournalKey, url: DownloadURL, timeout_s: int):
+        entry = asdict(key)
+        entry['url'] = str(url)
+        entry['timeout_s'] = timeout_s
+        entry['expires'] = 0 if timeout_s == 0 else int(time.time()) + timeout_s
+        self._append(entry)
+
+    def forget(self, entry: dict):
+        self._append({'path': entry['path'], 'server': entry['server'], 'url': None})
+
+    def _append(self, entry: dict):
+        with self._open_locked() as f:
+            # Entries written by other processes since the journal was loaded
+            f.seek(0)
+            data = f.read()
+            self.entries = {}
+            self.lines = 0
+            self._parse(data.splitlines())
+            line = json.dumps(entry)
+            self._parse([line])
+            if len(data) > 0 and not data.endswith("\n"):
+                # Truncated line
+                line = "\n" + line
+            f.write(line + "\n")
+            f.flush()
+            if self.lines > max(self.COMPACT_MIN_LINES, self.COMPACT_RATIO*len(self.entries)):
+                self._compact()
+
+    def compact(self):
+        with self._open_locked() as f:
+            f.seek(0)
+            self.entries = {}
+            self.lines = 0
+            self._parse(f)
+            self._compact()
+
+    def _compact(self):
+        # Called with the journal locked. It is replaced by a new file, so
+        # that a crash can't lose it: other processes notice it when they
+        # lock it.
+        entries = [e for e in self.entries.values() if not _has_expired(e)]
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.entries = {(e['path'], e['server']): e for e in entries}
+        self.lines = len(entries)
+
+    def _open_locked(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o600)
+            f = os.fdopen(fd, "a+")
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            # Compacted by another process in the meantime
+            f.close()
+
+def _has_expired(entry: dict) -> bool:
+    return entry['expires'] != 0 and entry['expires'] <= time.time()
@@ -3,7 +3,7 @@ import struct
 from dataclasses import dataclass, asdict
 from enum import Enum
 
-ALGOS = ['aes-gcm']
+ALGOS = ['aes-gcm', 'aes-gcm-zlib']
 
 @dataclass
 class EncryptedFileMetadata:
@@ -28,7 +28,7 @@ class EncryptedFileMetadata:
     def from_jsonable(cls, d):
         for f in ("name","mime_type","iv","chunk_size","key_sign"):
             d[f] = base64.b64decode(d[f])
-        d = {k: d[k] for k in ("name","mime_type","iv","chunk_size","key_sign","algo","version")}
+        d = {k: d[k] for k in ("name","mime_type","iv","chunk_size","key_sign","algo","version","timeout_s","complete") if k in d}
         return cls(**d)
 
 @dataclass
@@ -1,25 +1,46 @@
 import io
 import requests
 import os
-import magic
 import pathlib
 import secrets
 import sys
+import time
 from typing import Optional
 
 from .metadata import FileMetadata, ALGOS, encryptMetadata, decryptMetadata
-from .crypto import AESGCMChunks, SignKey, VerifyKey
+from .crypto import AESGCMChunks, GCMIV, SignKey, VerifyKey
+from .compression import ALGO as COMPRESSED_ALGO, CompressStream, ChunkIndex, decompress_stream, compressible, sample_stream, read_exact
 from .client import ClientAPI, DownloadURL
 
 class InvalidKey(Exception):
     def __init__(self):
         super().__init__("invalid decryption key")
 
+class RateLimit:
+    # Token bucket limiting the rate (in bytes per second) at which streams
+    # are consumed. Whole chunks are taken at once, and we sleep afterwards if
+    # too much has been consumed, so that there is at most one sleep per
+    # chunk.
+    def __init__(self, rate: int, burst: Optional[int] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def consume(self, n: int):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        self._tokens -= n
+        if self._tokens < 0:
+            time.sleep(-self._tokens / self.rate)
+
 class StreamTransform:
-    def __init__(self, data_process, in_chunk_size: int, out_seek: int = 0):
+    def __init__(self, data_process, in_chunk_size: int, out_seek: int = 0, rate_limit: Optional[RateLimit] = None):
         self.data_process = data_process
         self.in_chunk_size = in_chunk_size
         self.out_seek = out_seek
+        self.rate_limit = rate_limit
 
         out_chunk_size = data_process.out_chunk_size(in_chunk_size)
         chunk_idx = out_seek//out_chunk_size
@@ -37,6 +58,7 @@ class StreamTransform:
         if self.out_seek > 0:
             cb_done(self.chunk_seek)
             data = source_stream.read(self.in_chunk_size)
+            self._consume(len(data))
             cb_done(len(data))
             data = self.data_process.process(data)
             data = data[self.bytes_skip:]
@@ -46,10 +68,15 @@ class StreamTransform:
             data = source_stream.read(self.in_chunk_size)
             if data is None or len(data) == 0:
                 return
+            self._consume(len(data))
             cb_done(len(data))
             data = self.data_process.process(data)
             yield data
 
+    def _consume(self, n: int):
+        if self.rate_limit is not None:
+            self.rate_limit.consume(n)
+
 def stream_transform(source_stream: io.IOBase, data_process, in_chunk_size: int, out_seek: int = 0):
     ctx = StreamTransform(data_process, in_chunk_size, out_seek)
     if out_seek > 0:
@@ -57,9 +84,43 @@ def stream_transform(source_stream: io.IOBase, data_process, in_chunk_size: int,
     yield from ctx(source_stream)
 
 
-MIME = magic.Magic(mime=True)
+_MIME = None
+
+def detect_mime(path) -> str:
+    # libmagic loads its database when it is opened: only do it for uploads
+    # that need it
+    global _MIME
+    if _MIME is None:
+        import magic
+        _MIME = magic.Magic(mime=True)
+    return _MIME.from_file(path)
+
+# Bigger chunks mean fewer AES-GCM tags and fewer iterations on big files, but
+# a resumed upload or download may send a whole chunk again, and downloads
+# decrypt a chunk at a time in memory. Big files are split in about
+# CHUNK_COUNT_TARGET chunks, within the sizes advertised by the server, and
+# chunks take at most CHUNK_DURATION_MAX seconds to send if the throughput is
+# known.
+CHUNK_SIZE_MIN = 64*1024
+CHUNK_COUNT_TARGET = 1024
+CHUNK_DURATION_MAX = 2
+
+def choose_chunk_size(in_size: Optional[int], preferred: int, maximum: int, throughput: Optional[int] = None) -> int:
+    ret = preferred
+    if in_size is not None:
+        ret = max(ret, in_size//CHUNK_COUNT_TARGET)
+    if throughput is not None:
+        ret = min(ret, throughput*CHUNK_DURATION_MAX)
+    if ret != preferred:
+        # Computed sizes are rounded, so that chunks are aligned with pages
+        ret = max(ret - ret%CHUNK_SIZE_MIN, CHUNK_SIZE_MIN)
+    return max(min(ret, maximum, GCMIV.MAX_CHUNK_SIZE), 1)
 
 class UploadCtx:
+    # Maximum size of encrypted files sent with a one-shot upload, as they are
+    # kept in memory
+    ONESHOT_SIZE_MAX = 4*1024*1024
+
     def __init__(self, input_stream, path, name, mime, auth, in_size):
         self.input_stream = input_stream
         self.path = path
@@ -71,6 +132,8 @@ class UploadCtx:
             self.session.auth = auth
         self._config = None
         self.id = None
+        self.complete = False
+        self.rate_limit = None
 
     def config(self):
         if self._config is None:
@@ -86,7 +149,7 @@ class UploadCtx:
     @classmethod
     def from_source_file(cls, path, mime=None, auth=None):
         if mime is None:
-            mime = MIME.from_file(path)
+            mime = detect_mime(path)
         name = pathlib.Path(path).name
         try:
             in_size = os.path.getsize(path)
@@ -99,7 +162,15 @@ class UploadCtx:
         return DownloadURL(self.server, self.id, self.key)
 
 
-    def upload_new(self, server: str, timeout_s: Optional[int] = None):
+    def should_compress(self, mode: str) -> bool:
+        # mode is "yes", "no", or "auto" to compress if a sample of the input
+        # shrinks enough
+        if mode != "auto":
+            return mode == "yes"
+        sample = sample_stream(self.input_stream)
+        return sample is not None and compressible(sample)
+
+    def upload_new(self, server: str, timeout_s: Optional[int] = None, compress: bool = False, chunk_size: Optional[int] = None):
         assert(self.id is None)
         self.client = ClientAPI(self.session, server)
 
@@ -109,21 +180,45 @@ class UploadCtx:
             if timeout_s not in self.config().timeout_s_valid:
                 raise ValueError("unsupported timeout value. Supported values are: " + ",".join((str(v) for v in self.config().timeout_s_valid)))
 
+        if chunk_size is None:
+            # The rate limit is the only throughput known before sending
+            # anything
+            throughput = self.rate_limit.rate if self.rate_limit is not None else None
+            chunk_size = choose_chunk_size(self.in_size, self.config().chunk_size_preferred, self.config().chunk_size_max, throughput)
+        elif not 0 < chunk_size <= GCMIV.MAX_CHUNK_SIZE:
+            raise ValueError("invalid chunk size %d" % chunk_size)
+
         self.key = secrets.token_bytes(16)
         iv = secrets.token_bytes(AESGCMChunks.IV_LEN)
         self.metadata = FileMetadata(
             name=self.name,
             mime_type=self.mime,
             iv=iv,
-            chunk_size=1024*1024,
+            chunk_size=chunk_size,
             key_sign=SignKey(self.key, iv),
-            timeout_s=timeout_s)
+            timeout_s=timeout_s,
+            algo=COMPRESSED_ALGO if compress else ALGOS[0])
 
         self.encrypt = AESGCMChunks(self.metadata.iv, self.key, encrypt=True)
 
         self.server = server
-        self.id = self.client.upload_new(encryptMetadata(self.metadata, self.encrypt))
-        self.stream = StreamTransform(self.encrypt, self.metadata.chunk_size, out_seek=0)
+        self.stream = self._transform(0)
+        encr_metadata = encryptMetadata(self.metadata, self.encrypt)
+        # Small files are sent with a single request
+        encr_size = self.encrypted_size()
+        data = None
+        if compress and self.in_size is not None and self.in_size <= self.ONESHOT_SIZE_MAX and self.input_stream.seekable():
+            # Small files are compressed in memory to know their size
+            data = b"".join(self.stream(self.input_stream))
+            encr_size = len(data)
+            self._seek(0)
+        if encr_size is not None and encr_size <= min(self.ONESHOT_SIZE_MAX, self.config().oneshot_size_limit):
+            if data is None:
+                data = b"".join(self.stream(self.input_stream))
+            self.id = self.client.upload_oneshot(encr_metadata, data)
+            self.complete = True
+        else:
+            self.id = self.client.upload_new(encr_metadata, encr_size)
         return self.id
 
     def upload_resume(self, dest: DownloadURL):
@@ -134,24 +229,72 @@ class UploadCtx:
         self.key = dest.key
 
         metadata, out_size = self.client.metadata(self.id.file_id())
-        if metadata.algo != ALGOS[0]:
+        if metadata.algo not in ALGOS:
             raise ValueError("algorithm '%s' not supported" % metadata.algo)
 
         self.encrypt = AESGCMChunks(metadata.iv, dest.key, encrypt=True)
         self.metadata = decryptMetadata(metadata, self.encrypt)
-        self.stream = StreamTransform(self.encrypt, self.metadata.chunk_size, out_seek=out_size)
+        self._seek(out_size)
+
+    def _transform(self, out_size):
+        if self.metadata.algo == COMPRESSED_ALGO:
+            return CompressStream(self.encrypt, self.metadata.chunk_size, out_seek=out_size, rate_limit=self.rate_limit)
+        return StreamTransform(self.encrypt, self.metadata.chunk_size, out_seek=out_size, rate_limit=self.rate_limit)
+
+    def _seek(self, out_size):
+        self.stream = self._transform(out_size)
         self.input_stream.seek(self.stream.chunk_seek)
 
     def upload_push(self, cb_done=lambda l: l):
         assert(self.id is not None)
-        self.client.upload_push(self.id, self.stream(self.input_stream, cb_done))
+        if self.complete:
+            cb_done(self.in_size)
+            return
+
+        # If the server is busy, the push is resumed from what the server has
+        # received, once it has asked us to retry. This is only possible if
+        # the input can be read again.
+        #
+        # Servers reject busy pushes before reading their body. Depending on
+        # timing, the connection can then be reset before their response
+        # could be read: connection errors are retried as well, with an
+        # exponential backoff, as they don't tell how long to wait.
+        reported = 0
+        for i in range(ClientAPI.MAX_RETRIES+1):
+            pos = 0
+            def progress(l):
+                nonlocal pos, reported
+                pos += l
+                if pos > reported:
+                    cb_done(pos - reported)
+                    reported = pos
+            try:
+                self.client.upload_push(self.id, self.stream(self.input_stream, progress))
+                return
+            except requests.HTTPError as e:
+                # Pushes redirected to another node of a cluster are resumed
+                # there right away
+                delay = 0 if e.response.status_code == 307 else ClientAPI.retry_after(e.response)
+                if delay is None or i == ClientAPI.MAX_RETRIES or not self.input_stream.seekable():
+                    raise
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                if i == ClientAPI.MAX_RETRIES or not self.input_stream.seekable():
+                    raise
+                delay = min(2**i, ClientAPI.MAX_RETRY_AFTER)
+            time.sleep(delay)
+            _, out_size = self.client.metadata(self.id.file_id())
+            self._seek(out_size)
 
     def upload_finish(self):
         assert(self.id is not None)
+        if self.complete:
+            return
         self.client.upload_finish(self.id)
+        self.complete = True
 
     def encrypted_size(self):
-        if self.in_size is None:
+        # Compressed sizes are only known once the file has been read
+        if self.in_size is None or self.metadata.algo == COMPRESSED_ALGO:
             return None
         return self.encrypt.out_size(self.in_size, self.metadata.chunk_size)
 
@@ -162,18 +305,40 @@ class DownloadCtx:
         self.key = key
         self.metadata = None
         self.decrypt = None
+        self.index = None
+        self._response = None
+        self.rate_limit = None
 
     @classmethod
     def from_url(cls, url: DownloadURL):
         return cls(url.server, url.id, url.key)
 
-    def get_metadata(self) -> FileMetadata:
+    def get_metadata(self, prefetch: bool = False) -> FileMetadata:
         if self.metadata is not None:
             return self.metadata
-        # Get metadata
-        metadata, size = self.client.metadata(self.id)
+        # With "prefetch", the file is about to be downloaded from its start:
+        # the download stream is opened straight away, and the metadata are
+        # read from its headers, so that the whole download takes a single
+        # request. The stream is kept until download() or close() is called.
+        # Otherwise, and for servers that don't send these headers, they are
+        # read from /v1/metadata.
+        ret = None
+        if prefetch:
+            r = self.client.download(self.id)
+            ret = self.client.download_metadata(r)
+            if ret is None:
+                r.close()
+            else:
+                self._response = r
+        if ret is None:
+            ret = self.client.metadata(self.id)
+        metadata, size = ret
         if not VerifyKey(metadata.key_sign, self.key, metadata.iv):
+            self.close()
             raise InvalidKey()
+        if metadata.algo not in ALGOS:
+            self.close()
+            raise ValueError("algorithm '%s' not supported" % metadata.algo)
         self.decrypt = AESGCMChunks(metadata.iv, self.key, encrypt=False)
         self.metadata = decryptMetadata(metadata, self.decrypt)
         self.size = size
@@ -181,14 +346,64 @@ class DownloadCtx:
 
     def decrypted_size(self):
         metadata = self.get_metadata()
+        if metadata.algo == COMPRESSED_ALGO:
+            return self.get_index().size
         return self.decrypt.out_size(self.size, metadata.chunk_size)
 
+    def get_index(self) -> ChunkIndex:
+        # Index of the chunks of compressed files, read from the end of the
+        # content
+        if self.index is None:
+            def read_range(start, length):
+                with self.client.download(self.id, start) as r:
+                    return read_exact(r.raw, length)
+            self.index = ChunkIndex.load(self.decrypt, read_range, self.size)
+        return self.index
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def download(self, out_seek = 0):
         assert(self.metadata is not None)
         assert(self.decrypt is not None)
         if not VerifyKey(self.metadata.key_sign, self.key, self.metadata.iv):
             raise InvalidKey()
-        stream = StreamTransform(self.decrypt, self.metadata.chunk_size+AESGCMChunks.TAG_SIZE, out_seek)
-        r = self.client.download(self.id, stream.chunk_seek)
+        if self.metadata.algo == COMPRESSED_ALGO:
+            yield from self._download_compressed(out_seek)
+            return
+        stream = StreamTransform(self.decrypt, self.metadata.chunk_size+AESGCMChunks.TAG_SIZE, out_seek, rate_limit=self.rate_limit)
+        r, self._response = self._response, None
+        if r is None or stream.chunk_seek > 0:
+            if r is not None:
+                r.close()
+            r = self.client.download(self.id, stream.chunk_seek)
         with r:
             yield from stream(r.raw)
+
+    def _download_compressed(self, out_seek):
+        index = self.get_index()
+        chunk_size = self.metadata.chunk_size
+        first = out_seek//chunk_size
+        r, self._response = self._response, None
+        if first >= len(index.offsets):
+            if r is not None:
+                r.close()
+            return
+        start = index.offsets[first]
+        if r is None or start > 0:
+            if r is not None:
+                r.close()
+            r = self.client.download(self.id, start)
+        skip = out_seek%chunk_size
+        with r:
+            for data in decompress_stream(self.decrypt, index, chunk_size, first, r.raw, rate_limit=self.rate_limit):
+                yield data[skip:]
+                skip = 0
@@ -0,0 +1,79 @@
+import unittest
+import argparse
+import contextlib
+import io
+import os
+import random
+import runpy
+import subprocess
+import sys
+from pathlib import Path
+
+import requests_mock
+
+from secsend.client import DownloadURL, RootID
+from secsend.metadata import FileMetadata, encryptMetadata
+from secsend.crypto import AESGCMChunks
+
+CLI_DIR = Path(__file__).resolve().parent.parent
+
+# Runs a command in a new interpreter, and prints the modules it has loaded
+LOADED_MODULES = """
+import runpy, sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+except SystemExit:
+    pass
+print()
+print(" ".join(sorted(m for m in sys.modules if "." not in m)))
+"""
+
+class TestStartup(unittest.TestCase):
+    # Modules that commands must only import once they need them
+    HEAVY = {"requests", "cryptography", "progressbar", "magic"}
+
+    def loaded_modules(self, script, *args):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(p for p in (str(CLI_DIR), env.get('PYTHONPATH')) if p)
+        p = subprocess.run([sys.executable, "-c", LOADED_MODULES, str(CLI_DIR / "bin" / script)] + list(args), env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        return set(p.stdout.decode("utf8").splitlines()[-1].split())
+
+    def test_help(self):
+        for script in ("secupload", "secdownload", "secadmin"):
+            self.assertEqual(self.loaded_modules(script, "--help") & self.HEAVY, set(), script)
+
+    def test_metadata(self):
+        # Nothing listens on the discard port: the request fails right away
+        url = DownloadURL("http://127.0.0.1:9", RootID.generate(), random.randbytes(16))
+        self.assertEqual(self.loaded_modules("secadmin", "-s", str(url)) & self.HEAVY, {"requests"})
+
+class TestSecadmin(unittest.TestCase):
+    def setUp(self):
+        self.secadmin = runpy.run_path(str(CLI_DIR / "bin" / "secadmin"), run_name="secadmin")
+        iv = b"\x00"*AESGCMChunks.IV_LEN
+        metadata = FileMetadata(name="toto", mime_type="application/octet-stream", iv=iv, chunk_size=10, key_sign=b"", timeout_s=0, complete=True)
+        self.metadata = encryptMetadata(metadata, AESGCMChunks(iv, b"\x00"*16, encrypt=True)).jsonable()
+
+    def status(self, urls, batch):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            errors = self.secadmin['bulk'](argparse.Namespace(delete=False), urls, batch)
+        return errors, out.getvalue().splitlines()
+
+    def test_status_without_batch_endpoints(self):
+        urls = [DownloadURL("http://secsend.test", RootID.generate(), random.randbytes(16)) for _ in range(2)]
+        with requests_mock.Mocker() as m:
+            m.get("http://secsend.test/v1/config", json={'timeout_s_valid': [0]})
+            m.post("http://secsend.test/v1/batch/metadata", status_code=404)
+            for url in urls:
+                m.get("http://secsend.test/v1/metadata/%s" % url.id.file_id(), json={'metadata': self.metadata, 'size': 28})
+
+            # A single URL only needs the metadata endpoint
+            self.assertEqual(self.status([str(urls[0])], batch=False), (0, ["%s\tcomplete\t28" % urls[0]]))
+            self.assertEqual([r.path for r in m.request_history], ["/v1/metadata/%s" % str(urls[0].id.file_id()).lower()])
+
+            # Older servers don't have the batch endpoints
+            errors, lines = self.status([str(u) for u in urls], batch=True)
+            self.assertEqual(errors, 0)
+            self.assertEqual(lines, ["%s\tcomplete\t28" % u for u in urls])
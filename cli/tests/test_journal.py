@@ -0,0 +1,119 @@
+import unittest
+import tempfile
+import os
+import random
+from pathlib import Path
+
+import requests
+import requests_mock
+from unittest.mock import patch
+
+from secsend.client import DownloadURL, RootID
+from secsend.journal import Journal, JournalKey
+from secsend.metadata import FileMetadata, encryptMetadata
+from secsend.crypto import AESGCMChunks, SignKey
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix="secsend-test")
+        self.dir = Path(self.tmpdir.name)
+        self.source = self.dir / "backup.tar"
+        self.source.write_bytes(b"hello world!")
+        self.journal_path = self.dir / "state" / "journal.jsonl"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def key(self, **kwargs):
+        args = dict(name="backup.tar", mime_type="application/x-tar")
+        args.update(kwargs)
+        return JournalKey.from_file(self.source, "http://secsend.test", **args)
+
+    def url(self):
+        return DownloadURL("http://secsend.test", RootID.generate(), random.randbytes(16))
+
+    def mock_metadata(self, session_mock, url, complete=True, status=200):
+        iv = random.randbytes(AESGCMChunks.IV_LEN)
+        metadata = FileMetadata(name="backup.tar", mime_type="application/x-tar", iv=iv, chunk_size=10, key_sign=SignKey(url.key, iv), timeout_s=0, complete=complete)
+        encr = encryptMetadata(metadata, AESGCMChunks(iv, url.key, encrypt=True))
+        session_mock.get("http://secsend.test/v1/metadata/%s" % url.id.file_id(), json={'metadata': encr.jsonable(), 'size': 28}, status_code=status)
+
+    def test_find(self):
+        journal = Journal(self.journal_path)
+        url = self.url()
+        journal.record(self.key(), url, 0)
+        self.assertEqual(os.stat(self.journal_path).st_mode & 0o777, 0o600)
+
+        journal = Journal(self.journal_path)
+        entry = journal.find(self.key())
+        self.assertEqual(entry['url'], str(url))
+        self.assertIsNone(journal.find(self.key(name="other.tar")))
+        # Entries recorded without their content hash don't match keys with one
+        self.assertIsNone(journal.find(self.key(hash_content=True)))
+        journal.record(self.key(hash_content=True), url, 0)
+        self.assertIsNotNone(journal.find(self.key(hash_content=True)))
+
+        # Same size and modification time, other content
+        st = os.stat(self.source)
+        self.source.write_bytes(b"hello world?")
+        os.utime(self.source, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertIsNotNone(journal.find(self.key()))
+        self.assertIsNone(journal.find(self.key(hash_content=True)))
+
+        self.source.write_bytes(b"hello world!!")
+        self.assertIsNone(journal.find(self.key()))
+
+    def test_reusable(self):
+        journal = Journal(self.journal_path)
+        url = self.url()
+        journal.record(self.key(), url, 3600)
+        entry = journal.find(self.key())
+        session = requests.Session()
+        with requests_mock.Mocker(session=session) as session_mock:
+            self.mock_metadata(session_mock, url)
+            self.assertEqual(str(journal.reusable(entry, session)), str(url))
+            self.assertEqual(session_mock.call_count, 1)
+            self.assertIsNone(journal.reusable(entry, session, timeout_s=60))
+
+            # Shares that expire soon are uploaded again
+            with patch("time.time", return_value=entry['expires'] - 1000):
+                self.assertIsNone(journal.reusable(entry, session))
+
+            self.mock_metadata(session_mock, url, complete=False)
+            self.assertIsNone(journal.reusable(entry, session))
+
+            # Deleted shares are forgotten
+            self.mock_metadata(session_mock, url, status=404)
+            self.assertIsNone(journal.reusable(entry, session))
+        self.assertIsNone(Journal(self.journal_path).find(self.key()))
+
+    def test_compact(self):
+        journal = Journal(self.journal_path)
+        journal.COMPACT_MIN_LINES = 10
+        other = self.dir / "other"
+        other.write_bytes(b"")
+        other_key = JournalKey.from_file(other, "http://secsend.test", "other", "application/octet-stream")
+        journal.record(other_key, self.url(), 0)
+        for i in range(10):
+            url = self.url()
+            journal.record(self.key(), url, 0)
+        self.assertLessEqual(journal.lines, 10)
+        journal = Journal(self.journal_path)
+        self.assertEqual(journal.find(self.key())['url'], str(url))
+        self.assertIsNotNone(journal.find(other_key))
+
+        # Expired entries are dropped
+        journal.record(other_key, self.url(), 1)
+        with patch("time.time", return_value=journal.find(other_key)['expires']):
+            journal.compact()
+        self.assertEqual(len(self.journal_path.read_text().splitlines()), 1)
+
+    def test_truncated(self):
+        journal = Journal(self.journal_path)
+        journal.record(self.key(), self.url(), 0)
+        with open(self.journal_path, "a") as f:
+            f.write('{"path": "/tmp/x", "ser')
+        url = self.url()
+        journal = Journal(self.journal_path)
+        journal.record(self.key(), url, 0)
+        self.assertEqual(Journal(self.journal_path).find(self.key())['url'], str(url))
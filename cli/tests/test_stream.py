@@ -1,16 +1,25 @@
 import unittest
 import tempfile
 import io
+import json
+import base64
+import http.server
 import os
 import random
+import socket
 import string
+import struct
+import threading
 
+import requests
 import requests_mock
+from unittest.mock import patch
 
-from secsend.client import DownloadURL, RootID
-from secsend.stream import stream_transform, UploadCtx, DownloadCtx
+from secsend.client import DownloadURL, RootID, ClientAPI
+from secsend.stream import stream_transform, UploadCtx, DownloadCtx, StreamTransform, RateLimit, choose_chunk_size, CHUNK_SIZE_MIN
 from secsend.metadata import FileMetadata, encryptMetadata
-from secsend.crypto import AESGCMChunks, SignKey
+from secsend.crypto import AESGCMChunks, GCMIV, SignKey
+from secsend.compression import InvalidIndex
 
 class TransformerEncr:
     TAG = b"TTAG"
@@ -103,6 +112,18 @@ class TestStream(unittest.TestCase):
             out.flush()
             self.assertEqual(out.getvalue(), ref_data)
 
+    def test_stream_rate_limit(self):
+        ref_data = bytes(1000)
+        with patch("time.monotonic", return_value=10.0), patch("time.sleep") as sleep:
+            limit = RateLimit(100, burst=200)
+            stream = StreamTransform(TransformerEncr(), 100, rate_limit=limit)
+            out = b"".join(stream(io.BytesIO(ref_data)))
+            self.assertEqual(out, self._transform_data(ref_data, 100))
+            # The burst is consumed without waiting, and then one sleep per
+            # chunk
+            self.assertEqual(sleep.call_count, 8)
+            self.assertEqual(sleep.call_args_list[-1].args[0], 8)
+
     def mock_config(self, session_mock):
         session_mock.get("http://secsend.test/v1/config", json={'timeout_s_valid': [0]})
 
@@ -123,6 +144,7 @@ class TestStream(unittest.TestCase):
 
                 id_ = ctx.upload_new("http://secsend.test")
                 self.assertEqual(str(id_), str(myid))
+                self.assertEqual(session_mock.last_request.json()['size'], ctx.encrypted_size())
 
                 session_mock.post(ctx.client._get_url("upload/push/%s" % id_), json={})
                 ctx.upload_push()
@@ -142,6 +164,25 @@ class TestStream(unittest.TestCase):
                 session_mock.post(ctx.client._get_url("upload/finish/%s" % myid), json={})
                 ctx.upload_finish()
 
+    def test_upload_oneshot(self):
+        ref_data = b"hello world!"
+        myid = RootID.generate()
+        with tempfile.NamedTemporaryFile(prefix="secsend-test") as f:
+            f.write(ref_data)
+            f.flush()
+
+            ctx = UploadCtx.from_source_file(f.name)
+            with requests_mock.Mocker(session=ctx.session) as session_mock:
+                session_mock.get("http://secsend.test/v1/config", json={'timeout_s_valid': [0], 'oneshot_size_limit': 1024})
+                session_mock.post("http://secsend.test/v1/upload/oneshot", json={'root_id': str(myid)})
+
+                id_ = ctx.upload_new("http://secsend.test")
+                self.assertEqual(str(id_), str(myid))
+                ctx.upload_push()
+                ctx.upload_finish()
+                self.assertEqual(session_mock.call_count, 2)
+                self.assertEqual(len(session_mock.last_request.body), ctx.encrypted_size())
+
     def test_download(self):
         ref_data = "".join(random.choice(string.ascii_lowercase) for _ in range(257)).encode("ascii")
         key = random.randbytes(16)
@@ -156,10 +197,341 @@ class TestStream(unittest.TestCase):
         with requests_mock.Mocker(session=ctx.client.session) as session_mock:
             encrMetadata = encryptMetadata(metadata, AESGCMChunks(iv, key, encrypt=False))
             session_mock.get(ctx.client._get_url("metadata/%s" % myid), json={'metadata': encrMetadata.jsonable(), 'size': len(encr_data)})
-            self.assertEqual(ctx.get_metadata(), metadata)
+            # Servers that do not send metadata in the download response
+            session_mock.get(ctx.client._get_url("download/%s" % myid), content=encr_data)
+            self.assertEqual(ctx.get_metadata(prefetch=True), metadata)
+            self.assertEqual([r.path for r in session_mock.request_history], ["/v1/download/%s" % myid.lower(), "/v1/metadata/%s" % myid.lower()])
+
+            out = io.BytesIO()
+            for d in ctx.download():
+                out.write(d)
+            self.assertEqual(out.getvalue(), ref_data)
+
+    def test_download_single_request(self):
+        ref_data = "".join(random.choice(string.ascii_lowercase) for _ in range(257)).encode("ascii")
+        key = random.randbytes(16)
+        iv = random.randbytes(AESGCMChunks.IV_LEN)
+        encrypt = AESGCMChunks(iv, key, encrypt=True)
+        chunk_size = 17
+        encr_data = self._transform_data(ref_data, chunk_size, encrypt)
+
+        myid = "MYID"
+        ctx = DownloadCtx("http://secsend.test", myid, key)
+        metadata = FileMetadata(name="toto", mime_type="application/octet-stream", iv=iv, chunk_size=chunk_size, key_sign=SignKey(key, iv), timeout_s=0)
+        encrMetadata = encryptMetadata(metadata, AESGCMChunks(iv, key, encrypt=False))
+        headers = {
+            "X-Secsend-Metadata": base64.b64encode(json.dumps(encrMetadata.jsonable()).encode("ascii")).decode("ascii"),
+            "X-Secsend-Size": str(len(encr_data))
+        }
+        with requests_mock.Mocker(session=ctx.client.session) as session_mock:
+            session_mock.get(ctx.client._get_url("download/%s" % myid), body=io.BytesIO(encr_data), headers=headers)
+            self.assertEqual(ctx.get_metadata(prefetch=True), metadata)
+            self.assertEqual(ctx.decrypted_size(), len(ref_data))
 
-            session_mock.get(ctx.client._get_url("download/%s" % myid), body=io.BytesIO(encr_data))
             out = io.BytesIO()
             for d in ctx.download():
                 out.write(d)
             self.assertEqual(out.getvalue(), ref_data)
+            self.assertEqual(session_mock.call_count, 1)
+
+        # Resumed downloads only read the metadata
+        with DownloadCtx("http://secsend.test", myid, key) as ctx, requests_mock.Mocker(session=ctx.client.session) as session_mock:
+            session_mock.get(ctx.client._get_url("metadata/%s" % myid), json={'metadata': encrMetadata.jsonable(), 'size': len(encr_data)})
+            session_mock.get(ctx.client._get_url("download/%s" % myid), content=lambda request, context: encr_data[int(request.headers["Range"][len("bytes="):-1]):])
+            self.assertEqual(ctx.get_metadata(), metadata)
+            self.assertEqual([r.path for r in session_mock.request_history], ["/v1/metadata/%s" % myid.lower()])
+            self.assertEqual(b"".join(ctx.download(100)), ref_data[100:])
+            self.assertEqual(session_mock.last_request.headers["Range"], "bytes=%d-" % ((100//chunk_size)*(chunk_size+AESGCMChunks.TAG_SIZE)))
+
+    def test_batch(self):
+        ids = [RootID.generate() for _ in range(5)]
+        client = ClientAPI(requests.Session(), "http://secsend.test")
+        metadata = encryptMetadata(FileMetadata(name="toto", mime_type="application/octet-stream", iv=b"\x00"*12, chunk_size=10, key_sign=b"", timeout_s=0), AESGCMChunks(b"\x00"*12, b"\x00"*16, encrypt=True))
+
+        def reply(request, context):
+            return {'results': [{'id': id_, 'status': 200, 'metadata': metadata.jsonable(), 'size': 1} for id_ in request.json()['ids']]}
+        with requests_mock.Mocker(session=client.session) as session_mock:
+            session_mock.post(client._get_url("batch/metadata"), json=reply)
+            res = client.metadata_batch(ids, batch_size=2)
+            self.assertEqual(session_mock.call_count, 3)
+            self.assertEqual([r['id'] for r in res], [str(id_) for id_ in ids])
+            self.assertEqual(res[0]['metadata'], metadata)
+
+    def test_retry_after(self):
+        client = ClientAPI(requests.Session(), "http://secsend.test")
+        with requests_mock.Mocker(session=client.session) as session_mock, patch("time.sleep") as sleep:
+            session_mock.get(client._get_url("config"), [
+                {'status_code': 503, 'headers': {'Retry-After': '2'}},
+                {'json': {'timeout_s_valid': [0]}}])
+            self.assertEqual(client.config().timeout_s_valid, [0])
+            sleep.assert_called_once_with(2)
+
+            session_mock.get(client._get_url("config"), status_code=503, headers={'Retry-After': '1'})
+            with self.assertRaises(requests.HTTPError):
+                client.config()
+            self.assertEqual(session_mock.call_count, 2 + ClientAPI.MAX_RETRIES + 1)
+
+    def test_upload_push_retry(self):
+        ref_data = os.urandom(3*1024*1024 + 100)
+        myid = RootID.generate()
+        with tempfile.NamedTemporaryFile(prefix="secsend-test") as f:
+            f.write(ref_data)
+            f.flush()
+
+            ctx = UploadCtx.from_source_file(f.name)
+            received = []
+            def push(request, context):
+                data = b"".join(request.body)
+                if len(received) == 0:
+                    # Only the first chunk has been stored
+                    received.append(data[:ctx.encrypt.out_chunk_size(1024*1024)])
+                    context.status_code = 503
+                    context.headers['Retry-After'] = '1'
+                else:
+                    received.append(data)
+                return {}
+            with requests_mock.Mocker(session=ctx.session) as session_mock, patch("time.sleep"):
+                self.mock_config(session_mock)
+                session_mock.post("http://secsend.test/v1/upload/new", json={'root_id': str(myid)})
+                ctx.upload_new("http://secsend.test")
+                session_mock.post(ctx.client._get_url("upload/push/%s" % myid), json=push)
+                encr_metadata = encryptMetadata(ctx.metadata, ctx.encrypt).jsonable()
+                session_mock.get(ctx.client._get_url("metadata/%s" % myid.file_id()), json=lambda r, c: {'metadata': encr_metadata, 'size': len(received[0])})
+                done = []
+                ctx.upload_push(done.append)
+                self.assertEqual(sum(done), len(ref_data))
+
+            encr_data = b"".join(received)
+            self.assertEqual(len(encr_data), ctx.encrypted_size())
+            decrypt = AESGCMChunks(ctx.metadata.iv, ctx.key, encrypt=False)
+            self.assertEqual(self._transform_data(encr_data, 1024*1024 + AESGCMChunks.TAG_SIZE, decrypt), ref_data)
+
+    def test_upload_push_retry_reset(self):
+        # A real server, as requests_mock reads the whole body before
+        # answering. It rejects the first push before reading its body, and
+        # resets the connection before the client could read its response.
+        ref_data = os.urandom(3*1024*1024 + 100)
+        myid = RootID.generate()
+        received = []
+        pushes = []
+        ctx = None
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            def reply(self, data):
+                body = json.dumps(data).encode("ascii")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def do_GET(self):
+                if self.path == "/v1/config":
+                    self.reply({'timeout_s_valid': [0]})
+                else:
+                    self.reply({'metadata': encryptMetadata(ctx.metadata, ctx.encrypt).jsonable(), 'size': len(b"".join(received))})
+            def do_POST(self):
+                if self.path == "/v1/upload/new":
+                    self.rfile.read(int(self.headers["Content-Length"]))
+                    self.reply({'root_id': str(myid)})
+                    return
+                pushes.append(self.path)
+                if len(pushes) == 1:
+                    self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                    self.close_connection = True
+                    return
+                while True:
+                    size = int(self.rfile.readline().strip(), 16)
+                    received.append(self.rfile.read(size))
+                    self.rfile.readline()
+                    if size == 0:
+                        break
+                self.reply({})
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with tempfile.NamedTemporaryFile(prefix="secsend-test") as f:
+                f.write(ref_data)
+                f.flush()
+                ctx = UploadCtx.from_source_file(f.name)
+                ctx.upload_new("http://127.0.0.1:%d" % server.server_address[1])
+                with patch("time.sleep") as sleep:
+                    ctx.upload_push()
+                sleep.assert_called_once_with(1)
+                ctx.input_stream.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual(pushes, ["/v1/upload/push/%s" % myid]*2)
+        decrypt = AESGCMChunks(ctx.metadata.iv, ctx.key, encrypt=False)
+        self.assertEqual(b"".join(stream_transform(io.BytesIO(b"".join(received)), decrypt, ctx.metadata.chunk_size+AESGCMChunks.TAG_SIZE)), ref_data)
+
+    def test_cluster_redirect(self):
+        myid = RootID.generate()
+        with tempfile.NamedTemporaryFile(prefix="secsend-test") as f:
+            f.write(os.urandom(1000))
+            f.flush()
+
+            ctx = UploadCtx.from_source_file(f.name)
+            with requests_mock.Mocker(session=ctx.session) as session_mock:
+                self.mock_config(session_mock)
+                session_mock.post("http://secsend.test/v1/upload/new", status_code=307, headers={'Location': "http://node1.test/v1/upload/new?node=1"})
+                session_mock.post("http://node1.test/v1/upload/new?node=1", json={'root_id': str(myid)})
+                ctx.upload_new("http://secsend.test")
+                # The URL is the one of the cluster, and the upload goes on
+                # with the node that stores it
+                self.assertEqual(ctx.url.server, "http://secsend.test")
+                self.assertEqual(ctx.client.server, "http://node1.test")
+                session_mock.post("http://node1.test/v1/upload/push/%s" % myid, json={})
+                session_mock.post("http://node1.test/v1/upload/finish/%s" % myid, json={})
+                ctx.upload_push()
+                ctx.upload_finish()
+
+        ids = [RootID.generate() for _ in range(3)]
+        client = ClientAPI(requests.Session(), "http://secsend.test")
+        with requests_mock.Mocker(session=client.session) as session_mock:
+            session_mock.post(client._get_url("batch/delete"), json=lambda r, c: {'results': [
+                {'id': id_, 'status': 200} if i != 1 else {'id': id_, 'status': 307, 'location': "http://node1.test"}
+                for i, id_ in enumerate(r.json()['ids'])]})
+            session_mock.post("http://node1.test/v1/batch/delete", json=lambda r, c: {'results': [{'id': id_, 'status': 404, 'message': "unknown ID"} for id_ in r.json()['ids']]})
+            res = client.delete_batch(ids)
+            self.assertEqual([r['status'] for r in res], [200, 404, 200])
+            self.assertEqual(session_mock.last_request.json(), {'ids': [str(ids[1])]})
+
+    def test_compressed(self):
+        lines = ("%d,user%d,%s\n" % (i, i % 97, random.choice(("GET", "POST", "PUT"))) for i in range(200000))
+        ref_data = "".join(lines).encode("ascii") + os.urandom(100000)
+        myid = RootID.generate()
+        content = bytearray()
+        def push(request, context):
+            content.extend(b"".join(request.body))
+            return {}
+        def download(request, context):
+            start = int(request.headers.get("Range", "bytes=0-")[len("bytes="):-1])
+            return bytes(content[start:])
+        with tempfile.NamedTemporaryFile(prefix="secsend-test") as f:
+            f.write(ref_data)
+            f.flush()
+
+            ctx = UploadCtx.from_source_file(f.name)
+            self.assertTrue(ctx.should_compress("auto"))
+            with requests_mock.Mocker(session=ctx.session) as session_mock:
+                self.mock_config(session_mock)
+                session_mock.post("http://secsend.test/v1/upload/new", json={'root_id': str(myid)})
+                ctx.upload_new("http://secsend.test", compress=True)
+                # Small files are compressed in memory to know their size
+                declared_size = session_mock.last_request.json()['size']
+                session_mock.post(ctx.client._get_url("upload/push/%s" % myid), json=push)
+                ctx.upload_push()
+            self.assertEqual(len(content), declared_size)
+            self.assertLess(len(content), len(ref_data)//2)
+            full = bytes(content)
+            key = ctx.key
+            encr_metadata = encryptMetadata(ctx.metadata, ctx.encrypt)
+
+            # Resume uploads cut in the middle of a record, and of the index
+            for cut in (len(full)//3, len(full) - 10):
+                del content[cut:]
+                ctx = UploadCtx.from_source_file(f.name)
+                with requests_mock.Mocker(session=ctx.session) as session_mock:
+                    session_mock.get("http://secsend.test/v1/metadata/%s" % myid.file_id(), json={'metadata': encr_metadata.jsonable(), 'size': cut})
+                    session_mock.post("http://secsend.test/v1/upload/push/%s" % myid, json=push)
+                    ctx.upload_resume(DownloadURL("http://secsend.test", myid, key))
+                    ctx.upload_push()
+                self.assertEqual(bytes(content), full)
+
+        # Downloads, from the start and from the middle of a chunk
+        ctx = DownloadCtx("http://secsend.test", myid.file_id(), key)
+        with requests_mock.Mocker(session=ctx.client.session) as session_mock:
+            session_mock.get(ctx.client._get_url("metadata/%s" % myid.file_id()), json={'metadata': encr_metadata.jsonable(), 'size': len(full)})
+            session_mock.get(ctx.client._get_url("download/%s" % myid.file_id()), content=download)
+            ctx.get_metadata()
+            self.assertEqual(ctx.decrypted_size(), len(ref_data))
+            self.assertEqual(b"".join(ctx.download()), ref_data)
+            out_seek = 2*1024*1024 + 12345
+            self.assertEqual(b"".join(ctx.download(out_seek)), ref_data[out_seek:])
+            index = ctx.get_index()
+
+        # Trailing records dropped by the server are detected, even though the
+        # index is still valid
+        for last in (len(index.offsets) - 1, len(index.offsets) - 3):
+            dropped = full[:index.offsets[last]] + full[index.records_end:]
+            content[:] = dropped
+            ctx = DownloadCtx("http://secsend.test", myid.file_id(), key)
+            with requests_mock.Mocker(session=ctx.client.session) as session_mock:
+                session_mock.get(ctx.client._get_url("metadata/%s" % myid.file_id()), json={'metadata': encr_metadata.jsonable(), 'size': len(dropped)})
+                session_mock.get(ctx.client._get_url("download/%s" % myid.file_id()), content=download)
+                ctx.get_metadata()
+                with self.assertRaises(InvalidIndex):
+                    b"".join(ctx.download())
+
+        self.assertFalse(UploadCtx(io.BytesIO(os.urandom(100000)), None, "x", "x", None, 100000).should_compress("auto"))
+
+    def test_choose_chunk_size(self):
+        MB = 1024*1024
+        # Unknown and small sizes use the preferred size
+        self.assertEqual(choose_chunk_size(None, MB, 16*MB), MB)
+        self.assertEqual(choose_chunk_size(1000, MB, 16*MB), MB)
+        # Big files get bigger chunks, up to the maximum
+        self.assertEqual(choose_chunk_size(5*1024*MB, MB, 16*MB), 5*MB)
+        self.assertEqual(choose_chunk_size(100*1024**3, MB, 16*MB), 16*MB)
+        self.assertEqual(choose_chunk_size(100*1024**3, MB, MB), MB)
+        # Slow links get smaller chunks
+        self.assertEqual(choose_chunk_size(100*1024**3, MB, 16*MB, 100*1024), 192*1024)
+        self.assertEqual(choose_chunk_size(100*1024**3, MB, 16*MB, 1), CHUNK_SIZE_MIN)
+        # AES-GCM limit
+        self.assertEqual(choose_chunk_size(2**50, MB, 2**40), GCMIV.MAX_CHUNK_SIZE)
+
+    def test_chunk_sizes(self):
+        # Uploads, resumed uploads and ranged downloads, for various chunk
+        # sizes
+        MB = 1024*1024
+        for chunk_size in (1, 17, 4096, CHUNK_SIZE_MIN, MB, 3*MB+7):
+            ref_data = os.urandom(3*chunk_size+5 if chunk_size > 64 else 257)
+            myid = RootID.generate()
+            content = bytearray()
+            def push(request, context):
+                content.extend(b"".join(request.body))
+                return {}
+            def download(request, context):
+                start = int(request.headers.get("Range", "bytes=0-")[len("bytes="):-1])
+                return bytes(content[start:])
+            with tempfile.NamedTemporaryFile(prefix="secsend-test") as f:
+                f.write(ref_data)
+                f.flush()
+
+                ctx = UploadCtx.from_source_file(f.name)
+                with requests_mock.Mocker(session=ctx.session) as session_mock:
+                    session_mock.get("http://secsend.test/v1/config", json={'timeout_s_valid': [0], 'chunk_size_preferred': chunk_size, 'chunk_size_max': chunk_size})
+                    session_mock.post("http://secsend.test/v1/upload/new", json={'root_id': str(myid)})
+                    ctx.upload_new("http://secsend.test")
+                    self.assertEqual(ctx.metadata.chunk_size, chunk_size)
+                    session_mock.post(ctx.client._get_url("upload/push/%s" % myid), json=push)
+                    ctx.upload_push()
+                self.assertEqual(len(content), ctx.encrypted_size())
+                full = bytes(content)
+                key = ctx.key
+                encr_metadata = encryptMetadata(ctx.metadata, ctx.encrypt)
+
+                encr_chunk_size = chunk_size + AESGCMChunks.TAG_SIZE
+                for cut in (1, encr_chunk_size-1, encr_chunk_size, encr_chunk_size+1, len(full)-1):
+                    del content[cut:]
+                    ctx = UploadCtx.from_source_file(f.name)
+                    with requests_mock.Mocker(session=ctx.session) as session_mock:
+                        session_mock.get("http://secsend.test/v1/metadata/%s" % myid.file_id(), json={'metadata': encr_metadata.jsonable(), 'size': cut})
+                        session_mock.post("http://secsend.test/v1/upload/push/%s" % myid, json=push)
+                        ctx.upload_resume(DownloadURL("http://secsend.test", myid, key))
+                        ctx.upload_push()
+                    self.assertEqual(bytes(content), full)
+
+            ctx = DownloadCtx("http://secsend.test", myid.file_id(), key)
+            with requests_mock.Mocker(session=ctx.client.session) as session_mock:
+                session_mock.get(ctx.client._get_url("metadata/%s" % myid.file_id()), json={'metadata': encr_metadata.jsonable(), 'size': len(full)})
+                session_mock.get(ctx.client._get_url("download/%s" % myid.file_id()), content=download)
+                ctx.get_metadata()
+                self.assertEqual(ctx.decrypted_size(), len(ref_data))
+                for out_seek in (0, 1, chunk_size-1, chunk_size, chunk_size+1, len(ref_data)-1):
+                    self.assertEqual(b"".join(ctx.download(out_seek)), ref_data[out_seek:])
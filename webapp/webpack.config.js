@@ -6,6 +6,25 @@ const { SubresourceIntegrityPlugin } = require('webpack-subresource-integrity');
 const MiniCssExtractPlugin = require("mini-css-extract-plugin");
 const PurgeCSSPlugin = require('purgecss-webpack-plugin')
 const BundleAnalyzerPlugin = require('webpack-bundle-analyzer').BundleAnalyzerPlugin;
+const CompressionPlugin = require('compression-webpack-plugin');
+const zlib = require('zlib');
+
+// Precompressed variants of every asset, served as is by secsend_api
+// according to the Accept-Encoding header of clients.
+const compressionPlugins = () => [
+  new CompressionPlugin({
+    filename: '[path][base].gz',
+    algorithm: 'gzip',
+    test: /\.(js|css|html|svg)$/,
+    compressionOptions: { level: 9 },
+  }),
+  new CompressionPlugin({
+    filename: '[path][base].br',
+    algorithm: 'brotliCompress',
+    test: /\.(js|css|html|svg)$/,
+    compressionOptions: { params: { [zlib.constants.BROTLI_PARAM_QUALITY]: 11 } },
+  }),
+];
 
 const gui = {
   entry: './src/gui/index.ts',
@@ -39,7 +58,8 @@ const gui = {
       // Give paths to parse for rules. These should be absolute!
       paths: glob.sync(path.join(__dirname, 'src/gui/*.ts')),
     }),
-    new SubresourceIntegrityPlugin()
+    new SubresourceIntegrityPlugin(),
+    ...compressionPlugins()
   ],
   output: {
     filename: 'main.[contenthash].js',
@@ -79,7 +99,8 @@ const dl = {
       filename: 'dl.html'
     }),
     new MiniCssExtractPlugin({filename: 'dl.[contenthash].css'}),
-    new SubresourceIntegrityPlugin()
+    new SubresourceIntegrityPlugin(),
+    ...compressionPlugins()
   ],
   output: {
     filename: 'dl.[contenthash].js',
@@ -118,7 +139,7 @@ const sw = {
     path: path.resolve(__dirname, 'dist_web'),
   },
   //plugins: [new webpack.IgnorePlugin(/\.\.\/dist/)]
-  plugins: []
+  plugins: [...compressionPlugins()]
 };
 
 module.exports = (env, argv) => {